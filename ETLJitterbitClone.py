@@ -3,12 +3,25 @@
 # Version 0.6
 
 import sys
+import atexit
+import threading
 import os
 import shutil
 import glob
+import hashlib
+import io
+import heapq
+import json
+import pickle
+import queue
 import random
+import time
 import pyodbc
 import csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import itertools
+from array import array
+from tempfile import gettempdir
 from datetime import datetime as dt
 from datetime import date as ymd
 from dateutil import relativedelta as reldelt
@@ -48,6 +61,9 @@ def sf_connection_obj(sfUname, sfPW, sfToken, test=False):
         return sf
 
 
+errorLogged = threading.local()  # errors logged by this thread - see errorLog
+
+
 def errorLog(p=None, **d):  # d is details
     '''
     Called when exception is raised. Appends to error.txt log file in
@@ -55,7 +71,10 @@ def errorLog(p=None, **d):  # d is details
     error_logs sub directory.
 
     Typical call errorLog(p='point: A', err=sys.exc_info(), m=mode ...)
+    Counts calls per thread in errorLogged.count so a caller can tell that
+    a function it called hit an error, even where it still returned.
     '''
+    errorLogged.count = getattr(errorLogged, 'count', 0) + 1
     with open(r'.\error_logs\error.txt', 'a+') as f:
         f.write(p + '\n')
         f.write(dt.today().strftime('%Y-%m-%d-%H:%M:%S') + '\n')
@@ -64,6 +83,211 @@ def errorLog(p=None, **d):  # d is details
         f.write('\n' * 3)
 
 
+# Per run trace of every stage - see run_trace
+runTrace = {'run': dt.today().strftime('%Y%m%d%H%M%S'), 'stages': []}
+runTraceLock = threading.Lock()
+metricsDir = os.path.join('.', 'metrics')
+traceCounts = ['rows_in', 'rows_out', 'rows_error', 'bytes_in', 'bytes_out',
+               'api_calls']
+promMetrics = [  # Prometheus name, stage key, help
+    ('stage_runs', 'runs', 'Times the stage ran this run.'),
+    ('stage_seconds', 'seconds', 'Wall time spent in the stage.'),
+    ('stage_rows_in', 'rows_in', 'Rows read by the stage.'),
+    ('stage_rows_out', 'rows_out', 'Rows written or returned by the stage.'),
+    ('stage_rows_error', 'rows_error', 'Rows that failed, see run_errors.'),
+    ('stage_bytes_read', 'bytes_in', 'Bytes of staged files read.'),
+    ('stage_bytes_written', 'bytes_out', 'Bytes of staged files written.'),
+    ('stage_api_calls', 'api_calls', 'SQL queries or Salesforce calls.')]
+
+
+def run_trace(mode, path=None):
+    '''
+    Every entry point - pull_SQL_data, transformCSV, transformPipeline,
+    CSV_query, query_salesforce, preupload_prep, chunk_n_upload and
+    bulk2_upload - adds one stage to the run's trace each time it is
+    called, e.g.
+    {'stage': 'transformCSV.purge', 'started': '2020-03-09T02:00:01',
+     'seconds': 1.92, 'rows_in': 100000, 'rows_out': 99950,
+     'rows_error': 0, 'bytes_in': 21004113, 'bytes_out': 20991870,
+     'api_calls': 0}
+
+    bytes are of staged files read / written. api_calls are SQL queries
+    for pull_SQL_data, Salesforce calls for the rest. A stage's time
+    includes the stages it calls e.g. preupload_prep includes its
+    chunk_n_upload.
+
+    Mode: 'json' - writes the whole trace to path, by default
+    metrics/trace_<run>.json. Returns path.
+
+    Mode: 'prometheus' - writes the totals per stage to path as a
+    Prometheus textfile (e.g. for node_exporter's textfile collector), by
+    default metrics/jitterbit.prom. Returns path.
+
+    Mode: 'summary' - returns the totals per stage, slowest first e.g.
+    {'pull_SQL_data.query_save': {'runs': 1, 'seconds': 41.2, ...}, ...}
+
+    Mode: 'reset' - empties the trace and starts a new run.
+    '''
+    if mode == 'reset':
+        with runTraceLock:
+            runTrace['run'] = dt.today().strftime('%Y%m%d%H%M%S')
+            runTrace['stages'] = []
+        return
+
+    with runTraceLock:
+        stages = list(runTrace['stages'])
+    totals = {}
+    for stage in stages:
+        t = totals.setdefault(stage['stage'], dict(
+            {'runs': 0, 'seconds': 0.0}, **{i: 0 for i in traceCounts}))
+        t['runs'] += 1
+        t['seconds'] = round(t['seconds'] + stage['seconds'], 4)
+        for i in traceCounts:
+            t[i] += stage[i]
+    totals = dict(sorted(totals.items(), key=lambda i: -i[1]['seconds']))
+
+    if mode == 'summary':
+        return totals
+    elif mode == 'json':
+        path = path or os.path.join(metricsDir,
+                                    'trace_' + runTrace['run'] + '.json')
+        body = json.dumps({'run': runTrace['run'], 'totals': totals,
+                           'stages': stages}, indent=1)
+    elif mode == 'prometheus':
+        path = path or os.path.join(metricsDir, 'jitterbit.prom')
+        lines = []
+        for metric, key, about in promMetrics:
+            lines.append('# HELP jitterbit_' + metric + ' ' + about)
+            lines.append('# TYPE jitterbit_' + metric + ' gauge')
+            for name in totals:
+                lines.append('jitterbit_' + metric + '{stage="' + name +
+                             '"} ' + str(totals[name][key]))
+        lines.append('# HELP jitterbit_run_timestamp_seconds When the '
+                     'trace was written.')
+        lines.append('# TYPE jitterbit_run_timestamp_seconds gauge')
+        lines.append('jitterbit_run_timestamp_seconds ' + str(time.time()))
+        body = '\n'.join(lines) + '\n'
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as f:  # never a half written file
+        f.write(body)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def traceStart(name):
+    '''
+    Starts timing a stage of run_trace. Returns the stage, a dict to pass
+    to traceEnd.
+    '''
+    stage = {'stage': name, 'started': dt.today().isoformat(
+        timespec='seconds'), 'seconds': None}
+    for i in traceCounts:
+        stage[i] = 0
+    stage['clock'] = time.perf_counter()
+    return stage
+
+
+def traceEnd(stage, **counts):
+    '''
+    Finishes a stage of run_trace - counts are any of traceCounts e.g.
+    rows_in=n - and adds it to the trace. Never raises.
+    '''
+    try:
+        stage.update(counts)
+        stage['seconds'] = round(time.perf_counter() - stage.pop('clock'), 4)
+        with runTraceLock:
+            runTrace['stages'].append(stage)
+    except Exception:
+        print('stage not traced!', stage, sys.exc_info())
+
+
+# Errors of the run, buffered - see run_errors
+runErrors = {'points': {}, 'emailPackage': None, 'atexit': False}
+runErrorsLock = threading.Lock()
+runErrorSamples = 5  # rows kept per point as samples for the summary
+
+
+def run_errors(mode, p=None, error=None, row=None, deadLetter=None,
+               emailPackage=None, **d):  # d is details, as errorLog
+    '''
+    Run scoped collector for errors that can happen once per row e.g. a
+    malformed column in transformCSV. Rather than an errorLog entry and an
+    email for every bad row, each error is counted against its point and
+    the first runErrorSamples of them kept as samples. One summary is then
+    logged and emailed at the end of the run.
+
+    Mode: 'add' - records one error. p is the point e.g. 'Point: F', error
+    is sys.exc_info(), row the row that failed and deadLetter the file it
+    was written to (see deadLetterRow). Any other keyword args are kept
+    with the sample, like errorLog. emailPackage is remembered for the
+    summary. The first 'add' also registers 'alert' to run on exit, so the
+    summary goes out even if the mainline script never asks for it.
+
+    Mode: 'summary' - returns the errors so far, without clearing them e.g.
+    {'Point: F': {'count': 100000, 'errors': {'IndexError': 100000},
+                  'samples': [...], 'dead_letters': ['x_123_deadletter.csv']}}
+
+    Mode: 'alert' - writes the summary to error.txt (one errorLog entry per
+    point) and sends it as one 'err' email to 'prim' if an emailPackage was
+    passed here or to any 'add'. Then clears the collector. Does nothing if
+    there were no errors. Returns the summary sent.
+
+    Mode: 'reset' - clears the collector without sending anything.
+    '''
+    if mode == 'add':
+        kind = error[0].__name__ if error and error[0] else 'Error'
+        with runErrorsLock:
+            point = runErrors['points'].setdefault(p, {
+                'count': 0, 'errors': {}, 'samples': [], 'dead_letters': []})
+            point['count'] += 1
+            point['errors'][kind] = point['errors'].get(kind, 0) + 1
+            if len(point['samples']) < runErrorSamples:
+                point['samples'].append(dict(
+                    {'time': dt.today().strftime('%Y-%m-%d-%H:%M:%S'),
+                     'error': kind + ': ' + str(error[1] if error else ''),
+                     'row': row}, **d))
+            if deadLetter and deadLetter not in point['dead_letters']:
+                point['dead_letters'].append(deadLetter)
+            if emailPackage:  # not None
+                runErrors['emailPackage'] = emailPackage
+            if not runErrors['atexit']:
+                runErrors['atexit'] = True
+                atexit.register(run_errors, 'alert')
+        return
+
+    with runErrorsLock:
+        summary = json.loads(json.dumps(runErrors['points'], default=str))
+        if mode == 'summary':
+            return summary
+        emailPackage = emailPackage or runErrors['emailPackage']
+        runErrors['points'] = {}
+        runErrors['emailPackage'] = None
+    if mode == 'reset' or len(summary) == 0:
+        return
+
+    lines = []
+    for p in summary:
+        point = summary[p]
+        errorLog(p=p, count=point['count'], errors=point['errors'],
+                 dead_letters=point['dead_letters'],
+                 samples=point['samples'])
+        lines.append(p + ' - ' + str(point['count']) + ' row(s) failed: ' +
+                     ', '.join([i + ' x' + str(point['errors'][i])
+                                for i in point['errors']]))
+        for i in point['dead_letters']:
+            lines.append('  dead letter file: ' + i)
+        for sample in point['samples']:
+            lines.append('  e.g. ' + sample['error'] + ' - row: ' +
+                         str(sample['row']))
+    if emailPackage:  # not None
+        try:
+            emailalert.alerter(emailPackage, mode='err', to='prim',
+                               body='Errors this run:\n\n' + '\n'.join(lines))
+        except Exception:
+            print('error summary not sent!', sys.exc_info())
+    return summary
+
+
 def hhmmss_to_secs(hhmmss):
     '''
     Converts hhmmss time format to equivalent seconds totality. E.g. SAP
@@ -103,6 +327,13 @@ def mapSourceDestination(mode, source=None, target=None, user=None, pw=None,
     'map_staging' - will only map staging network share.
 
     'unmap_staging' - will only unmap staging network share.
+
+    'map_source' - will only map source network share.
+
+    'unmap_source' - will only unmap source network share.
+
+    Functions don't call the staging modes directly but through stageBegin
+    and stageEnd, which skip them when staging_area has been opened.
     '''
     try:
         if mode == 'map_all':
@@ -123,6 +354,12 @@ def mapSourceDestination(mode, source=None, target=None, user=None, pw=None,
                     target=target, pw=pw, user=user))
         elif mode == 'unmap_staging':
             os.system(r'NET USE Q: /DELETE')
+        elif mode == 'map_source':  # only source
+            os.system(
+                r'NET USE Y: {source} {pw} /USER:{user} /persistent:No'.format(
+                    source=source, pw=pw, user=user))
+        elif mode == 'unmap_source':
+            os.system(r'NET USE Y: /DELETE')
     except Exception:
         if emailPackage:  # not None
             emailalert.alerter(emailPackage, mode='err', to='prim',
@@ -130,6 +367,173 @@ def mapSourceDestination(mode, source=None, target=None, user=None, pw=None,
         errorLog(p='Point: A', mode=mode, error=str(sys.exc_info()))
 
 
+# staging_area - the backend staged files live on for the job, see stageOpen
+staging = {}
+stagingLocal = os.path.join('.', 'staging')
+
+
+def staging_area(mode, backend='local', root=None, share=None, user=None,
+                 pw=None, name=None, emailPackage=None):
+    '''
+    Opens the staging area once for a whole job, instead of every function
+    mapping the Q: share with NET USE on the way in and unmapping it on the
+    way out. While open, the 'target', 'user', 'pw' args of transformCSV,
+    CSV_query, preupload_prep, pull_SQL_data etc are not needed and ignored.
+    Not opened - every function maps and unmaps Q: itself as always.
+
+    E.g.
+    staging_area('open', 'local', share=stg, user=uName, pw=uPw)
+    f = lastModifiedFile('CARPARKSALES_DEV_*.xls', 'csv', source=src, ...)
+    tx = transformCSV('remove_header', f)
+    ...
+    staging_area('publish', name=tx)  # keep a copy of the final file
+    staging_area('close')
+
+    Mode: 'open' - backend is one of:
+        'smb' - the Q: share as before, mapped once. share is its UNC path.
+        'local' - folder on local disk, root or stagingLocal by default.
+        'tmpfs' - folder for this process under /dev/shm (RAM) or the temp
+        folder where there is no /dev/shm. Removed again on 'close'.
+        'memory' - files held in a dictionary, nothing touches disk. Only
+        for files that comfortably fit in memory.
+    For backends other than 'smb', share is the optional final sink i.e.
+    where 'publish' copies files to. Returns the root staged names are
+    relative to.
+
+    Mode: 'publish' - copies staged file name to the share (mapped as Q: for
+    the copy only). Nothing to do for 'smb'. Returns name.
+
+    Mode: 'close' - unmaps Q: ('smb'), removes the tmpfs folder or drops
+    the memory files. Functions map and unmap Q: themselves again after it.
+    '''
+    try:
+        if mode == 'open':
+            if staging:  # already open - one at a time
+                staging_area('close')
+            if backend == 'smb':
+                mapSourceDestination('map_staging', target=share, user=user,
+                                     pw=pw, emailPackage=emailPackage)
+                root = 'Q:'
+            elif backend == 'local':
+                root = root or stagingLocal
+            elif backend == 'tmpfs':
+                base = '/dev/shm' if os.path.isdir('/dev/shm') \
+                    else gettempdir()
+                root = os.path.join(base, 'staging_' + str(os.getpid()))
+            elif backend == 'memory':
+                staging['files'] = dict()  # name: bytes
+            if backend == 'local' or backend == 'tmpfs':
+                os.makedirs(root, exist_ok=True)
+                root = os.path.join(root, '')  # trailing separator
+            staging.update({'backend': backend, 'root': root, 'share': share,
+                            'user': user, 'pw': pw})
+            return root
+        elif mode == 'publish':
+            if staging.get('backend', 'smb') == 'smb':  # already there
+                return name
+            mapSourceDestination('map_staging', target=staging['share'],
+                                 user=staging['user'], pw=staging['pw'],
+                                 emailPackage=emailPackage)
+            try:
+                with stageOpen(name, 'rb') as orig, \
+                        open('Q:' + name, 'wb') as new:
+                    shutil.copyfileobj(orig, new)
+            finally:
+                mapSourceDestination('unmap_staging')
+            return name
+        elif mode == 'close':
+            if staging.get('backend') == 'smb':
+                mapSourceDestination('unmap_staging')
+            elif staging.get('backend') == 'tmpfs':
+                shutil.rmtree(staging['root'], ignore_errors=True)
+            staging.clear()
+    except Exception:
+        if emailPackage:  # not None
+            emailalert.alerter(emailPackage, mode='err', to='prim',
+                               body='Error @ Point: AE')
+        errorLog(p='Point: AE', mode=mode, backend=backend, root=root,
+                 name=name, error=str(sys.exc_info()))
+
+
+def stageBegin(target=None, user=None, pw=None):
+    '''
+    Called by each function before it reads or writes staged files. Maps Q:
+    unless staging_area is open.
+    '''
+    if not staging:
+        mapSourceDestination('map_staging', target=target, user=user, pw=pw)
+
+
+def stageEnd():
+    '''
+    Called by each function when done with staged files. Unmaps Q: unless
+    staging_area is open.
+    '''
+    if not staging:
+        mapSourceDestination('unmap_staging')
+
+
+def stageOpen(name, mode='r', newline=None, encoding=None):
+    '''
+    open() for a staged file name e.g. 'carpark_123.csv', on whichever
+    backend staging_area has open - the Q: share if none.
+    '''
+    if staging.get('backend') == 'memory':
+        files = staging['files']
+        if 'r' in mode:
+            if name not in files:
+                raise FileNotFoundError('not staged: ' + name)
+            buf = io.BytesIO(files[name])
+        else:  # 'w' or 'a'
+            buf = MemoryFile(name, files.get(name, b'') if 'a' in mode
+                             else b'')
+        if 'b' in mode:
+            return buf
+        return io.TextIOWrapper(buf, encoding=encoding or 'utf-8',
+                                newline=newline)
+    return open(staging.get('root', 'Q:') + name, mode, newline=newline,
+                encoding=encoding)
+
+
+def stageSize(name):
+    '''
+    Size in bytes of a staged file name, 0 if it isn't there. For run_trace.
+    '''
+    try:
+        if staging.get('backend') == 'memory':
+            return len(staging['files'].get(name, b''))
+        return os.path.getsize(staging.get('root', 'Q:') + name)
+    except OSError:
+        return 0
+
+
+def stageRemove(name):
+    '''
+    os.remove() for a staged file name.
+    '''
+    if staging.get('backend') == 'memory':
+        staging['files'].pop(name, None)
+    else:
+        os.remove(staging.get('root', 'Q:') + name)
+
+
+class MemoryFile(io.BytesIO):
+    '''
+    Staged file written on the 'memory' backend - saved to the backend when
+    closed, like a file on disk.
+    '''
+
+    def __init__(self, name, data=b''):
+        super().__init__(data)
+        self.seek(0, io.SEEK_END)  # 'a' mode - carries on at the end
+        self.stageName = name
+
+    def close(self):
+        if not self.closed and 'files' in staging:
+            staging['files'][self.stageName] = self.getvalue()
+        super().close()
+
+
 def lastModifiedFile(src, extension=None, source=None, target=None, user=None,
                      pw=None, emailPackage=None):
     '''
@@ -151,21 +555,17 @@ def lastModifiedFile(src, extension=None, source=None, target=None, user=None,
     'csv' will change extension of copied file to .csv
 
     'source', 'target', 'user', 'pw' - these are to call mapSourceDestination
+
+    Only ever picks up the one newest file. To process every report as it
+    lands use watch_folder.
     '''
     targetFile = ''
-    lastMod = {}  # a list of all files with similar name and file extension
-    tformat = '%Y-%m-%d %H:%M:%S'
-    sortedLastMod = []  # date/time of all files in lastMod dictionary
-
-    mapSourceDestination('map_all', source=source, target=target, user=user,
-                         pw=pw)  # oh well
-    try:
-        for file in glob.glob('Y:' + src):  # create list of all files with *
-            lastMod[file] = os.path.getctime(file)
+    stagedFile = ''
 
-        for i in lastMod:
-            sortedLastMod.append(dt.fromtimestamp(lastMod[i]).
-                                 strftime(tformat))
+    mapSourceDestination('map_source', source=source, user=user, pw=pw)
+    stageBegin(target, user, pw)
+    try:  # newest creation time, one stat per file
+        targetFile = max(glob.glob('Y:' + src), key=os.path.getctime)
     except Exception:
         if emailPackage:  # not None
             emailalert.alerter(emailPackage, mode='err', to='prim',
@@ -173,18 +573,8 @@ def lastModifiedFile(src, extension=None, source=None, target=None, user=None,
         errorLog(p='Point: B', source=src, fileExt=extension,
                  error=str(sys.exc_info()))
 
-    sortedLastMod.sort()  # ascending i.e. last entry is newest date/time
-
     try:
-        for j in lastMod:  # search & assign last modified file to targetFile
-            if dt.fromtimestamp(lastMod[j]).strftime(tformat) == sortedLastMod[-1]:
-                targetFile = j  # last in ascending order
-        targetFile  # y:lastmodedfile.xls
-
-        if extension == None:
-            shutil.copy(targetFile, r'Q:' + targetFile)  # copy
-        else:  # change extension
-            shutil.copy(targetFile, r'Q:' + targetFile[2:-3] + extension)
+        stagedFile = stageFile(targetFile, extension)
     except Exception:
         if emailPackage:  # not None
             emailalert.alerter(emailPackage, mode='err', to='prim',
@@ -192,12 +582,181 @@ def lastModifiedFile(src, extension=None, source=None, target=None, user=None,
         errorLog(p='Point: C', source=src, fileExt=extension,
                  targFile=targetFile, error=str(sys.exc_info()))
 
-    mapSourceDestination('unmap_all')
+    mapSourceDestination('unmap_source')
+    stageEnd()
+
+    return stagedFile  # to be passed into preupload_prep
+
+
+def stageFile(file, extension=None):
+    '''
+    Copies a file found on the source share e.g. 'Y:CARPARKSALES_1.xls' to
+    staging and returns the staged file's name e.g. 'CARPARKSALES_1.xls'.
+    'extension' as per lastModifiedFile. Source share and staging need to
+    be mapped / open.
+    '''
+    name = file[2:]  # drop 'Y:'
+    if extension != None:  # change extension
+        name = name[:-3] + extension
+    with open(file, 'rb') as orig, stageOpen(name, 'wb') as new:
+        shutil.copyfileobj(orig, new)
+    return name
+
+
+watchSeenFile = os.path.join('.', 'state', 'watch_seen.json')
+
+
+def watch_folder(src, handler, extension=None, poll=30, settle=2,
+                 polls=None, backfill=False, seenFile=None, source=None,
+                 target=None, user=None, pw=None, emailPackage=None):
+    '''
+    Ingestion service - watches the source share for new files matching src
+    and hands each one to handler as soon as it is complete, instead of
+    picking up only the newest file once per scheduled run (lastModifiedFile).
+
+    E.g. car park:
+
+    def carpark(f):
+        tx = transformPipeline([...], f)
+        preupload_prep('Opportunity', sf, tx, ...)
+
+    watch_folder('CARPARKSALES_DEV_*.xls', carpark, extension='csv',
+                 source=src, target=stg, user=uName, pw=uPw)
+
+    'src', 'extension', 'source', 'target', 'user', 'pw' - as per
+    lastModifiedFile. Both shares stay mapped while watching.
+
+    'handler' - function called with the staged file's name (as returned by
+    lastModifiedFile) once per new file, oldest first. Runs on a worker
+    thread so the share is still polled while a file is being loaded. A
+    file overwritten since it was processed (newer modified time) is
+    handed over again.
+
+    'poll' - seconds between looks at the share. The share is polled rather
+    than watched for events as change notifications are not reliable over
+    a mapped network drive.
+
+    'settle' - a file counts as complete once its size and modified time
+    have not changed for this many polls, so a report SAP is still writing
+    is never picked up half done.
+
+    'polls' - stop after this many polls. None (default) watches until
+    interrupted (Ctrl+C).
+
+    'backfill' - the very first time src is watched, files already there
+    are recorded as seen and not processed unless this is True.
+
+    'seenFile' - defaults to watchSeenFile. JSON record of files already
+    handed to handler, per src, so a restart does not process them again.
+    A file is recorded, with the modified time it was queued at, once
+    handler returns - or raises, in which case it is alerted on (Point: AD)
+    and not retried until it is overwritten.
+
+    Returns a list of staged file names processed successfully.
+    '''
+    seenFile = seenFile or watchSeenFile
+    try:
+        with open(seenFile) as f:
+            seen = json.load(f)
+    except FileNotFoundError:
+        seen = {}
+    first = src not in seen
+    done = seen.setdefault(src, {})  # file: modified time when queued
+    sizes = {}  # file: [size, modified time, polls unchanged]
+    queued = set()
+    work = queue.Queue()
+    seenLock = threading.Lock()  # worker and poll loop both save seen
+    processed = []
+
+    def worker():
+        while True:
+            item = work.get()
+            if item == None:  # stopping
+                break
+            file, mtime = item  # mtime as settled - file may be gone now
+            try:
+                staged = stageFile(file, extension)
+                handler(staged)
+                processed.append(staged)
+            except Exception:
+                if emailPackage:  # not None
+                    emailalert.alerter(emailPackage, mode='err', to='prim',
+                                       body='Error @ Point: AD - ' + file)
+                errorLog(p='Point: AD', source=src, file=file,
+                         error=str(sys.exc_info()))
+            try:
+                with seenLock:
+                    done[file] = mtime
+                    queued.discard(file)  # done first - never both missing
+                    watchSeenSave(seenFile, seen)
+            except Exception:  # keep the worker alive for the next file
+                if emailPackage:  # not None
+                    emailalert.alerter(emailPackage, mode='err', to='prim',
+                                       body='Error @ Point: AD - ' + file)
+                errorLog(p='Point: AD', source=src, file=file,
+                         error=str(sys.exc_info()))
+
+    mapSourceDestination('map_source', source=source, user=user, pw=pw)
+    stageBegin(target, user, pw)
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    count = 0
+    try:
+        while polls == None or count < polls:
+            try:
+                for file in sorted(glob.glob('Y:' + src),
+                                   key=os.path.getctime):
+                    if file in queued:
+                        continue
+                    stat = os.stat(file)
+                    if done.get(file) == stat.st_mtime:  # not overwritten
+                        continue
+                    if first and not backfill:  # already there - skip
+                        done[file] = stat.st_mtime
+                        continue
+                    last = sizes.get(file)
+                    if last == None or last[0] != stat.st_size or \
+                            last[1] != stat.st_mtime:  # new or still growing
+                        sizes[file] = [stat.st_size, stat.st_mtime, 0]
+                        continue
+                    last[2] += 1
+                    if last[2] >= settle:  # complete - queue it
+                        sizes.pop(file)
+                        queued.add(file)
+                        work.put((file, stat.st_mtime))
+                if first:
+                    with seenLock:
+                        watchSeenSave(seenFile, seen)
+                    first = False
+            except Exception:
+                if emailPackage:  # not None
+                    emailalert.alerter(emailPackage, mode='err', to='prim',
+                                       body='Error @ Point: AC')
+                errorLog(p='Point: AC', source=src,
+                         error=str(sys.exc_info()))
+            count += 1
+            if polls == None or count < polls:
+                time.sleep(poll)
+    except KeyboardInterrupt:
+        print('watch_folder stopped -', src)
+    finally:
+        work.put(None)  # let the worker finish what is queued
+        thread.join()
+        mapSourceDestination('unmap_source')
+        stageEnd()
+
+    return processed
 
-    if extension == None:
-        return targetFile  # to be passed into preupload_prep
-    else:  # change extension
-        return targetFile[2:-3] + extension
+
+def watchSeenSave(seenFile, seen):
+    '''
+    Saves watch_folder's record of files already processed. Written to a
+    .tmp file first so a crash mid write can't lose the record.
+    '''
+    os.makedirs(os.path.dirname(seenFile), exist_ok=True)
+    with open(seenFile + '.tmp', 'w') as f:
+        json.dump(seen, f, indent=1)
+    os.replace(seenFile + '.tmp', seenFile)
 
 
 def query_sf_custom(sfConn, soql_string, returnKey, purpose=None,
@@ -264,7 +823,8 @@ def query_sf_custom(sfConn, soql_string, returnKey, purpose=None,
 
 
 def query_salesforce(sfConn, sObject, sObjectField, array=None, wCard=None,
-                     purpose=None, switch=None, emailPackage=None):
+                     purpose=None, switch=None, emailPackage=None,
+                     concurrency=4):
     '''
     update 13 feb 2020 - this too needs to be modified. nope! all good! 
     update - 22 september - find out difference between bulk.query and normal
@@ -309,48 +869,45 @@ def query_salesforce(sfConn, sObject, sObjectField, array=None, wCard=None,
     function in 'tack_sfid' mode to find in the transformed SAP dump file the
     corresponding Email of each row, finding a match it will then tack on as
     last column the related SFID.
+
+    Every page of each result is read (see soql_records) - not just the
+    first 2000 records.
+
+    concurrency - 'Contact' mode runs up to this many of the IN list batches
+    from CSV_query at the same time, merging them into the one mapping.
     '''
 
     pairings = {}  # i am but a vessel
     bulk_del = []  # as am i
+    qString = None
+    stage = traceStart('query_salesforce.' + sObject)
 
     try:
         if sObject == 'Contact':
-            if type(array) == list:  # list_of_strs
-                while len(array) != 0:
-                    array_batch = array.pop()
-                    qString = "SELECT Id, {1} FROM {0} WHERE {1} IN ({2})".format(
-                        sObject, sObjectField, array_batch
-                    )
-                    query = sfConn.query(qString)  # < max_size of CSV_query
-
-                    size = query['totalSize']  # number of pairs returned
-
-                    for i in range(size):  # build it!
+            if type(array) == str:  # one batch
+                array = [array]
+            qStrings = ["SELECT Id, {1} FROM {0} WHERE {1} IN ({2})".format(
+                sObject, sObjectField, array_batch) for array_batch in array]
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                batches = [pool.submit(list, soql_records(sfConn, qString,
+                                                          stage=stage))
+                           for qString in qStrings]  # < max_size of CSV_query
+                for batch in as_completed(batches):  # build it!
+                    for record in batch.result():
                         if switch == True:
-                            pairings[query['records'][i]['Id']] = query[
-                                'records'][i][sObjectField]
-                        else:  # switch=None
-                            pairings[query['records'][i][sObjectField]] = query[
-                                'records'][i]['Id']  # e.g. {Email = 'SFID'}
-
-        elif sObject == 'Opportunity':  # 'mode' - update 07022020 need to cater
-          # for large queryset like 'contact' mode - not needed for the moment as
-          # there is never a need to query for opportunities
-            qString = "SELECT Id, {1}, FROM {0} WHERE {1} LIKE '{2}'".format(
+                            pairings[record['Id']] = record[sObjectField]
+                        else:  # switch=None e.g. {Email = 'SFID'}
+                            pairings[record[sObjectField]] = record['Id']
+
+        elif sObject == 'Opportunity':  # 'mode'
+            qString = "SELECT Id, {1} FROM {0} WHERE {1} LIKE '{2}'".format(
                 sObject, sObjectField, wCard
             )
-            query = sfConn.query(qString)
-
-            size = query['totalSize']
-
-            for i in range(size):
+            for record in soql_records(sfConn, qString, stage=stage):
                 if switch == True:
-                    pairings[query['records'][i]['Id']] = query[
-                        'records'][i][sObjectField]
-                else:  # switch=None
-                    pairings[query['records'][i][sObjectField]] = query[
-                        'records'][i]['Id']  # e.g. {Name = 'OpportunityId'}
+                    pairings[record['Id']] = record[sObjectField]
+                else:  # switch=None e.g. {Name = 'OpportunityId'}
+                    pairings[record[sObjectField]] = record['Id']
 
         if purpose == 'bulk_delete':  # return to be used for bulk delete
             for j in pairings:
@@ -360,39 +917,179 @@ def query_salesforce(sfConn, sObject, sObjectField, array=None, wCard=None,
             return pairings
     except Exception:
         if emailPackage:  # not None
-            emailalert.alerter(emailPackage, 'Error @ Point: Q')
+            emailalert.alerter(emailPackage, mode='err', to='prim',
+                               body='Error @ Point: Q')
         errorLog(p='Point: Q', source=sObject, qString=qString,
                  sObjectField=sObjectField, array=array, wCard=wCard,
-                 purpose=purpose, switch=switch, querySize=size,
-                 error=str(sys.exc_info()))
+                 purpose=purpose, switch=switch, error=str(sys.exc_info()))
+    finally:  # failed queries are timed too
+        traceEnd(stage, rows_in=len(array or []), rows_out=len(pairings))
 
 
-def looper(file, a_list):
+def soql_records(sfConn, qString, include_deleted=False, stage=None):
     '''
-    Writes contents of a Python list to a file.
+    Runs a SOQL query and yields its records one at a time, fetching the
+    next page (nextRecordsUrl) only when the previous page has been used up.
+    sfConn.query on its own only ever returns the first page.
+
+    include_deleted - True also returns deleted / archived records (queryAll)
+    e.g. for keeping a local copy in step with Salesforce.
+
+    stage - run_trace stage to count the calls made against.
+    '''
+    if include_deleted:
+        page = sfConn.query(qString, include_deleted=True)
+    else:
+        page = sfConn.query(qString)
+    while True:
+        if stage != None:
+            with runTraceLock:  # batches run on threads
+                stage['api_calls'] += 1
+        for record in page['records']:
+            yield record
+        if page['done']:
+            break
+        page = sfConn.query_more(page['nextRecordsUrl'],
+                                 identifier_is_url=True)
+
+
+# Local Contact Id index - see sfid_index
+sfidIndexFile = os.path.join('.', 'state', 'sfid_index.json')
+sfidIndexFields = ['Email', 'LINKS_CUSTID__c']
+
+
+def sfid_index(mode, sfConn=None, field='Email', indexFile=None,
+               emailPackage=None):
+    '''
+    Local copy of Contact Id against Email and LINKS_CUSTID__c (see
+    sfidIndexFields), so 'tack_sfid' doesn't need every email re-queried
+    from Salesforce on every run. E.g. car park, after the Contact upsert:
+
+    mapping = sfid_index('sync', sf)
+    tx = transformCSV('tack_sfid', f, mapping=mapping)
+
+    Mode: 'sync' - brings the index up to date by querying only Contacts
+    whose SystemModstamp is at or after the last sync (all of them the first
+    time), including deleted ones which are dropped from the index. Then
+    returns the mapping as per 'load'.
+
+    Mode: 'load' - returns the mapping from the index as it is on disk,
+    no Salesforce calls. {value of field: Id} e.g. {'a@b.com': '0035D...'}
+    Emails are lower case, as 'tack_sfid' looks them up.
+
+    'field' - one of sfidIndexFields, the key of the mapping returned.
+
+    'indexFile' - defaults to sfidIndexFile.
+    '''
+    indexFile = indexFile or sfidIndexFile
+    try:
+        with open(indexFile) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        index = {'synced': None, 'records': {}}  # records - Id: [fields]
+
+    try:
+        if mode == 'sync':
+            qString = 'SELECT Id, IsDeleted, SystemModstamp, ' + \
+                ', '.join(sfidIndexFields) + ' FROM Contact'
+            if index['synced'] != None:  # only what changed since
+                qString += ' WHERE SystemModstamp >= ' + index['synced']
+            for record in soql_records(sfConn, qString, include_deleted=True):
+                if record['IsDeleted']:
+                    index['records'].pop(record['Id'], None)
+                else:
+                    index['records'][record['Id']] = [
+                        record[i] for i in sfidIndexFields]
+                stamp = record['SystemModstamp'][:19] + 'Z'  # UTC, to secs
+                if index['synced'] == None or stamp > index['synced']:
+                    index['synced'] = stamp
+            os.makedirs(os.path.dirname(indexFile), exist_ok=True)
+            with open(indexFile + '.tmp', 'w') as f:
+                json.dump(index, f)
+            os.replace(indexFile + '.tmp', indexFile)
+    except Exception:
+        if emailPackage:  # not None
+            emailalert.alerter(emailPackage, mode='err', to='prim',
+                               body='Error @ Point: AB')
+        errorLog(p='Point: AB', mode=mode, indexFile=indexFile,
+                 synced=index['synced'], error=str(sys.exc_info()))
+
+    col = sfidIndexFields.index(field)
+    mapping = {}
+    for sfid in index['records']:
+        value = index['records'][sfid][col]
+        if value != None:
+            mapping[value.lower() if field == 'Email' else value] = sfid
+    return mapping
+
+
+def looper(file, a_list, strip=True):
+    '''
+    Writes contents of a Python list to a file as one CSV row.
 
     Takes two args. 'file' arg takes an open file in 'w' mode. Whereas 'a_list'
     arg takes a Python list.
 
-    Loop will pop first item in the list and write it to file, until no more
-    left to pop.
+    Each item is stripped of white space (unless strip is False) and written
+    comma delimited. Items with a comma or double quote in them (e.g. Links
+    addresses) are quoted so readCSV reads them back as one column.
 
     Nothing to return. Used only in conjunction the various modes of
     transformCSV function.
     '''
-    while len(a_list) != 0:
-        file.write(str(a_list.pop(0)).strip())  # white spaces
-        if len(a_list) == 0:
-            file.write('\n')
-            break
+    if len(a_list) != 0:
+        if strip:
+            file.write(','.join([quoteField(str(i).strip()) for i in a_list]))
         else:
-            file.write(',')
+            file.write(','.join([quoteField(str(i)) for i in a_list]))
+        file.write('\n')
+
+
+def quoteField(field):
+    '''
+    CSV quotes a field if needed i.e. 'a "b", c' becomes '"a ""b"", c"'.
+    Fields with a line break in them (readCSV reads quoted multi line
+    fields) are quoted too, otherwise they'd be read back as two rows.
+    '''
+    if ',' in field or '"' in field or '\n' in field or '\r' in field:
+        return '"' + field.replace('"', '""') + '"'
+    return field
+
+
+def readCSV(CSV, header=False):
+    '''
+    Shared CSV reader - used by every function that reads a CSV file in place
+    of row.split(','), which shifts every column along whenever a quoted field
+    has a comma in it e.g. "12, Smith St" in a Links address. Built on the
+    csv module (C parser) so quoted commas and quotes are handled.
+
+    'CSV' - file object, opened with newline=''.
+
+    'header' - True if the first row holds column names. It is then not
+    yielded as a row.
+
+    Returns a list of two items: [schema, rows]. schema is worked out once,
+    from the first row: {'header': [names] or None, 'colLength': n}. rows is
+    an iterator of tuples, one per row. Rows with a different number of
+    columns to schema['colLength'] are still yielded as is - it is up to the
+    caller (e.g. 'purge' mode of transformCSV) what to do with them.
+    '''
+    reader = csv.reader(CSV)
+    first = next(reader, None)
+    if first == None:  # empty file
+        return [{'header': None, 'colLength': 0}, iter(())]
+    schema = {'header': None, 'colLength': len(first)}
+    if header:
+        schema['header'] = first
+        return [schema, map(tuple, reader)]
+    return [schema, map(tuple, itertools.chain([first], reader))]
 
 
 def transformCSV(mode, inFile, col=None, origTrue=None, origFalse=None,
                  newTrue=None, newFalse=None, fromX=None, toY=None, match=None,
                  mapping=None, source=None, target=None, user=None, pw=None,
-                 emailPackage=None, colLength=None, purgeUniqueId=None):
+                 emailPackage=None, colLength=None, purgeUniqueId=None,
+                 how=None, rightKey=0, dateCol=None, memLimit=500000):
     '''
     Function takes text/csv file passed through inFile arg, then transforms
     the file as per the selected mode, saving a new text/csv file with an
@@ -400,6 +1097,13 @@ def transformCSV(mode, inFile, col=None, origTrue=None, origFalse=None,
     the newly generated text/csv file's name as a string to be used in further
     transformations etc.
 
+    Each call reads and writes the whole file once for one mode. To run
+    several modes over the file in a single pass use transformPipeline.
+
+    Rows that raise are written to a dead letter CSV next to the new file
+    (see deadLetterRow) and counted by run_errors - one summary email at the
+    end of the run rather than one per row.
+
     All modes except 'remove_header' require passing of args: mode (obviously)
     & inFile in addition to specific args based on mode selected.
 
@@ -427,6 +1131,9 @@ def transformCSV(mode, inFile, col=None, origTrue=None, origFalse=None,
     'tack_sfid' - adds SFID as last column in CSV file - this function & mode
     to be used after calling query_salesforce. Requires arg: mapping - return
     value from query_salesforce i.e. a dictionary of email keys to SFID values.
+    Optional arg: match - index of the email column. When given only that
+    column is looked up (one hash lookup per row). Otherwise every field of
+    the row is tried against mapping.
 
     Assumption of 'tack_sfid' mode is that all emails will have corresponding
     SFID on the Contact records on Salesforce. Hence this mode is only run
@@ -497,19 +1204,23 @@ def transformCSV(mode, inFile, col=None, origTrue=None, origFalse=None,
     CSV file. 
 
     'de_dupe_remove_old_dates' - used primarily with Links extracts, in
-    particular health club. Takes 3 args. 'col' - specify the column to check
-    for identical values e.g. index of LinksID column. 'target' - specify the
-    column to check for date values e.g. index of Date Started column. Logic as
-    follows: 
-    1. checks 'col' for duplicates. Duplicate values are inserted into dupes 
-    list for further processing. Non duplicate rows are inserted into dedupes
-    dict.
-    2. with dupes collection, check the date value as per column index
-    identified by 'target' arg. Remove from the dupes collection all duplicates
-    except for the row with most recent date in 'target' column.
-
-    Update - 9 March 2020 - no longer used / needed due to SQL query being
-    modified to return non duplicate LinksIDs.
+    particular health club. Keeps one row per value in 'col' (e.g. index of
+    CustomerId column) - the row with the most recent date in 'dateCol'
+    (e.g. index of CurrentExpiryDate column). If dates are equal the first
+    row read wins. Dates can be yyyy-mm-dd (with or without time), yyyymmdd,
+    dd/mm/yyyy or dd.mm.yyyy - see dateKey. Blank dates lose to any date.
+
+    Only the newest row per key is held in memory. Once more than 'memLimit'
+    keys are held they are written out, sorted by key, as a run file under
+    spillDir and memory starts again. At the end the runs are merged back
+    (heapq.merge, one row per run in memory at a time) and the newest row per
+    key written out. So multi-year exports are de-duplicated in bounded
+    memory. Output is in key order if anything was spilled, otherwise in the
+    order the keys were first read. Required args: col, dateCol - ValueError
+    up front without them. Optional:
+    memLimit - default 500000 keys.
+
+    E.g. tx = transformCSV('de_dupe_remove_old_dates', f, col=0, dateCol=5)
 
     'remove_row_based_on_val' - removes entire rows based on matching value
     as passed in via 'col' and 'match'. The later identifies what value to look
@@ -533,16 +1244,23 @@ def transformCSV(mode, inFile, col=None, origTrue=None, origFalse=None,
     row_errors list will be then be emailed to helpdesk for fixing / notifying
     venues to edit the data accordingly on Links. Required args:
 
+    Update - rows are now read with readCSV, so commas inside a quoted
+    address no longer shift columns and such rows load as normal. 'purge'
+    only catches rows that still have the wrong number of columns.
+
     purgeUniqueId - integer val indicating index of column that will be added
     as value to row_errors list e.g. LinksID or email address column.
 
     colLength - integer val indicating the number of rows each row is meant to
     have. Anything deviating from it, it's purgeUniqueId index value of the row
-    will be added to row_errors.
+    will be added to row_errors. Defaults to the number of columns of the
+    file's first row (schema['colLength'] of readCSV) - pass it when the
+    first row may itself be dirty.
 
-    'join_dict_to_csv' - emulates a left join. Given input of CSV file, and
+    'join_dict_to_csv' - emulates a join. Given input of CSV file, and
     a dictionary of key to value mappings - will tack on the dictionary to the
-    CSV and spit out new file. Required args:
+    CSV and spit out new file. Rows with no match are dropped (inner join)
+    unless how arg says otherwise - see 'hash_join'. Required args:
 
     mapping - the dictionary that has key to value mapping. Key being the
     primary key that will be used to 'join' to a specific column in the CSV.
@@ -552,155 +1270,486 @@ def transformCSV(mode, inFile, col=None, origTrue=None, origFalse=None,
     be matched to the 'Key' of the mapping arg.
 
     col - integer index value to be tacked onto the CSV file from the
-    dictionary value as identified by mapping arg. Note 'join_dict_to_csv' will
-    only ever tack on one value / field / column per iteration through the
-    function. As such multiple values to be 'joined' will need to be rerun with
-    different col value set.
+    dictionary value as identified by mapping arg. Or a list of them - all
+    are tacked on in the one pass, in the order given.
 
     E.g. tx = transformCSV(mode='join_dict_to_csv', inFile=raw_data[0],
-                            mapping=sqlq, match=0, col=1)
+                            mapping=sqlq, match=0, col=[1, 0])
     # sqlq = {20000001: [20017922, datetime.datetime(2020, 2, 13, 11, 22, 23)]
     # match = index of LinksID in CSV file
-    # col = index of val to pull from key to value mapping as per sqlq
+    # col = index of val(s) to pull from key to value mapping as per sqlq
+
+    'hash_join' - same as 'join_dict_to_csv' but the right hand side can
+    also be another staged CSV file, and the join type is picked. A hash
+    index of the right hand side is built once (see joinIndex), then each
+    row is one lookup. Keys are compared as stripped, lower case strings, so
+    ' A@B.com' matches 'a@b.com' and 20000001 matches '20000001'. Args:
+
+    mapping - dictionary of key to list of values, or name of a CSV file in
+    staging. For a CSV file the values are the whole row.
+
+    rightKey - for a CSV mapping, index of its key column. Default 0.
+
+    match - index of the key column in inFile.
+
+    col - integer or list of integer indexes into the right hand values to
+    tack on to the end of each row.
+
+    how - 'inner' (default) drops rows with no match. 'left' keeps them with
+    '' for each col. 'anti' keeps only the rows with no match and tacks on
+    nothing, e.g. emails not yet on Salesforce.
+
+    E.g. tx = transformCSV('hash_join', f, mapping='links_extract.csv',
+                           rightKey=0, match=3, col=[2, 5, 6], how='left')
     '''
+    transformCheck(mode, col=col, dateCol=dateCol)
     randomAppend = str(random.randint(0, 99999))  # used as postfix.
+    stage = traceStart('transformCSV.' + mode)
+    rowsIn, rowsOut, rowsError = 0, 0, 0
 
-    mapSourceDestination('map_staging', target=target, user=user, pw=pw)
+    stageBegin(target, user, pw)
 
-    dedupes = dict()
-    dupes = list()  # required for mode: de_dupe_split
-    row_errors = set()  # collection of LinksIDs / identifier for helpdesk
+    state = dict()  # carried between rows - see transformRow
+    dead = dict()  # dead letter file, opened on the first bad row
 
+    outFileName = inFile[:-4] + '_' + randomAppend + '.csv'  # just name
     try:  # need to close at the end
-        tempfile = open('Q:' + inFile[:-4] + '_' + randomAppend + '.csv', 'w')
-        outFileName = inFile[:-4] + '_' + randomAppend + '.csv'  # just name
+        tempfile = stageOpen(outFileName, 'w')
     except Exception:
         if emailPackage:  # not None
             emailalert.alerter(emailPackage, mode='err', to='prim',
                                body='Error @ Point: E')
         errorLog(p='Point: E', mode=mode, error=str(sys.exc_info()))
-    with open('Q:' + inFile) as CSV:
-        if mode == 'remove_header':
-            CSV.readline()  # read header row - doesn't write to new file!
-        elif mode == 'tack_date_based_on_condition':  # calc the date
-            ddDate = str(
-                dt.today().replace(year=dt.today().year + mapping).date()
-            )
-        for row in CSV:
+        tempfile = None
+    try:
+        with stageOpen(inFile, newline='') as CSV:
+            schema, rows = readCSV(CSV)
+            if mode == 'purge' and colLength == None:
+                colLength = schema['colLength']
+            for row in rows:
+                rowsIn += 1
+                try:
+                    split = list(row)
+                    split = transformRow(
+                        mode, split, state, col=col, origTrue=origTrue,
+                        origFalse=origFalse, newTrue=newTrue,
+                        newFalse=newFalse, fromX=fromX, toY=toY,
+                        match=match, mapping=mapping, colLength=colLength,
+                        purgeUniqueId=purgeUniqueId, how=how,
+                        rightKey=rightKey, dateCol=dateCol,
+                        memLimit=memLimit)
+                    if split != None:  # None - row dropped or held back
+                        looper(tempfile, split, mode not in rawModes)
+                        rowsOut += 1
+                except Exception:  # one bad row - see run_errors
+                    rowsError += 1
+                    run_errors('add', p='Point: F', error=sys.exc_info(),
+                               row=row, deadLetter=deadLetterRow(
+                                   dead, outFileName, row, sys.exc_info()),
+                               emailPackage=emailPackage, transform=mode,
+                               inFile=inFile, col=col)
+        for split in transformFlush(mode, state):  # e.g. 'de-duplicate'
             try:
-                split = row.split(',')
-                if mode == 'purge':  # specifically for Links dirty data
-                    if len(split) != colLength:  # multiple commas inside""
-                        row_errors.add(split[purgeUniqueId])  # add to list
-                        continue  # skip writing it to file - not needed :|
-                    else:
-                        tempfile.write(row)
-                elif mode == 'boolify':
-                    if split[col] == origTrue:
-                        split[col] = newTrue  # originally (newTrue)
-                    elif split[col] == origFalse:
-                        split[col] = newFalse  # originally (newFalse)
-                    looper(tempfile, split)
-                elif mode == 'remove_header':
-                    tempfile.write(row)
-                elif mode == 'swap_columns':
-                    split[fromX], split[toY] = split[toY], split[fromX]
-                    looper(tempfile, split)
-                elif mode == 'delete_column':
-                    split.pop(col)
-                    looper(tempfile, split)
-                elif mode == 'de-duplicate':
-                    dedupes[split[col]] = split  # one row, dedupes['x@y.com']
-                elif mode == 'tack_sfid':
-                    sfid = ''
-                    for field in split:  # add onto split list
-                        # email in {'a@b.com': 'SF91941'}
-                        if field.lower() in mapping:
-                            sfid = mapping[field.lower()]
-                            break
-                    split.append(sfid)
-                    for i in split:  # commit to file update 10 mar 2020 - i think this can be put into looper? looks like it'll work
-                        tempfile.write(str(i).strip() + ',')
-                    tempfile.write('\n')
-                elif mode == 'tack_date_based_on_condition':  # used primarily for null/'' expiry dates for memberships
-                    if split[col] in match:  # no date
-                        split.append(ddDate)
-                    else:  # has expiry date
-                        split.append(split[col])
-                    looper(tempfile, split)
-                elif mode == 'yyyymmdd_to_yyyy-mm-dd':
-                    for i in col:
-                        if split[i] != '':  # always a chance there's no date!
-                            ph = split[i]  # placeholder
-                            split[i] = ph[:4] + '-' + ph[4:6] + '-' + ph[6:]
-                    looper(tempfile, split)
-                elif mode == 'concat_n_tack':
-                    container = col[:]  # make a copy!
-                    new_col = ''
-                    while len(container) != 0:  # concatenate as per col index
-                        item = container.pop(0)
-                        if type(item) == str:
-                            new_col += item + ' '
-                        else:  # column indexes (int)
-                            new_col += split[item] + ' '  # space
-                    split.append(new_col)
-                    looper(tempfile, split)
-                elif mode == 'tack_custom_val':
-                    split.append(mapping)  # 4 march 2020 - may break parking?
-                    looper(tempfile, split)
-                elif mode == 'convert_time':  # todo: cater for multiple col(s)
-                    split[col] = hhmmss_to_secs(split[col])
-                    looper(tempfile, split)
-                elif mode == 'remove_missing_cols':
-                    ph = [i.strip() for i in split]  # ph placeholder
-                    ph = [i for i in ph if i != '']
-                    looper(tempfile, ph)
-                elif mode == 'remove_row_based_on_val':
-                    if split[col].strip() != match:  # caters for '\n', ' ' & ''
-                        tempfile.write(row)
-                    else:  # dirty data email!
-                        row_errors.add(split[mapping])
-                elif mode == 'strip_time':
-                    for i in col:
-                        if split[i] != '':
-                            split[i] = str(dt.strptime(
-                                split[i], "%Y-%m-%d %H:%M:%S").date()
-                            )
-                    looper(tempfile, split)
-                elif mode == 'de_dupe_remove_old_dates':
-                    ...  # to be fleshed out for health club nightly
-                elif mode == 'join_dict_to_csv':  # use in conjunction with loop_n_load of pull_SQL_data function
-                    if split[match] in mapping:
-                        split.append(str(mapping[split[match]][col]))
-                        looper(tempfile, split)
+                looper(tempfile, split)
+                rowsOut += 1
             except Exception:
-                if emailPackage:  # not None
-                    emailalert.alerter(emailPackage, mode='err', to='prim',
-                                       body='Error @ Point: F')
-                errorLog(p='Point: F', mode=mode, inFile=inFile, col=col,
-                         origTrue=origTrue, origFalse=origFalse,
-                         newTrue=newTrue, newFalse=newFalse, fromX=fromX,
-                         toY=toY, outFileName=outFileName, row=row,
-                         split=split, error=str(sys.exc_info()))
+                rowsError += 1
+                run_errors('add', p='Point: G', error=sys.exc_info(),
+                           row=split, deadLetter=deadLetterRow(
+                               dead, outFileName, split, sys.exc_info()),
+                           emailPackage=emailPackage, transform=mode,
+                           inFile=inFile, col=col)
+    finally:  # closed and traced even when the file couldn't be read
+        if tempfile != None:
+            tempfile.close()  # memory backend only saves on close
+        if 'file' in dead:
+            dead['file'].close()
+        spillRemove(state)  # only left if it failed part way
+        traceEnd(stage, rows_in=rowsIn, rows_out=rowsOut,
+                 rows_error=rowsError, bytes_in=stageSize(inFile),
+                 bytes_out=stageSize(outFileName))
+    stageEnd()  # first map destination drive
+
+    rowErrorsAlert(state.get('row_errors', set()), emailPackage)
+    return outFileName
+
+
+# Modes that write rows as they were read - the rest write through looper,
+# which strips every field. See stepRow.
+rawModes = ('purge', 'remove_header', 'remove_row_based_on_val')
+
+
+def transformRow(mode, split, state, col=None, origTrue=None, origFalse=None,
+                 newTrue=None, newFalse=None, fromX=None, toY=None, match=None,
+                 mapping=None, colLength=None, purgeUniqueId=None, how=None,
+                 rightKey=0, dateCol=None, memLimit=500000):
+    '''
+    Applies one transformCSV mode to one row and returns the transformed row
+    (a list of column values). Returns None if the row is not to be written,
+    i.e. header row, purged or removed rows, or rows held back by
+    'de-duplicate' / 'de_dupe_remove_old_dates' until transformFlush is
+    called.
+
+    'split' - the row as a list of column values.
+
+    'state' - dictionary that lives for one mode over one file. Holds what
+    needs carrying from row to row e.g. row_errors, dedupes, header. Pass in
+    an empty dict at the start of each file. After the last row
+    state['row_errors'] (if present) holds the set used for the dirty data
+    email.
+
+    All other args are as per the modes of transformCSV. Called by both
+    transformCSV and transformPipeline so each mode only lives in one place.
+    '''
+    row_errors = state.setdefault('row_errors', set())  # for helpdesk
+
+    if mode == 'purge':  # specifically for Links dirty data
+        if len(split) != colLength:  # multiple commas inside""
+            row_errors.add(split[purgeUniqueId])  # add to list
+            return None  # skip writing it to file - not needed :|
+    elif mode == 'boolify':
+        if split[col] == origTrue:
+            split[col] = newTrue  # originally (newTrue)
+        elif split[col] == origFalse:
+            split[col] = newFalse  # originally (newFalse)
+    elif mode == 'remove_header':
+        if 'header' not in state:  # first row - don't write to new file!
+            state['header'] = split
+            return None
+    elif mode == 'swap_columns':
+        split[fromX], split[toY] = split[toY], split[fromX]
+    elif mode == 'delete_column':
+        split.pop(col)
+    elif mode == 'de-duplicate':
+        # one row, dedupes['x@y.com'] - written out by transformFlush
+        state.setdefault('dedupes', dict())[split[col]] = split
+        return None
+    elif mode == 'tack_sfid':
+        sfid = ''
+        if match != None:  # only the email column
+            if 'index' not in state:  # built once per file
+                state['index'] = joinIndex(mapping)
+            sfid = state['index'].get(normKey(split[match]), '')
+        else:
+            for field in split:  # add onto split list
+                # email in {'a@b.com': 'SF91941'}
+                if field.lower() in mapping:
+                    sfid = mapping[field.lower()]
+                    break
+        split.append(sfid)
+    elif mode == 'tack_date_based_on_condition':  # used primarily for null/'' expiry dates for memberships
+        if 'ddDate' not in state:  # calc the date once per file
+            state['ddDate'] = str(
+                dt.today().replace(year=dt.today().year + mapping).date()
+            )
+        if split[col] in match:  # no date
+            split.append(state['ddDate'])
+        else:  # has expiry date
+            split.append(split[col])
+    elif mode == 'yyyymmdd_to_yyyy-mm-dd':
+        for i in col:
+            if split[i] != '':  # always a chance there's no date!
+                ph = split[i]  # placeholder
+                split[i] = ph[:4] + '-' + ph[4:6] + '-' + ph[6:]
+    elif mode == 'concat_n_tack':
+        container = col[:]  # make a copy!
+        new_col = ''
+        while len(container) != 0:  # concatenate as per col index
+            item = container.pop(0)
+            if type(item) == str:
+                new_col += item + ' '
+            else:  # column indexes (int)
+                new_col += split[item] + ' '  # space
+        split.append(new_col)
+    elif mode == 'tack_custom_val':
+        split.append(mapping)  # 4 march 2020 - may break parking?
+    elif mode == 'convert_time':  # todo: cater for multiple col(s)
+        split[col] = hhmmss_to_secs(split[col])
+    elif mode == 'remove_missing_cols':
+        split = [i.strip() for i in split]
+        split = [i for i in split if i != '']
+    elif mode == 'remove_row_based_on_val':
+        if split[col].strip() == match:  # caters for '\n', ' ' & ''
+            row_errors.add(split[mapping])  # dirty data email!
+            return None
+    elif mode == 'strip_time':
+        for i in col:
+            if split[i] != '':
+                split[i] = str(dt.strptime(
+                    split[i], "%Y-%m-%d %H:%M:%S").date()
+                )
+    elif mode == 'de_dupe_remove_old_dates':
+        # newest row per key, latest['20000001'] = (date, row)
+        latest = state.setdefault('latest', dict())
+        if 'col' not in state:  # for transformFlush
+            state['col'], state['dateCol'] = col, dateCol
+        key = split[col].strip()
+        held = latest.get(key)
+        date = dateKey(split[dateCol])
+        if held == None or date > held[0]:
+            latest[key] = (date, split)
+            if len(latest) > memLimit:  # over budget - spill to disk
+                spillRun(state)
+        return None
+    elif mode == 'join_dict_to_csv' or mode == 'hash_join':  # use in conjunction with loop_n_load of pull_SQL_data function
+        if 'index' not in state:  # built once per file
+            state['index'] = joinIndex(mapping, rightKey)
+        right = state['index'].get(normKey(split[match]))
+        cols = [col] if type(col) == int else col
+        if how == 'anti':
+            return split if right == None else None
+        elif right != None:
+            split.extend(['' if right[i] == None else str(right[i])
+                          for i in cols])
+        elif how == 'left':
+            split.extend([''] * len(cols))
+        else:  # inner
+            return None
+    return split
+
+
+def normKey(key):
+    '''
+    Join key as compared by joinIndex lookups - stripped, lower case string.
+    '''
+    return str(key).strip().lower()
+
+
+def joinIndex(right, rightKey=0):
+    '''
+    Builds the hash index for the join modes of transformCSV / transformRow
+    and transformCollection, once per file. right is either a dictionary of
+    key to values, or the name of a CSV file in staging - indexed on its
+    rightKey column with the whole row as values. Keys go through normKey.
+    Last one wins for a repeated key.
+    '''
+    if type(right) == str:  # staged CSV
+        with stageOpen(right, newline='') as CSV:
+            return {normKey(row[rightKey]): row for row in readCSV(CSV)[1]}
+    return {normKey(key): right[key] for key in right}
+
+
+def transformFlush(mode, state):
+    '''
+    Yields the rows held back by transformRow until the whole file has been
+    read, e.g. the rows kept by 'de-duplicate'. Modes that don't hold rows
+    back yield nothing. Call once after the last row of the file.
+    '''
     if mode == 'de-duplicate':
-        for i in dedupes:
-            try:
-                templist = dedupes[i]
-                while len(templist) != 1:
-                    tempfile.write(str(templist.pop(0)).strip() + ',')
-                tempfile.write(str(templist.pop()).strip() + '\n')
-            except Exception:
-                if emailPackage:  # not None
-                    emailalert.alerter(emailPackage, mode='err', to='prim',
-                                       body='Error @ Point: G')
-                errorLog(p='Point: G', mode=mode, inFile=inFile, col=col,
-                         outFileName=outFileName, error=str(sys.exc_info()))
+        for i in state.get('dedupes', dict()):
+            yield state['dedupes'][i]
     elif mode == 'de_dupe_remove_old_dates':
-        ...  # to be fleshed out for health club nightly
+        latest = state.get('latest', dict())
+        if len(state.get('runs', [])) == 0:  # all fitted in memory
+            for key in latest:
+                yield latest[key][1]
+            return
+        col, dateCol = state['col'], state['dateCol']
+        files = [open(path, newline='') for path in state['runs']]
+        try:
+            runs = [readCSV(f)[1] for f in files]  # each sorted by key
+            runs.append(latest[key][1] for key in sorted(latest))
+            merged = heapq.merge(*runs, key=lambda row: row[col].strip())
+            for key, group in itertools.groupby(
+                    merged, key=lambda row: row[col].strip()):
+                best = next(group)  # earlier run first - first read wins
+                for row in group:
+                    if dateKey(row[dateCol]) > dateKey(best[dateCol]):
+                        best = row
+                yield list(best)
+        finally:
+            for f in files:
+                f.close()
+            spillRemove(state)
+
+
+def transformCheck(mode, col=None, dateCol=None, **args):
+    '''
+    Raises ValueError for a mode missing an arg that every row needs, before
+    any row is read - rather than a TypeError logged for each row.
+    '''
+    if mode == 'de_dupe_remove_old_dates' and (col == None or dateCol == None):
+        raise ValueError('de_dupe_remove_old_dates needs col and dateCol')
+
+
+spillDir = os.path.join('.', 'spill')  # sorted runs of de_dupe_remove_old_dates
+
+
+def spillRun(state):
+    '''
+    Writes the rows held in state['latest'] by 'de_dupe_remove_old_dates' to
+    a new run file under spillDir, sorted by key, and empties it. Run file
+    names are added to state['runs'] for transformFlush to merge.
+    '''
+    os.makedirs(spillDir, exist_ok=True)
+    path = os.path.join(spillDir, 'run_' + str(os.getpid()) + '_' +
+                        str(random.randint(0, 99999)) + '_' +
+                        str(len(state.get('runs', []))) + '.csv')
+    latest = state['latest']
+    state.setdefault('runs', []).append(path)  # see spillRemove
+    with open(path, 'w', newline='') as run:
+        for key in sorted(latest):
+            looper(run, latest[key][1], False)  # read back as held
+    latest.clear()
+
+
+def spillRemove(state):
+    '''
+    Deletes the run files spillRun wrote for state, if any are left - e.g.
+    the file failed part way through, before transformFlush merged them.
+    '''
+    for path in state.get('runs', []):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    state['runs'] = []
+
 
-    tempfile.close()
-    mapSourceDestination('unmap_staging')  # first map destination drive
+def dateKey(value):
+    '''
+    Date string as a sortable string for 'de_dupe_remove_old_dates', i.e.
+    '20200313', '13/03/2020' and '13.03.2020' all become '2020-03-13'.
+    yyyy-mm-dd (hh:mm:ss) is already sortable and returned as is. Blank
+    sorts before any date.
+    '''
+    value = value.strip()
+    if len(value) == 8 and value.isdigit():  # SAP yyyymmdd
+        return value[:4] + '-' + value[4:6] + '-' + value[6:]
+    if len(value) >= 10 and value[2] in './' and value[5] == value[2]:
+        return value[6:10] + '-' + value[3:5] + '-' + value[:2] + value[10:]
+    return value
+
+
+def transformPipeline(steps, inFile, source=None, target=None, user=None,
+                      pw=None, emailPackage=None):
+    '''
+    Fused version of transformCSV. Takes an ordered list of steps and runs
+    all of them over each row in one pass - inFile is read once and one new
+    file is written, instead of a read, a write and a map/unmap of staging
+    for every transformCSV call. Returns the newly generated file's name as a
+    string, same as transformCSV.
+
+    'steps' - list of (mode, args) tuples. mode is any transformCSV mode and
+    args is a dictionary of the args that mode needs, e.g. car park:
+
+    transformPipeline([
+        ('remove_header', {}),
+        ('yyyymmdd_to_yyyy-mm-dd', {'col': (0, 10)}),
+        ('convert_time', {'col': 11}),
+        ('concat_n_tack', {'col': ['PK', 8, 0]}),
+        ('tack_custom_val', {'mapping': '0127F000001HyMzQAK'}),
+        ('tack_sfid', {'mapping': email_to_sfid})
+    ], f)
+
+    Column indexes of each step refer to the row as it is when it reaches
+    that step, i.e. after columns tacked on or deleted by the steps before it.
+    Exactly the same as chaining transformCSV calls.
+
+    'de-duplicate' holds rows back until the whole file has been read. The
+    rows it keeps then carry on through the steps after it.
+
+    Rows that raise go to a dead letter CSV and run_errors, as transformCSV.
+
+    Args 'source', 'target', 'user', 'pw' - for mapSourceDestination.
+    '''
+    for mode, args in steps:
+        transformCheck(mode, **args)
+    randomAppend = str(random.randint(0, 99999))  # used as postfix.
+    outFileName = inFile[:-4] + '_' + randomAppend + '.csv'  # just name
+    states = [dict() for i in steps]  # one per step, see transformRow
+    dead = dict()  # dead letter file, opened on the first bad row
+    stage = traceStart('transformPipeline')
+    rowsIn, rowsOut, rowsError = 0, 0, 0
+
+    stageBegin(target, user, pw)
+
+    try:
+        with stageOpen(inFile, newline='') as CSV, \
+                stageOpen(outFileName, 'w') as tempfile:
+            schema, rows = readCSV(CSV)
+            steps = [(mode, dict({'colLength': schema['colLength']}, **args))
+                     if mode == 'purge' and args.get('colLength') == None
+                     else (mode, args) for mode, args in steps]  # see purge
+            for row in rows:
+                rowsIn += 1
+                try:
+                    split = pipelineRow(steps, states, list(row), 0)
+                    if split != None:  # None - row dropped or held back
+                        looper(tempfile, split, False)  # see stepRow
+                        rowsOut += 1
+                except Exception:  # one bad row - see run_errors
+                    rowsError += 1
+                    run_errors('add', p='Point: U', error=sys.exc_info(),
+                               row=row, deadLetter=deadLetterRow(
+                                   dead, outFileName, row, sys.exc_info()),
+                               emailPackage=emailPackage, inFile=inFile)
+            for i in range(len(steps)):  # held back rows, in step order
+                for split in transformFlush(steps[i][0], states[i]):
+                    try:
+                        split = pipelineRow(steps, states,
+                                            stepRow(steps[i][0], split), i + 1)
+                        if split != None:
+                            looper(tempfile, split, False)
+                            rowsOut += 1
+                    except Exception:
+                        rowsError += 1
+                        run_errors('add', p='Point: V',
+                                   error=sys.exc_info(), row=split,
+                                   deadLetter=deadLetterRow(
+                                       dead, outFileName, split,
+                                       sys.exc_info()),
+                                   emailPackage=emailPackage, inFile=inFile,
+                                   step=steps[i][0])
+
+        if 'file' in dead:
+            dead['file'].close()
+    finally:  # traced even when the file couldn't be read
+        for state in states:
+            spillRemove(state)  # only left if it failed part way
+        traceEnd(stage, rows_in=rowsIn, rows_out=rowsOut,
+                 rows_error=rowsError, bytes_in=stageSize(inFile),
+                 bytes_out=stageSize(outFileName))
+    stageEnd()
+
+    row_errors = set()
+    for state in states:
+        row_errors.update(state.get('row_errors', set()))
+    rowErrorsAlert(row_errors, emailPackage)
+    return outFileName
+
+
+def pipelineRow(steps, states, split, start):
+    '''
+    Runs one row through steps[start:] of transformPipeline. Returns the
+    transformed row or None as soon as a step drops or holds back the row.
+    '''
+    for i in range(start, len(steps)):
+        mode, args = steps[i]
+        split = transformRow(mode, split, states[i], **args)
+        if split == None:
+            break
+        split = stepRow(mode, split)
+    return split
 
+
+def stepRow(mode, split):
+    '''
+    The row as the next step would read it back, had mode been run by
+    transformCSV - fields stripped and made strings as looper writes them,
+    or untouched for rawModes. Keeps transformPipeline the same as chained
+    transformCSV calls.
+    '''
+    if mode in rawModes:
+        return split
+    return [str(i).strip() for i in split]
+
+
+def rowErrorsAlert(row_errors, emailPackage=None):
+    '''
+    Emails helpdesk the identifiers of rows skipped due to dirty data e.g.
+    'purge' and 'remove_row_based_on_val' modes of transformCSV.
+    '''
     if len(row_errors) != 0:  # some rows with mangled data!
         if emailPackage:  # not None
             row_errors = list(row_errors)
@@ -711,11 +1760,24 @@ def transformCSV(mode, inFile, col=None, origTrue=None, origFalse=None,
                                        i) + '\n' for i in row_errors if i not in ['"', "'"]]
                                )
                                )
-    return outFileName
+
+
+# Salesforce per record error codes worth retrying - anything else (e.g.
+# INVALID_EMAIL_ADDRESS) fails the same way every time. CHUNK_EXCEPTION is
+# set by chunk_n_upload when a whole bulk job raised e.g. timed out, or
+# came back without a result for the record. The records may well be on
+# Salesforce already, so it is only retried for upserts - see retryable.
+retryableErrors = ('UNABLE_TO_LOCK_ROW', 'REQUEST_RUNNING_TOO_LONG',
+                   'SERVER_UNAVAILABLE')
+# API calls a simple_salesforce bulk job makes at the least - create job,
+# add batch, close job, one status poll, get results. Longer jobs poll more,
+# which isn't seen from here, so run_trace api_calls is a lower bound.
+bulkJobCalls = 5
 
 
 def chunk_n_upload(mode, chunk_size, package, sfConnection,
-                   primaryIDentifier=None, emailPackage=None):
+                   primaryIDentifier=None, emailPackage=None, concurrency=1,
+                   retries=3, backoff=5, deadLetter=None):
     '''
     Breakup large reports/csv files into smaller chunks of chunk_size arg
     prior to initiating upload. All arguments are required.
@@ -734,48 +1796,188 @@ def chunk_n_upload(mode, chunk_size, package, sfConnection,
 
     'sfConnection' - Salesforce connection object.
 
+    'concurrency' - max number of chunks (i.e. Salesforce bulk jobs) in
+    flight at once. Each chunk is submitted on its own worker thread which
+    polls its job until done, while this function collects the results of
+    whichever jobs finish first. 1 (default) uploads one chunk at a time as
+    before - callers opt in to more. Keep it modest - parallel jobs touching
+    the same Accounts can fail with row lock errors on Salesforce.
+
+    'retries' - after all chunks are done, records that failed with one of
+    retryableErrors (row locks, timeouts) are re-chunked and uploaded again,
+    up to this many more times. Only the failed records are resent - not
+    the chunk, not the package. Records of a job that raised as a whole
+    are only resent when upserting on primaryIDentifier - an insert may
+    have been committed before the job raised, resending it would create
+    duplicates.
+
+    'backoff' - seconds to wait before the first retry, doubled each retry.
+
+    'deadLetter' - CSV file to write records that still failed after the
+    retries to, along with their errors. Defaults to
+    <mode>_deadletter_<yyyymmddhhmmss>.csv in the error_logs sub directory
+    (see errorLog). Only written when there are failures.
+
+    Returns the per record results in the same order as package, e.g.
+    [{'success': True, 'created': False, 'id': '0035D00000', 'errors': []}]
+
+    Its run_trace api_calls are bulkJobCalls per chunk uploaded (a bulk job
+    is several calls, not one) - a lower bound, status polls beyond the
+    first aren't counted.
+
     Example call: chunk_n_upload('Contact', 500, entirePackage, sf, primaryID)
     '''
-    try:  # check length & break up bulk upsert if necessary, refactor?
-        while len(package) != 0:
-            chunk = []  # new
-            while len(chunk) < chunk_size:
-                chunk.append(package.pop(0))
-                if len(package) != 0:
-                    continue
-                else:
-                    break
-            if mode == 'Contact':
-                if primaryIDentifier == None:  # create new records - assuming it will just update existing ones !
-                    # update 4 Mar 2020 - test process, may never need this clause
-                    print('here')
-                    sfConnection.bulk.Contact.insert(chunk)
-                    print('but not here')
-                else:  # previously working condition
-                    sfConnection.bulk.Contact.upsert(chunk, primaryIDentifier)
-            elif mode == 'Opportunity':  # always an upsert i.e. only available contacts will get opportunities
-                sfConnection.bulk.Opportunity.upsert(chunk, primaryIDentifier)
-            if emailPackage:  # success
-                sz = 'Upserted: ' + str(len(chunk)) + ' ' + mode + ' objects.'
-                emailalert.alerter(emailPackage, mode='success', to='prim',
-                                   body=sz)
-            else:
-                print('Upserted:', len(chunk), mode,
-                      'primID:', primaryIDentifier)
-    except Exception:
+    results = [None] * len(package)  # per record, in package order
+    todo = list(range(len(package)))  # index of records left to upload
+    stage = traceStart('chunk_n_upload.' + mode)
+
+    for attempt in range(retries + 1):
+        if attempt != 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        chunks = [todo[i:i + chunk_size]
+                  for i in range(0, len(todo), chunk_size)]
+        stage['api_calls'] += len(chunks) * bulkJobCalls  # see bulkJobCalls
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            jobs = {pool.submit(bulkJob, mode, [package[i] for i in chunk],
+                                sfConnection, primaryIDentifier): chunk
+                    for chunk in chunks}
+            for job in as_completed(jobs):  # as each job finishes
+                chunk = jobs[job]
+                returned = None
+                try:
+                    returned = job.result()
+                    for i, result in zip(chunk, returned):
+                        results[i] = result
+                    for i in chunk[len(returned):]:  # came back short
+                        results[i] = chunkFailure('no result returned for '
+                                                  'the record')
+                    done = len([i for i in chunk if results[i]['success']])
+                    if emailPackage:  # success
+                        sz = 'Upserted: ' + str(done) + ' of ' + \
+                            str(len(chunk)) + ' ' + mode + ' objects.'
+                        emailalert.alerter(emailPackage, mode='success',
+                                           to='prim', body=sz)
+                    else:
+                        print('Upserted:', done, 'of', len(chunk), mode,
+                              'primID:', primaryIDentifier)
+                except Exception:
+                    if emailPackage:  # not None
+                        emailalert.alerter(emailPackage, mode='err',
+                                           to='prim',
+                                           body='Error uploading to Salesforce')
+                    errorLog(p='Error uploading to Salesforce', mode=mode,
+                             chunk_size=chunk_size, attempt=attempt,
+                             last_item_in_chunk=package[chunk[-1]],
+                             primID=primaryIDentifier,
+                             error=str(sys.exc_info()))
+                    if returned == None:  # the job itself raised
+                        for i in chunk:
+                            results[i] = chunkFailure(str(sys.exc_info()[1]))
+        todo = [i for i in todo if not results[i]['success'] and
+                retryable(results[i], primaryIDentifier != None)]
+        if len(todo) == 0:
+            break
+
+    failed = [i for i in range(len(package)) if not results[i]['success']]
+    traceEnd(stage, rows_in=len(package), rows_out=len(package) - len(failed))
+    if len(failed) != 0:
+        if deadLetter == None:
+            deadLetter = '.\\error_logs\\' + mode + '_deadletter_' + \
+                dt.today().strftime('%Y%m%d%H%M%S') + '.csv'
+        deadLetterCSV(deadLetter, [package[i] for i in failed],
+                      [results[i]['errors'] for i in failed])
         if emailPackage:  # not None
             emailalert.alerter(emailPackage, mode='err', to='prim',
-                               body='Error uploading to Salesforce')
-        if len(package) != 0:
-            errrow = package.pop()
+                               body=str(len(failed)) + ' ' + mode +
+                               ' records failed to upload, see ' + deadLetter)
+    return results
+
+
+def retryable(result, upsert=False):
+    '''
+    True if a failed per record result from Salesforce has an error whose
+    status code is in retryableErrors - or is CHUNK_EXCEPTION and upsert is
+    True. Errors are either dicts with a 'statusCode' or strings like
+    'UNABLE_TO_LOCK_ROW:unable to obtain exclusive access...', depending on
+    simple_salesforce version.
+    '''
+    for error in result['errors'] or []:
+        if isinstance(error, dict):
+            code = error.get('statusCode')
         else:
-            errrow = package
-        errorLog(p='Error uploading to Salesforce', mode=mode,
-                 chunk_size=chunk_size, last_item_in_package=errrow,
-                 primID=primaryIDentifier, error=str(sys.exc_info()))  # only last item in package list
+            code = str(error).split(':')[0].strip()
+        if code in retryableErrors or (upsert and code == 'CHUNK_EXCEPTION'):
+            return True
+    return False
+
+
+def chunkFailure(message):
+    '''
+    Per record result chunk_n_upload fills in for the records of a bulk job
+    that raised, or returned fewer results than records sent.
+    '''
+    return {'success': False, 'created': False, 'id': None,
+            'errors': [{'statusCode': 'CHUNK_EXCEPTION', 'message': message}]}
+
+
+def deadLetterCSV(path, records, errors):
+    '''
+    Writes records that could not be processed to a CSV file, one row per
+    record with an 'errors' column at the end. records is a list of dicts
+    (e.g. what was sent to Salesforce) and errors is a list, one item per
+    record. Columns are every key found across the records.
+    '''
+    fields = []
+    for record in records:
+        for key in record:
+            if key not in fields:
+                fields.append(key)
+    with open(path, 'w', newline='') as CSV:
+        wr = csv.writer(CSV)
+        wr.writerow(fields + ['errors'])
+        for record, error in zip(records, errors):
+            wr.writerow([record.get(i, '') for i in fields] + [str(error)])
+
+
+def deadLetterRow(dead, outFileName, row, error):
+    '''
+    Writes a row that failed to transform, with the error tacked on as the
+    last column, to the dead letter CSV next to outFileName i.e. in staging,
+    same name ending _deadletter.csv. Fix the rows and run the file through
+    again. dead is a dict the caller keeps for the one file - the dead
+    letter file is only created on the first bad row, the caller closes
+    dead['file'] at the end. Returns the dead letter file's name.
+
+    Never raises - it's called from the callers' except handlers. If the row
+    can't be written it returns None, the row is still counted by run_errors
+    just without a dead letter file.
+    '''
+    try:
+        if 'file' not in dead:
+            dead['name'] = outFileName[:-4] + '_deadletter.csv'
+            dead['file'] = stageOpen(dead['name'], 'w')
+        looper(dead['file'], list(row) + [error[0].__name__ + ': ' +
+                                          str(error[1])])
+        return dead['name']
+    except Exception:
+        print('row not dead lettered!', sys.exc_info())
 
 
-def stateConversion(mode, orig, new, emailPackage=None):
+def bulkJob(mode, chunk, sfConnection, primaryIDentifier=None):
+    '''
+    Uploads one chunk as a Salesforce bulk job and waits for it to complete.
+    Upserts on primaryIDentifier, or inserts when it is None. Returns the
+    per record results from Salesforce. Called on worker threads by
+    chunk_n_upload.
+    '''
+    sfObject = getattr(sfConnection.bulk, mode)  # e.g. sf.bulk.Contact
+    if primaryIDentifier == None:  # create new records
+        return sfObject.insert(chunk)
+    return sfObject.upsert(chunk, primaryIDentifier)
+
+
+def stateConversion(mode, orig, new=None, source=None, target=None,
+                    user=None, pw=None, emailPackage=None):
     '''
     Used to convert a collection of lists (usually an SQL query) to a CSV file
     OR used to read from a CSV file back into memory i.e. either a list of
@@ -786,29 +1988,125 @@ def stateConversion(mode, orig, new, emailPackage=None):
     manipulate it further using tools in transformCollection function
 
     Mode: 'list_to_CSV' - will convert a list of lists (usually from
-    pull_SQL_data) to a CSV file.
+    pull_SQL_data) to a CSV file. new arg is the name of the CSV file.
 
     Mode: 'CSV_to_list' - will convert a CSV file into a list of lists
+
+    Mode: 'list_to_table' - will convert a list of lists (usually from
+    pull_SQL_data 'list_of_lists' mode) into a column oriented table, i.e.
+    one list per column instead of one list per row. new arg optionally takes
+    a list of column names. Table returned is a dictionary e.g.
+
+    {'header': ['CustomerId', 'Surname', ...],  # or None
+     'columns': [array('q', [20000001, 20000002]), ['Smith', 'Jones'], ...]}
+
+    Columns holding only integers are stored as array('q'), everything else
+    is a list of whatever pyodbc returned (str, datetime etc). Tables are
+    what transformCollection works on.
+
+    Every row must be as wide as the header (or the first row, without a
+    header). Rows that aren't are left out of the table and counted by
+    run_errors (Point: AG) - see tableColumns.
+
+    Mode: 'CSV_to_table' - same as 'list_to_table' but from a CSV file.
+
+    Mode: 'table_to_list' - table back to a list of lists.
+
+    Mode: 'table_to_CSV' - table to a CSV file, new arg is the file name.
+
+    Args 'source', 'target', 'user', 'pw' - for mapSourceDestination, only
+    needed for modes that read or write CSV files.
     '''
-    ...
+    try:
+        if mode == 'list_to_CSV' or mode == 'table_to_CSV':
+            if mode == 'table_to_CSV':
+                orig = zip(*orig['columns'])  # columns to rows
+            stageBegin(target, user, pw)
+            with stageOpen(new, 'w', newline='') as CSV:
+                csv.writer(CSV).writerows(orig)
+            stageEnd()
+            return new
+        elif mode == 'CSV_to_list' or mode == 'CSV_to_table':
+            stageBegin(target, user, pw)
+            with stageOpen(orig, newline='') as CSV:
+                rows = [list(row) for row in readCSV(CSV)[1]]
+            stageEnd()
+            if mode == 'CSV_to_list':
+                return rows
+            return {'header': new, 'columns': tableColumns(rows, new, orig,
+                                                           emailPackage)}
+        elif mode == 'list_to_table':
+            return {'header': new, 'columns': tableColumns(orig, new, None,
+                                                           emailPackage)}
+        elif mode == 'table_to_list':
+            return [list(row) for row in zip(*orig['columns'])]
+    except Exception:
+        if emailPackage:  # not None
+            emailalert.alerter(emailPackage, mode='err', to='prim',
+                               body='Error @ Point: W')
+        errorLog(p='Point: W', mode=mode, new=new, error=str(sys.exc_info()))
 
 
-def transformCollection(mode, source, col=None, emailPackage=None):
+def tableColumns(rows, header=None, source=None, emailPackage=None):
     '''
-    To be fleshed out - the equivalent of transformCSV but in memory on
-    data structure. Usually used straight after stateConversion function.
-    As such most of the modes in this function are similar to that of
-    transformCSV. Ideally the function would be function chainable and modular
-    but as it is currently will not be as modular.
+    Rows to the columns of a table for stateConversion. Rows not as wide as
+    header (or the first row) are left out and added to run_errors at
+    Point: AG - a short or long row would otherwise shift or cut off the
+    columns of every row when transposed. source is the file, for the log.
+    '''
+    rows = list(rows)
+    if len(rows) == 0:
+        return []
+    width = len(header) if header != None else len(rows[0])
+    kept = []
+    for n, row in enumerate(rows):
+        try:
+            if len(row) != width:
+                raise ValueError('row has ' + str(len(row)) +
+                                 ' columns, table has ' + str(width))
+            kept.append(row)
+        except ValueError:  # one bad row - see run_errors
+            run_errors('add', p='Point: AG', error=sys.exc_info(), row=row,
+                       emailPackage=emailPackage, source=source, line=n)
+    return [tableColumn(i) for i in zip(*kept)]
+
+
+def tableColumn(values):
+    '''
+    Stores one column of a table. Integers only (no None, no bools) go into
+    array('q') - compact and typed. Anything else stays a list.
+    '''
+    if len(values) != 0 and all(type(i) == int for i in values):
+        return array('q', values)
+    return list(values)
+
+
+def transformCollection(mode, source, col=None, origTrue=None,
+                        origFalse=None, newTrue=None, newFalse=None,
+                        match=None, mapping=None, how='inner',
+                        emailPackage=None):
+    '''
+    The equivalent of transformCSV but in memory on data structure. Usually
+    used straight after stateConversion function. As such most of the modes
+    in this function are similar to that of transformCSV, except each mode
+    works on whole columns of a table (see stateConversion 'list_to_table')
+    rather than splitting and rewriting every row.
 
     Mandatory args: mode and source - later of which is the data collection
-    that'll be manipulated. Typically in a list of list fashion straight
-    from an SQL query via pull_SQL_data. source arg can also be a dictionary
-    of lists as opposed to a list of lists.
+    that'll be manipulated. Typically a table from stateConversion. 'dictify'
+    and 'split_dupes_nondupes' also take a list of lists straight from an SQL
+    query via pull_SQL_data.
+
+    Column modes change the table in place and return it, so calls chain:
+
+    t = stateConversion('list_to_table', pull_SQL_data('list_of_lists', ...))
+    t = transformCollection('strip_time', t, col=(4, 5))
+    t = transformCollection('de-duplicate', t, col=0)
 
     Mode: 'dictify' based on a col arg will turn source data structure
     typically a list of lists from an SQL query to a key/value pair. Typically
     used when a dictionary of lists is preferred to list of lists. Required
+    args: col. Returns {row[col]: row, ...} - last row wins for a repeated key.
 
     Mode: 'split_dupes_nondupes' - specifically used with health club nightly
     runs to return a list of lists (of non duplicate rows with unique
@@ -823,15 +2121,208 @@ def transformCollection(mode, source, col=None, emailPackage=None):
 
     Example return: [[n...], [n...], n...]], {col: [[n...], [n...], [n...]]}
     # where frst list of list is non duplicate rows. And second dictionary of
-    list of lists is a series of duplicate values found in col of each row. 
+    list of lists is a series of duplicate values found in col of each row.
+
+    Mode: 'boolify' - as per transformCSV. Required args: col, origTrue,
+    origFalse, newTrue, newFalse.
+
+    Mode: 'strip_time' - as per transformCSV, also takes datetime values as
+    returned by pyodbc. Required args: col, tuple or list of column indexes.
+
+    Mode: 'yyyymmdd_to_yyyy-mm-dd' - as per transformCSV, None and '' are
+    kept as they are. Required args: col, tuple or list of column indexes.
+
+    Mode: 'convert_time' - as per transformCSV, column becomes array('q') of
+    milliseconds. None and '' are kept as they are, a column with any of
+    them stays a list. Required args: col.
+
+    Mode: 'de-duplicate' - as per transformCSV, keeps one row per value in
+    col - the last one found, in order of first appearance. Required args: col
+
+    Mode: 'join' - as per transformCSV 'join_dict_to_csv' except any number
+    of columns are tacked on in one go. Required args:
+    * mapping - dictionary of key to list of values e.g. from pull_SQL_data
+    'loop_n_load' mode.
+    * match - index of the table column to look up in mapping.
+    * col - integer or list of integer indexes into the mapping's values,
+    each one tacked on as a new column.
+    * how - 'inner' (default) drops rows without a match, 'left' keeps them
+    with '' in the new columns, 'anti' keeps only rows without a match and
+    adds no columns.
+    Keys are compared as per transformCSV 'hash_join' i.e. normKey.
     '''
+    try:
+        if mode == 'dictify' or mode == 'split_dupes_nondupes':
+            if type(source) == dict:  # table
+                source = [list(row) for row in zip(*source['columns'])]
+            if mode == 'dictify':
+                return {row[col]: row for row in source}
+            groups = dict()
+            for row in source:
+                groups.setdefault(row[col], []).append(row)
+            nondupes = [groups[i][0] for i in groups if len(groups[i]) == 1]
+            dupes = {i: groups[i] for i in groups if len(groups[i]) != 1}
+            return [nondupes, dupes]
+
+        columns = source['columns']
+        if mode == 'boolify':
+            swap = {origTrue: newTrue, origFalse: newFalse}
+            columns[col] = [swap.get(i, i) for i in columns[col]]
+        elif mode == 'strip_time':
+            for i in col:
+                columns[i] = [
+                    j if j == '' or j == None
+                    else str(j.date()) if type(j) == dt
+                    else str(dt.strptime(j, "%Y-%m-%d %H:%M:%S").date())
+                    for j in columns[i]
+                ]
+        elif mode == 'yyyymmdd_to_yyyy-mm-dd':
+            for i in col:
+                columns[i] = [
+                    j if j == '' or j == None
+                    else str(j)[:4] + '-' + str(j)[4:6] + '-' + str(j)[6:]
+                    for j in columns[i]
+                ]
+        elif mode == 'convert_time':  # see tableColumn for the nulls
+            columns[col] = tableColumn([
+                j if j == '' or j == None else hhmmss_to_secs(str(j))
+                for j in columns[col]])
+        elif mode == 'de-duplicate':
+            last = dict()  # key: index of last row - order of first seen
+            for i, key in enumerate(columns[col]):
+                last[key] = i
+            source['columns'] = tableTake(columns, list(last.values()))
+        elif mode == 'join':
+            if type(col) == int:
+                col = [col]
+            index = joinIndex(mapping)
+            keep = []  # indexes of rows kept
+            tacked = [[] for i in col]
+            for i, key in enumerate(columns[match]):
+                right = index.get(normKey(key))
+                if how == 'anti':
+                    if right != None:
+                        continue
+                elif right != None:
+                    for j in range(len(col)):
+                        tacked[j].append(right[col[j]])
+                elif how == 'left':
+                    for j in tacked:
+                        j.append('')
+                else:  # inner
+                    continue
+                keep.append(i)
+            if how != 'left':
+                columns = tableTake(columns, keep)
+            if how == 'anti':
+                tacked, col = [], []
+            source['columns'] = columns + [tableColumn(i) for i in tacked]
+            if source['header'] != None:
+                source['header'] = source['header'] + [str(i) for i in col]
+        return source
+    except Exception:
+        if emailPackage:  # not None
+            emailalert.alerter(emailPackage, mode='err', to='prim',
+                               body='Error @ Point: X')
+        errorLog(p='Point: X', mode=mode, col=col, match=match,
+                 error=str(sys.exc_info()))
+
+
+def tableTake(columns, index):
+    '''
+    Returns columns with only the rows at the given row indexes, in the order
+    given. Keeps array columns as arrays.
+    '''
+    taken = []
+    for c in columns:
+        if type(c) == array:
+            taken.append(array(c.typecode, [c[i] for i in index]))
+        else:
+            taken.append([c[i] for i in index])
+    return taken
 
 # Utility Functions for SQL connectivity
 
 
+# pyodbc connection pool - see sql_connection
+sqlPool = {}  # (sqlSvr, sqlDB, sqlUname): [[conn, time given back], ...]
+sqlPoolLock = threading.Lock()
+sqlPoolSize = 4  # max idle connections kept per server/DB/user
+sqlPoolIdle = 300  # seconds a connection can sit idle before it is closed
+
+
+def sql_connection(mode, sqlSvr, sqlDB, sqlUname, sqlPw=None, conn=None):
+    '''
+    Process wide pool of pyodbc connections, keyed by server/DB/user, so
+    every SQL call of a run doesn't pay the login (and TLS handshake) again.
+    Used by pull_SQL_data and anything that calls it e.g. sql_refTables.
+
+    Mode: 'get' - returns an open connection, reusing an idle one from the
+    pool if there is one that still answers 'SELECT 1'. Otherwise connects.
+    sqlPw is required.
+
+    Mode: 'release' - gives conn back to the pool (rolled back first so no
+    transaction is left open). If sqlPoolSize connections are already idle
+    for that server/DB/user, conn is closed instead.
+
+    Mode: 'close_all' - closes every idle connection in the pool, e.g. at
+    the end of a mainline script. Server/DB/user args are ignored.
+
+    Connections idle for more than sqlPoolIdle seconds are closed whenever
+    the pool is used.
+    '''
+    key = (sqlSvr, sqlDB, sqlUname)
+    with sqlPoolLock:
+        now = time.time()
+        stale = []
+        for k in sqlPool:  # idle eviction
+            stale += [i[0] for i in sqlPool[k] if now - i[1] > sqlPoolIdle]
+            sqlPool[k] = [i for i in sqlPool[k] if now - i[1] <= sqlPoolIdle]
+        if mode == 'close_all':
+            for k in sqlPool:
+                stale += [i[0] for i in sqlPool[k]]
+            sqlPool.clear()
+        elif mode == 'get':
+            idle = sqlPool.get(key, [])
+            conn = idle.pop()[0] if len(idle) != 0 else None
+        elif mode == 'release':
+            idle = sqlPool.setdefault(key, [])
+            if len(idle) < sqlPoolSize and \
+                    conn not in [i[0] for i in idle]:
+                try:
+                    conn.rollback()
+                    idle.append([conn, now])
+                    conn = None  # pooled, not to be closed
+                except Exception:
+                    print('conn not reusable!', sys.exc_info())
+            if conn != None:
+                stale.append(conn)
+    for i in stale:
+        try:
+            i.close()
+        except Exception:
+            print('conn already closed!', sys.exc_info())
+
+    if mode == 'get':
+        if conn != None:
+            try:  # health check
+                conn.execute('SELECT 1').fetchall()
+                return conn
+            except Exception:
+                try:
+                    conn.close()
+                except Exception:
+                    print('conn already closed!', sys.exc_info())
+        return pyodbc.connect('DRIVER={SQL Server Native Client 10.0};SERVER='
+                              + sqlSvr + ';DATABASE=' + sqlDB + ';UID=' +
+                              sqlUname + ';PWD=' + sqlPw)
+
+
 def pull_SQL_data(mode, sqlQuery, sqlSvr, sqlDB, sqlUname, sqlPw,
                   outFileName=None, loadIntoMem=False, loadIntoMemType=None,
-                  key=None, iterable=None, target=None, user=None, pw=None, emailPackage=None):
+                  key=None, iterable=None, target=None, user=None, pw=None, emailPackage=None,
+                  arraysize=5000, batchSize=2000, latest=None, params=None,
+                  watermark=None):
     '''
     Connects & queries SQL database on specified server with passed in
     username / password. Dependnig on mode selected - will either save query
@@ -851,6 +2342,24 @@ def pull_SQL_data(mode, sqlQuery, sqlSvr, sqlDB, sqlUname, sqlPw,
     * key, which identifies the field in the returned row which will act as key
     in the dictionary ph2 (placeholder2).
 
+    Mode: 'batch_load' - same return as 'loop_n_load' but sends the keys in
+    iterable as parameterised IN lists, batchSize keys per query, rather than
+    one query per key. A few queries instead of tens of thousands of round
+    trips for health club. sqlQuery has {0} where the IN list goes e.g.
+
+    "SELECT LinksID, VisitDate, Survey FROM VisitSurveyView
+    WHERE LinksID IN ({0})"
+
+    Requires args: iterable & key as per 'loop_n_load'. Optional:
+    * batchSize - keys per query. SQL Server allows 2100 parameters per
+    query, so keep under that.
+    * latest - (key column, date column) names e.g. ('LinksID', 'VisitDate')
+    for 'batch_load' and 'loop_n_load'. When a key has many rows (e.g. every
+    visit of a member) only the row with the most recent date comes back,
+    i.e. latest child per parent - picked by the SQL server, see latestSQL,
+    so the older rows never cross the network. sqlQuery can't have its own
+    ORDER BY then. Without it the first row returned for a key is kept.
+
     Mode: 'query_save' - save to disk some complex SQL query. Stores in CSV
     format. Most commonly used mode. Returns a list of two items. CSV output
     filename and ph (which is either empty or filled with data)
@@ -878,16 +2387,52 @@ def pull_SQL_data(mode, sqlQuery, sqlSvr, sqlDB, sqlUname, sqlPw,
 
     Mode: 'return_cursor' - will just return the pyodbc connection object after
     doing running query as idenfied by the arg sqlQuery. Used for quick
-    troubleshooting.
+    troubleshooting. Connection is the caller's to close - it does not go
+    back to the pool.
+
+    Every other mode borrows a connection from the pool (see sql_connection)
+    and gives it back when done, so a run of many queries against the same
+    server/DB/user only logs in once.
+
+    Mode: 'stream' - returns a generator that yields the rows of the query in
+    batches (lists of up to arraysize pyodbc rows) as they are fetched, so
+    full table pulls e.g. all_members_initial never sit in memory all at
+    once. Connection is closed when the generator is used up (or closed),
+    or straight away if the query fails - no batches then, see Point: Z.
+    Flatten it to rows for writers e.g.
+
+    batches = pull_SQL_data('stream', sqlQueries_v4.hc['all_members_initial'],
+                            svr, db, un, pw)
+    stateConversion('list_to_CSV', itertools.chain.from_iterable(batches),
+                    'hc_initial.csv')
+
+    'arraysize' - rows fetched per round trip to the SQL server (fetchmany)
+    for 'stream', 'list_of_lists' and 'query_save' modes.
+
+    'params' - list of values for the ? markers in sqlQuery, for 'stream',
+    'list_of_lists', 'query_save' and 'return_cursor' modes. E.g. the
+    watermark of an incremental query, see watermark_state.
+
+    'watermark' - (job, [column indexes]) for 'stream', 'list_of_lists' and
+    'query_save' modes. The highest value found in those columns over every
+    row returned is staged as the job's new watermark once all rows have
+    been fetched. It is only saved by watermark_state('commit', job) - call
+    that after the rows have made it into Salesforce. E.g.
+
+    since = watermark_state('get', 'hc_nightly', default=dt(2000, 1, 1))
+    pull_SQL_data('query_save', sqlQueries_v4.hc['all_members_incremental'],
+                  svr, db, un, pw, outFileName='hc.csv',
+                  params=[since, since, since],
+                  watermark=('hc_nightly', [17, 18]))
     '''
     ph = []
     ph2 = {}
     ph3 = set()
+    stage = traceStart('pull_SQL_data.' + mode)
+    rowsOut, queries = 0, 0
 
     try:
-        conn = pyodbc.connect('DRIVER={SQL Server Native Client 10.0};SERVER=' +
-                              sqlSvr + ';DATABASE=' + sqlDB + ';UID=' +
-                              sqlUname + ';PWD=' + sqlPw)
+        conn = sql_connection('get', sqlSvr, sqlDB, sqlUname, sqlPw)
         cursor = conn.cursor()
     except Exception:  # nested two trys may not be needed
         try:
@@ -899,14 +2444,18 @@ def pull_SQL_data(mode, sqlQuery, sqlSvr, sqlDB, sqlUname, sqlPw,
         except Exception:
             print('conn already closed!', sys.exc_info())
         if emailPackage:  # not None
-            emailalerter.alert(emailPackage, mode='err', to='prim',
+            emailalert.alerter(emailPackage, mode='err', to='prim',
                                body='Error @ Point: R')
         errorLog(p='Point: R', error=str(sys.exc_info()))
 
+    if latest != None and mode in ('loop_n_load', 'batch_load'):
+        sqlQuery = latestSQL(sqlQuery, latest, mode == 'loop_n_load')
+
     if mode == 'loop_n_load':
         for i in iterable:
             try:
                 q = sqlQuery.format(i)
+                queries += 1
                 cursor.execute(q)
                 row = cursor.fetchone()
                 ph2[str(row[key])] = list(row)  # entire row
@@ -918,58 +2467,92 @@ def pull_SQL_data(mode, sqlQuery, sqlSvr, sqlDB, sqlUname, sqlPw,
         except Exception:
             print('cursor already closed!', sys.exc_info())
         try:
-            conn.close()
+            sql_connection('release', sqlSvr, sqlDB, sqlUname, conn=conn)
         except Exception:
             print('conn already closed!', sys.exc_info())
+        traceEnd(stage, rows_in=queries, rows_out=len(ph2),
+                 api_calls=queries)
+        return ph2
+    elif mode == 'batch_load':
+        keys = list(dict.fromkeys(iterable))  # no dupes, order kept
+        i = None  # batch offset, for errorLog
+        width = None if latest == None else -1
+        try:
+            cursor.arraysize = arraysize
+            for i in range(0, len(keys), batchSize):
+                batch = keys[i:i + batchSize]
+                queries += 1
+                cursor.execute(sqlQuery.format(','.join('?' * len(batch))),
+                               batch)
+                for rows in fetchBatches(cursor):
+                    rowsOut += len(rows)
+                    for row in rows:
+                        k = str(row[key])
+                        if k not in ph2:  # latest_rn dropped, see latestSQL
+                            ph2[k] = list(row)[:width]
+        except Exception:
+            if emailPackage:  # not None
+                emailalert.alerter(emailPackage, mode='err', to='prim',
+                                   body='Error @ Point: AA')
+            errorLog(p='Point: AA', sqlQuery=sqlQuery, batch=i,
+                     error=str(sys.exc_info()))
+        finally:
+            try:
+                cursor.close()
+            except Exception:
+                print('cursor already closed!', sys.exc_info())
+            try:
+                sql_connection('release', sqlSvr, sqlDB, sqlUname,
+                               conn=conn)
+            except Exception:
+                print('conn already closed!', sys.exc_info())
+        traceEnd(stage, rows_in=len(keys), rows_out=rowsOut,
+                 api_calls=queries)
         return ph2
     elif mode == 'query_save' or mode == 'list_of_lists':
+        staged = False  # Q: mapped, to unmap in finally
         try:
-            cursor.execute(sqlQuery)  # pull easy
+            cursor.arraysize = arraysize  # rows per fetchmany
+            sqlExecute(cursor, sqlQuery, params)  # pull easy
             if mode == 'list_of_lists':
-                while True:
-                    row = cursor.fetchone()
-                    ph.append(list(row))
-                    if not row:  # no moar rows! :(
-                        break
+                for rows in fetchBatches(cursor, watermark):
+                    ph.extend([list(row) for row in rows])
+                rowsOut = len(ph)
             elif mode == 'query_save':
-                mapSourceDestination('map_staging', target=target, user=user,
-                                     pw=pw)
-                with open('Q:' + outFileName, 'w', newline='') as CSV:
+                stageBegin(target, user, pw)
+                staged = True
+                with stageOpen(outFileName, 'w', newline='') as CSV:
                     wr = csv.writer(CSV)
-                    while True:
-                        row = cursor.fetchone()
-                        wr.writerow(row)  # PROBLEM HERE!
+                    for rows in fetchBatches(cursor, watermark):
+                        wr.writerows(rows)
+                        rowsOut += len(rows)
                         # return [outFileName, [r[key], r2[key], n]
                         if loadIntoMem == True:
                             if loadIntoMemType == 'list':
-                                ph.append(row[key])
+                                ph.extend([row[key] for row in rows])
                             elif loadIntoMemType == 'set':
-                                ph3.add(row[key])
-                        if not row:
-                            break
-        except Exception:  # no moar rows! :)
-            cursor.close()  # amazin
-            conn.close()  # amazin
-            errtype, value, traceback = sys.exc_info()
-            if str(value) == 'iterable expected, not NoneType':
-                pass  # expected
-            else:
-                if emailPackage:  # not None
-                    emailalert.alerter(emailPackage, mode='err', to='prim',
-                                       body='Error @ Point: I')
-                errorLog(p='Point: I', sqlQuery=sqlQuery, sqlSvr=sqlSvr,
-                         sqlDB=sqlDB, sqlUname=sqlUname, outFile=outFileName,
-                         error=str(sys.exc_info()))
+                                ph3.update([row[key] for row in rows])
+                stage['bytes_out'] = stageSize(outFileName)
+        except Exception:
+            if emailPackage:  # not None
+                emailalert.alerter(emailPackage, mode='err', to='prim',
+                                   body='Error @ Point: I')
+            errorLog(p='Point: I', sqlQuery=sqlQuery, sqlSvr=sqlSvr,
+                     sqlDB=sqlDB, sqlUname=sqlUname, outFile=outFileName,
+                     error=str(sys.exc_info()))
         finally:  # double checks
             try:
                 cursor.close()
-                print('here???')
             except Exception:
                 print('cursor already closed!', sys.exc_info())
             try:
-                conn.close()
+                sql_connection('release', sqlSvr, sqlDB, sqlUname,
+                               conn=conn)
             except Exception:
                 print('conn already closed!', sys.exc_info())
+            if staged:  # also when the query or the write failed
+                stageEnd()
+        traceEnd(stage, rows_out=rowsOut, api_calls=1)
         if mode == 'list_of_lists':
             return ph
         elif mode == 'query_save':
@@ -978,47 +2561,298 @@ def pull_SQL_data(mode, sqlQuery, sqlSvr, sqlDB, sqlUname, sqlPw,
             elif loadIntoMemType == 'set':
                 return [outFileName, ph3]
     elif mode == 'return_cursor':
-        cursor.execute(sqlQuery)  # pull easy
+        sqlExecute(cursor, sqlQuery, params)  # pull easy
+        traceEnd(stage, api_calls=1)
         return [conn, cursor]  # for direct work on SQL view
+    elif mode == 'stream':
+        try:
+            cursor.arraysize = arraysize  # rows per fetchmany
+            sqlExecute(cursor, sqlQuery, params)
+        except Exception:  # no generator to close them - done here
+            if emailPackage:  # not None
+                emailalert.alerter(emailPackage, mode='err', to='prim',
+                                   body='Error @ Point: Z')
+            errorLog(p='Point: Z', sqlQuery=sqlQuery, sqlSvr=sqlSvr,
+                     sqlDB=sqlDB, sqlUname=sqlUname, error=str(sys.exc_info()))
+            try:
+                cursor.close()
+            except Exception:
+                print('cursor already closed!', sys.exc_info())
+            try:
+                sql_connection('release', sqlSvr, sqlDB, sqlUname,
+                               conn=conn)
+            except Exception:
+                print('conn already closed!', sys.exc_info())
+            traceEnd(stage, api_calls=1)
+            return iter([])  # no batches
+        return streamRows(conn, cursor, sqlQuery, sqlSvr, sqlDB, sqlUname,
+                          emailPackage, watermark, stage)
 
 
-def sql_refTables(query, emailPackage=None):  # load tables into memory
+def latestSQL(sqlQuery, latest, top=False):
+    '''
+    Wraps sqlQuery so the SQL server only returns the most recent row per
+    key, see pull_SQL_data 'latest' - (key column, date column). Rows with
+    no date sort last (NULLs are lowest on SQL Server).
+
+    top=True is for a query of the one key ('loop_n_load') - TOP 1 ...
+    ORDER BY, same columns as sqlQuery. Otherwise ROW_NUMBER() OVER
+    (PARTITION BY key ORDER BY date DESC), which adds the row number as an
+    extra last column.
+    '''
+    keyCol, dateCol = ['q.[' + str(i).replace(']', ']]') + ']'
+                       for i in latest]
+    if top:
+        return ('SELECT TOP 1 * FROM (' + sqlQuery + ') AS q ORDER BY ' +
+                dateCol + ' DESC')
+    return ('SELECT * FROM (SELECT q.*, ROW_NUMBER() OVER (PARTITION BY ' +
+            keyCol + ' ORDER BY ' + dateCol + ' DESC) AS latest_rn FROM (' +
+            sqlQuery + ') AS q) AS r WHERE r.latest_rn = 1')
+
+
+def sqlExecute(cursor, sqlQuery, params=None):
+    '''
+    cursor.execute with params for the query's ? markers, if there are any.
+    '''
+    if params == None:
+        return cursor.execute(sqlQuery)
+    return cursor.execute(sqlQuery, params)
+
+
+def fetchBatches(cursor, watermark=None):
+    '''
+    Yields the rows of an executed pyodbc cursor in lists of up to
+    cursor.arraysize rows, one fetchmany (one round trip) per list. Stops on
+    the first empty fetch rather than waiting for an exception.
+
+    'watermark' - (job, [column indexes]), see pull_SQL_data. Staged only
+    once the last row has been fetched. Nulls are skipped and dates count
+    as midnight (see watermarkValue) so date and datetime columns mix.
+    '''
+    high = None
+    while True:
+        rows = cursor.fetchmany()
+        if len(rows) == 0:  # no moar rows! :)
+            break
+        if watermark != None:
+            for row in rows:
+                for i in watermark[1]:
+                    if row[i] == None:
+                        continue
+                    value = watermarkValue(row[i])
+                    if high == None or value > high:
+                        high = value
+        yield rows
+    if high != None:
+        watermark_state('stage', watermark[0], high)
+
+
+def streamRows(conn, cursor, sqlQuery, sqlSvr, sqlDB, sqlUname,
+               emailPackage=None, watermark=None, stage=None):
+    '''
+    Generator behind pull_SQL_data 'stream' mode. Yields fetchBatches of the
+    cursor, then closes cursor and gives connection back to the pool - also
+    if the consumer stops early and closes the generator. The run_trace
+    stage is ended then too, so its time includes the consumer's.
+    '''
+    rowsOut = 0
+    try:
+        for rows in fetchBatches(cursor, watermark):
+            rowsOut += len(rows)
+            yield rows
+    except Exception:
+        if emailPackage:  # not None
+            emailalert.alerter(emailPackage, mode='err', to='prim',
+                               body='Error @ Point: Z')
+        errorLog(p='Point: Z', sqlQuery=sqlQuery, error=str(sys.exc_info()))
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            print('cursor already closed!', sys.exc_info())
+        try:
+            sql_connection('release', sqlSvr, sqlDB, sqlUname, conn=conn)
+        except Exception:
+            print('conn already closed!', sys.exc_info())
+        if stage != None:
+            traceEnd(stage, rows_out=rowsOut, api_calls=1)
+
+
+# Incremental extraction state - see watermark_state
+watermarkFile = os.path.join('.', 'state', 'watermarks.json')
+watermarkStaged = {}  # job: highest value seen this run, not yet committed
+watermarkLock = threading.Lock()  # jobs stage / commit from their threads
+
+
+def watermark_state(mode, job, value=None, default=None):
+    '''
+    High watermark store for incremental extraction. Keeps, per job (any
+    name e.g. 'hc_nightly'), the highest change timestamp of the rows that
+    were last loaded successfully. Queries then ask only for rows changed
+    since then (see hc['all_members_incremental'] in sqlQueries_v4) - so
+    jobs can run as often as needed and a missed run loses nothing, the
+    next run picks up from where the last successful one got to.
+
+    Mode: 'get' - returns the job's committed watermark as a datetime, or
+    default if the job has never committed one. No default then - KeyError,
+    rather than a None that would end up as the query's parameter.
+
+    Mode: 'stage' - holds value as the job's new watermark for this run if
+    it is higher than anything staged so far. Not saved. Done by
+    pull_SQL_data when called with its watermark arg.
+
+    Mode: 'commit' - saves the staged watermark to watermarkFile. Call after
+    the run has loaded into Salesforce. Nothing staged - nothing changes.
+
+    Safe to call from jobrunner's worker threads - see watermarkLock.
+    '''
+    with watermarkLock:
+        if mode == 'stage':
+            value = watermarkValue(value)
+            if job not in watermarkStaged or value > watermarkStaged[job]:
+                watermarkStaged[job] = value
+            return watermarkStaged[job]
+
+        try:
+            with open(watermarkFile) as f:
+                committed = json.load(f)
+        except FileNotFoundError:
+            committed = {}
+
+        if mode == 'get':
+            if job in committed:
+                return dt.fromisoformat(committed[job])
+            if default == None:
+                raise KeyError('no watermark committed for ' + job +
+                               ' - pass a default for its first run')
+            return default
+        elif mode == 'commit':
+            if job in watermarkStaged:
+                value = watermarkValue(watermarkStaged.pop(job))
+                committed[job] = value.isoformat()
+                os.makedirs(os.path.dirname(watermarkFile), exist_ok=True)
+                with open(watermarkFile + '.tmp', 'w') as f:
+                    json.dump(committed, f, indent=1)
+                os.replace(watermarkFile + '.tmp', watermarkFile)
+                return value
+
+
+def watermarkValue(value):
+    '''
+    A watermark value as a datetime - a date is midnight that day.
+    '''
+    if type(value) == ymd:
+        return dt.combine(value, dt.min.time())
+    return value
+
+
+# sql_refTables cache - pickle files on local disk, one per query
+refCacheDir = os.path.join('.', 'ref_cache')
+refTableCache = {}  # cache key: [time loaded, change token, table]
+
+
+def sql_refTables(query, sqlSvr, sqlDB, sqlUname, sqlPw,
+                  emailPackage=None, ttl=None,
+                  changeToken=None):  # load tables into memory
     '''
-    update - 22 september 2019 - docstring needs to be fleshed out.
     Load into memory reference Tables used for lookup, referencing
     and compiling new tables which can then be saved as CSVs.
     Used in conjunction with variables from sqlQueries module.
     Import ETLJitterbitClone in the mainline script then call
     sql_refTables with the variable from sqlQueries module e.g.
-    membersTable = refTable(sqlQueries.membershiptTypes)
+    membersTable = sql_refTables(sqlQueries_v4.membershipTypes, svr, db, un,
+                                 pw, ttl=86400)
+
+    Returns a dictionary keyed on the first column of the query (see notes
+    at the top of sqlQueries_v4) with the rest of the row as a list e.g.
+    {'M1050': [ProductId, CategoryId, ...], ...}
+
+    sqlSvr, sqlDB, sqlUname, sqlPw - as per pull_SQL_data.
+
+    'ttl' - seconds a loaded table is good for. None (default) loads from
+    the server every call. Otherwise the table is kept in refCacheDir (keyed
+    by query text + server/DB/user) and read from there - only once per run,
+    and only when first asked for. Until ttl runs out the Links server is
+    not touched at all.
+
+    'changeToken' - optional query returning one value that changes when
+    the table does e.g. "SELECT MAX(LastUpdated) FROM MembershipTypesView".
+    Once ttl runs out it is run instead of the full query - if the value is
+    the same as last time the cached table is kept for another ttl.
+
+    If the server can't be reached (nothing comes back) a stale cached table
+    is returned rather than an empty one.
+    '''
+    if ttl == None:
+        return refTableLoad(query, sqlSvr, sqlDB, sqlUname, sqlPw,
+                            emailPackage)
+
+    key = hashlib.sha1('\n'.join([sqlSvr, sqlDB, sqlUname, query]).
+                       encode('utf-8')).hexdigest()
+    path = os.path.join(refCacheDir, key + '.pickle')
+    entry = refTableCache.get(key)
+    if entry == None and os.path.exists(path):  # lazily, first use only
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            refTableCache[key] = entry
+        except Exception:
+            print('ref table cache unreadable!', path, sys.exc_info())
+    if entry != None and time.time() - entry[0] < ttl:
+        return entry[2]  # fresh - no server
+
+    token = None
+    if changeToken != None:
+        token = pull_SQL_data('list_of_lists', changeToken, sqlSvr, sqlDB,
+                              sqlUname, sqlPw, emailPackage=emailPackage)
+        token = token[0][0] if token else None
+        if entry != None and token != None and token == entry[1]:
+            entry[0] = time.time()  # unchanged - good for another ttl
+            refTableSave(path, entry)
+            return entry[2]
+
+    table = refTableLoad(query, sqlSvr, sqlDB, sqlUname, sqlPw, emailPackage)
+    if len(table) == 0 and entry != None:  # server down? stale beats empty
+        return entry[2]
+    entry = [time.time(), token, table]
+    refTableCache[key] = entry
+    refTableSave(path, entry)
+    return table
+
+
+def refTableLoad(query, sqlSvr, sqlDB, sqlUname, sqlPw, emailPackage=None):
+    '''
+    Runs a reference table query and returns it as a dictionary of first
+    column to rest of row, see sql_refTables.
     '''
     referenceTable = {}  # a dictionary!
-    conn, cursor = pull_SQL_data(query)  # [conn, cursor]
     try:
-        while True:
-            row = list(cursor.fetchone())  # see membershipTypes in sqlQueries
+        rows = pull_SQL_data('list_of_lists', query, sqlSvr, sqlDB, sqlUname,
+                             sqlPw, emailPackage=emailPackage)
+        for row in rows:  # see membershipTypes in sqlQueries
             key = row.pop(0)  # 0 is primary key or unique identifier of table
             referenceTable[key] = row
-            if not row:
-                break
     except Exception:
-        cursor.close()  # amazing
-        conn.close()  # grace
         if emailPackage:  # not None
             emailalert.alerter(emailPackage, mode='err', to='prim',
                                body='Error @ Point: J')
         errorLog(p='Point: J', query=query, error=str(sys.exc_info()))
-    finally:
-        try:
-            cursor.close()
-        except Exception:
-            print('cursor already closed!', sys.exc_info())
-        try:
-            conn.close()
-        except Exception:
-            print('conn already closed!', sys.exc_info())
     return referenceTable
 
+
+def refTableSave(path, entry):
+    '''
+    Writes a sql_refTables cache entry to disk. Written to a temp file then
+    swapped in, so a run killed mid write doesn't leave a broken cache.
+    '''
+    try:
+        os.makedirs(refCacheDir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+    except Exception:
+        print('ref table cache not saved!', path, sys.exc_info())
+
 # Next two functions act as: for each parent, find associated child
 
 
@@ -1063,16 +2897,18 @@ def CSV_query(mode, csvfile, col=None, max_size=None, value=None,
     for mapSourceDestination function.
     '''
 
-    mapSourceDestination('map_staging', target=target, user=user, pw=pw)
+    stage = traceStart('CSV_query.' + mode)
+    stageBegin(target, user, pw)
     # assumes CSV is already in target
 
     temp, temp2, list_of_lists, list_of_strs = [], {}, [], []  # placeholders
+    rowsIn = 0
 
-    with open('Q:' + csvfile) as CSV:
+    with stageOpen(csvfile, newline='') as CSV:
         try:
             if mode == 'select_col':
-                for row in CSV:
-                    split = row.split(',')
+                for split in readCSV(CSV)[1]:
+                    rowsIn += 1
                     if len(temp) < max_size:
                         temp.append(split[col])  # e.g. (split[3])
                     else:
@@ -1083,13 +2919,15 @@ def CSV_query(mode, csvfile, col=None, max_size=None, value=None,
                     list_of_lists.append(temp[:])
                     temp.clear()
             elif mode == 'select_all':
-                for row in CSV:
-                    split = row.split(',')
+                for row in readCSV(CSV)[1]:
+                    rowsIn += 1
+                    split = list(row)
                     key = split.pop(col)
                     temp2[key] = split
             elif mode == 'find_value':
-                for row in CSV:
-                    split = row.split(',')
+                for row in readCSV(CSV)[1]:
+                    rowsIn += 1
+                    split = list(row)
                     for i in split:
                         if i == value:
                             key = i
@@ -1104,7 +2942,9 @@ def CSV_query(mode, csvfile, col=None, max_size=None, value=None,
                      value=value, colFormat=colFormat,
                      error=str(sys.exc_info()))
 
-    mapSourceDestination('unmap_staging')  # remove
+    traceEnd(stage, rows_in=rowsIn, bytes_in=stageSize(csvfile),
+             rows_out=rowsIn if mode == 'select_col' else len(temp2))
+    stageEnd()  # remove
 
     if mode == 'select_col':  # todo 10 feb - add exception handling like above
         try:
@@ -1130,16 +2970,149 @@ def CSV_query(mode, csvfile, col=None, max_size=None, value=None,
 # Utility Function - Salesforce
 
 
+# Column layouts of the staged CSVs preupload_prep is given - the report /
+# query columns, then the ones the mainline scripts tack on in transformCSV,
+# in that order. None for a column nothing maps from.
+carparkColumns = [
+    'Car Park date', 'Car Park', 'First Name', 'Last Name', 'Mobile',
+    'Post Code', 'Email', 'Pay Amount', 'Ticket No', 'Tickets', 'Pay Date',
+    'Pay Time', 'Whats On', 'Promo Code',
+    'ContactSFID', 'StageName', 'OpportunityName', 'RecordTypeId']  # tacked
+membersColumns = [  # sqlQueries_v4.hc all_members_* queries
+    'CustomerId', 'Surname', 'GivenNames', 'Description', 'DateStarted',
+    'CurrentExpiryDate', 'Address', 'Suburb', 'State', 'PostCode',
+    'HomePhone', 'WorkPhone', 'MobilePhone', 'Email', 'DateOfBirth', 'Gender',
+    'Status', 'IDLastUpdated', 'ContractLastUpdated', 'CustomerDateCreated',
+    'LastVisit', 'ContactSFID', None, 'OpportunityName', 'ExpiryDate']  # tacked
+
+# Field mappings for preupload_prep and bulk2_upload, keyed by (mode,
+# select). 'columns' - layout the fields are looked up in when the file has
+# no header row. 'fields' - Salesforce field: where its value comes from,
+# one of:
+#   'Email'            column name (or an int - column index)
+#   ('Whats On', int)  column then a converter - a callable or the name of
+#                      one in fieldConverters e.g. 'int', 'strip', 'date'
+#   {'value': x}       x as is on every row
+# Compiled once per file by compileFields.
+fieldMaps = {
+    ('Contact', 'car_park_tickets'): {
+        'columns': carparkColumns,
+        'fields': {'FirstName': 'First Name', 'LastName': 'Last Name',
+                   'MobilePhone': 'Mobile', 'Email': 'Email',
+                   'What_s_On__c': ('Whats On', 'int')}},  # only takes ints
+    ('Contact', 'health_club_nomailing'): {
+        'columns': membersColumns,
+        'fields': {'FirstName': 'GivenNames', 'LastName': 'Surname',
+                   'Phone': 'HomePhone', 'MobilePhone': 'MobilePhone',
+                   'Email': 'Email', 'LINKS_CUSTID__c': 'CustomerId'}},
+    ('Contact', 'health_club'): {  # including mailing info
+        'columns': membersColumns,
+        'fields': {'Id': 'ContactSFID', 'MailingStreet': 'Address',
+                   'MailingCity': 'Suburb', 'MailingState': 'State',
+                   'MailingPostalCode': 'PostCode'}},
+    ('Contact_MailingPostalCode', None): {
+        'columns': carparkColumns,
+        'fields': {'Id': 'ContactSFID', 'MailingPostalCode': 'Post Code'}},
+    ('Opportunity', 'car_park_tickets'): {
+        'columns': carparkColumns,
+        'fields': {'Ticket_Number__c': ('Ticket No', 'int'),
+                   'Park_Date__c': 'Car Park date',
+                   'Pay_Time__c': ('Pay Time', 'int'),
+                   'Promo_codes__c': 'Promo Code', 'Amount': 'Pay Amount',
+                   'Pay_Date__c': 'Pay Date', 'Car_Park__c': 'Car Park',
+                   'CloseDate': 'Pay Date', 'StageName': {'value':
+                                                          'Closed Won'},
+                   'Contact__c': 'ContactSFID', 'Name': 'OpportunityName',
+                   'RecordTypeId': 'RecordTypeId'}},
+    ('Opportunity', 'health_club'): {
+        'columns': membersColumns,
+        'fields': {'Student_DOB__c': 'DateOfBirth',
+                   'Aquatic_Health_Club__c': {'value': 1},
+                   'Opportunity_type__c': {'value': 'Health Club'},
+                   'Start_Date__c': 'DateStarted', 'Status__c': 'Status',
+                   'Membership_Type__c': 'Description',
+                   'Current_Expiry__c': ('ExpiryDate', 'strip'),
+                   'Last_Visit__c': ('LastVisit', 'date'),  # date only
+                   'CloseDate': ('ExpiryDate', 'strip'),
+                   'StageName': {'value': 'Closed Won'},
+                   'Contact__c': 'ContactSFID', 'Name': 'OpportunityName',
+                   'RecordTypeId': {'value': ''}}},  # e.g. 0125D0000000
+}
+
+fieldConverters = {
+    'int': int,
+    'float': float,
+    'strip': str.strip,
+    'date': lambda v: v[:10],  # yyyy-mm-dd of yyyy-mm-dd hh:mm:ss
+    'money': lambda v: format(float(v), '.2f'),
+    'blank_none': lambda v: v if v.strip() != '' else None,
+}
+
+
+def compileFields(mapping, header=None):
+    '''
+    Turns a field mapping (see fieldMaps) into a function that takes a row
+    of the CSV (a tuple, from readCSV) and returns the dict to upload e.g.
+    {'FirstName': 'Jo', 'What_s_On__c': 3}. Column names are looked up
+    once here - in header, the file's own header row, if it has one,
+    otherwise in mapping['columns'].
+
+    The function is the one dict literal, built once per mapping, e.g.
+    lambda row: {'Email': row[6], 'What_s_On__c': c0(row[12])} - the same
+    per row cost as the hand written literals preupload_prep used to have.
+    Only field names (checked to be identifiers, then repr) and integer
+    indexes go into its source. Converters and values are passed in as
+    defaults.
+
+    Raises KeyError for a column that isn't in the header / layout, and
+    ValueError for a field name that isn't one Salesforce could have,
+    before any row is read.
+    '''
+    columns = header or mapping.get('columns') or []
+    items, bound = [], {}
+    for field, source in mapping['fields'].items():
+        if not isinstance(field, str) or not field.isidentifier():
+            raise ValueError('not a Salesforce field name: ' + repr(field))
+        convert = None
+        if isinstance(source, dict):
+            name = 'v' + str(len(bound))
+            bound[name] = source['value']
+            items.append(repr(field) + ': ' + name)
+            continue
+        if isinstance(source, (tuple, list)):
+            source, convert = source
+            if not callable(convert):
+                convert = fieldConverters[convert]
+        if not isinstance(source, int):
+            if source not in columns:
+                raise KeyError('no column ' + repr(source) + ' for ' + field)
+            source = columns.index(source)
+        value = 'row[' + str(int(source)) + ']'
+        if convert != None:
+            name = 'c' + str(len(bound))
+            bound[name] = convert
+            value = name + '(' + value + ')'
+        items.append(repr(field) + ': ' + value)
+
+    args = ''.join([', ' + i + '=' + i for i in bound])
+    payload = eval('lambda row' + args + ': {' + ', '.join(items) + '}',
+                   {'__builtins__': {}}, bound)
+    payload.fields = list(mapping['fields'])  # in declared order
+    return payload
+
+
 def preupload_prep(mode, sfConn, csvfile, primaryID=None, select=None,
                    debug=False, source=None, target=None, user=None, pw=None,
-                   emailPackage=None):
+                   emailPackage=None, concurrency=1, api='bulk',
+                   snapshot=None, snapshotKey=None, mapping=None,
+                   header=False, insert=False):
     '''
     Upsert a data collection to Salesforce object. Depending on the mode
     selected. Available modes:
 
     'Contact' - upserts to Contact object, sub modes are specified by the
-    'select' argument. Either 'car_park_tickets', 'health_club', 'swim_school',
-    or 'gymnastics'.
+    'select' argument. Either 'car_park_tickets', 'health_club' or
+    'health_club_nomailing' - the field mappings in fieldMaps.
 
     'Contact_MailingPostalCode' - for whatever reason upserts to contact
     object with 'MailingPostalCode' as a key to value mapping will fail.
@@ -1148,8 +3121,12 @@ def preupload_prep(mode, sfConn, csvfile, primaryID=None, select=None,
     primaryID set as SFID. This will be successful. This is the only reason
     why this mode exists separately to the 'Contact' mode.
 
-    'Opportunity' - upserts to Opportunity object, sub modes identical to that
-    of 'Contact' mode.
+    'Opportunity' - upserts to Opportunity object, sub modes
+    'car_park_tickets' or 'health_club'. With no primaryID nothing is
+    uploaded (returns None) unless insert=True - an insert can't tell a
+    record that is already there, so a re-run makes duplicates.
+
+    Any other mode is taken as the sObject to upload to, with a mapping.
 
     'sfConn' - pass in the Salesforce connection object.
 
@@ -1171,185 +3148,420 @@ def preupload_prep(mode, sfConn, csvfile, primaryID=None, select=None,
     will upsert mapping to Salesforce. True is useful when determining why
     upserts are failing.
 
-    Note, this function is where the 'Load' component of ETL happens. As such
-    Every type of upsert you are planning to do needs to be added here. I.e.
-    once you have the shape of the CSV file (final transformed CSV file), then
-    modify this function by adding a new 'mode' and specifying the mapping
-    structure based on the CSV file.
+    Note, this function is where the 'Load' component of ETL happens. Which
+    column of the CSV goes to which Salesforce field is a field mapping (see
+    fieldMaps), compiled once per file by compileFields. For a new upload
+    e.g. swim school, once you have the shape of the final transformed CSV
+    file, add its mapping to fieldMaps under (mode, select) - or pass it in:
 
-    As an example, for 'gymnastics' mode, entirePackage.append(x)
+    'mapping' - field mapping to use instead of fieldMaps[(mode, select)],
+    e.g. from a jobrunner spec:
+    {'columns': ['Email', 'Given', 'Family', 'Class', 'Level'],
+     'fields': {'Email': 'Email', 'FirstName': 'Given',
+                'LastName': 'Family', 'Level__c': ('Level', 'int'),
+                'Venue__c': {'value': 'Gymnastics'}}}
 
-    Where x is {'FirstName': split[a], 'Class': split[b], ...}
+    'header' - True if csvfile's first row holds the column names. Mapping
+    columns are then looked up in it (no 'columns' needed) and the row is
+    not uploaded.
+
+    'concurrency' - max bulk jobs in flight at once, see chunk_n_upload.
+    Default 1 - one at a time.
+
+    'insert' - True to insert Opportunity records when primaryID is None.
+
+    When not in debug mode, returns the per record upload results from
+    chunk_n_upload - records still failing after retries are in its
+    dead-letter CSV.
+
+    'snapshot' - file to keep a hash of every record uploaded in, see
+    row_snapshot. When passed, only records that are new or differ from
+    what was last uploaded successfully are sent - the rest are skipped, no
+    API calls, no Salesforce automation firing for nothing. Hashes are
+    saved for records that uploaded OK. One file per job/mode/select.
+
+    'snapshotKey' - field that identifies a record in the snapshot e.g.
+    'LINKS_CUSTID__c', 'Email', 'Ticket_Number__c'. Defaults to primaryID,
+    one of the two is needed with snapshot (ValueError otherwise).
+
+    'api' - 'bulk' (default) builds the dicts and uploads via chunk_n_upload.
+    'bulk2' streams csvfile straight to Bulk API 2.0 ingest jobs using the
+    same field mapping - no dicts kept, no JSON. Returns the final state of
+    the ingest jobs, see bulk2_upload. Can't be used with snapshot - every
+    row is sent (ValueError if both are given).
 
     'source', 'target', 'user', 'pw' - these are to call mapSourceDestination
     '''
-    mapSourceDestination('map_staging', target=target, user=user, pw=pw)
+    stage = traceStart('preupload_prep.' + mode + '.' + str(select))
+    sObject = 'Contact' if mode == 'Contact_MailingPostalCode' else mode
+    if mapping == None:
+        mapping = fieldMaps.get((mode, select))
+    if api == 'bulk2':  # stream the staged CSV, no dicts
+        traceEnd(stage)  # see the bulk2_upload stage
+        if snapshot != None:
+            raise ValueError("snapshot needs api='bulk' - bulk2 streams the "
+                             "file, there are no records to compare")
+        return bulk2_upload(sObject, sfConn, csvfile, mapping, primaryID,
+                            source=source, target=target, user=user, pw=pw,
+                            emailPackage=emailPackage, header=header)
+
+    stageBegin(target, user, pw)
 
     entirePackage = []  # load in memory items from CSV in destination
+    results = None  # per record results of upload, see chunk_n_upload
+    point = {'Contact': 'L', 'Contact_MailingPostalCode': 'M'}.get(mode, 'N')
+    split = None
 
-    if mode == 'Contact':
-        try:
-            with open('Q:' + csvfile) as CSV:
-                for row in CSV:
-                    split = row.split(',')  # make list of CSV param
-                    if select == 'car_park_tickets':
-                        entirePackage.append(  # todo: need to add -
-                            # MailingStreet, MailingCity, MailingState,
-                            # MailingPostalCode, Phone
-                            {'FirstName': split[2],
-                             'LastName': split[3],
-                             'MobilePhone': split[4],
-                             'Email': split[6],
-                             'What_s_On__c': int(split[12])  # only takes ints
-                             }
-                        )
-                    elif select == 'health_club_nomailing':
-                        entirePackage.append(
-                            {'FirstName': split[2],
-                             'LastName': split[1],
-                             'Phone': split[10],
-                             'MobilePhone': split[12],
-                             'Email': split[13],
-                             'LINKS_CUSTID__c': split[0]
-                             }
-                        )
-                    elif select == 'health_club':  # including mailing info
-                        entirePackage.append(
-                            {'Id': split[21],
-                             'MailingStreet': split[6],
-                             'MailingCity': split[7],
-                             'MailingState': split[8],
-                             'MailingPostalCode': split[9],
-                             }
-                        )
-                    elif select == 'swim_school':
-                        ...  # to be fleshed out
-                    elif select == 'gymnastics':
-                        ...
-        except Exception:
-            if emailPackage:  # not None
-                emailalert.alerter(emailPackage, mode='err', to='prim',
-                                   body='Error @ Point: L')
-            if len(entirePackage) != 0:
-                errrow = entirePackage.pop()
-            else:
-                errrow = entirePackage
-            errorLog(p='Point: L', mode=mode, csvfile=csvfile,
-                     primaryID=primaryID, select=select, debug=debug,
-                     row=row, split=split, last_row=errrow,
-                     error=str(sys.exc_info()))
-        if debug == True:
-            mapSourceDestination('unmap_staging')
-            return entirePackage
+    try:
+        if mapping == None:
+            raise KeyError('no field mapping for ' + str((mode, select)))
+        with stageOpen(csvfile, newline='') as CSV:
+            schema, rows = readCSV(CSV, header)
+            payload = compileFields(mapping, schema['header'])  # once
+            for split in rows:  # tuple of CSV param
+                entirePackage.append(payload(split))
+    except Exception:
+        if emailPackage:  # not None
+            emailalert.alerter(emailPackage, mode='err', to='prim',
+                               body='Error @ Point: ' + point)
+        if len(entirePackage) != 0:
+            errrow = entirePackage.pop()
         else:
-            # caters for Fn+Ln+Email combo uses sf.bulk.Contact.insert(data) API call
-            if primaryID == None:
-                print('at least here!')
-                chunk_n_upload('Contact', 500, entirePackage,
-                               sfConn, emailPackage=emailPackage)
-                print('if not??? here.')
-            else:  # original upsert with primaryID specified by mainline script
-                chunk_n_upload('Contact', 500, entirePackage,
-                               sfConn, primaryIDentifier=primaryID,
-                               emailPackage=emailPackage)
-    # legacy for car parks - TODO: remove and add to the main IF clause like health_club_nomail
-    elif mode == 'Contact_MailingPostalCode':
+            errrow = entirePackage
+        errorLog(p='Point: ' + point, mode=mode, csvfile=csvfile,
+                 primaryID=primaryID, select=select, debug=debug,
+                 split=split, last_row=errrow, error=str(sys.exc_info()))
+    stage['rows_in'] = len(entirePackage)
+    if snapshot != None:  # only what changed since last upload
+        hashes = row_snapshot('load', snapshot, None, snapshotKey or primaryID)
+        entirePackage = row_snapshot('filter', snapshot, entirePackage,
+                                     snapshotKey or primaryID, hashes=hashes)
+    if debug == True:
+        traceEnd(stage, rows_out=len(entirePackage),
+                 bytes_in=stageSize(csvfile))
+        stageEnd()
+        return entirePackage
+    if primaryID == None and sObject == 'Opportunity' and insert != True:
+        print('Opportunity not uploaded - no primaryID, see insert')
+        traceEnd(stage, bytes_in=stageSize(csvfile))
+        stageEnd()
+        return results
+    # primaryID None - Fn+Ln+Email combo, sf.bulk.<sObject>.insert(data)
+    results = chunk_n_upload(sObject, 500, entirePackage, sfConn,
+                             primaryIDentifier=primaryID,
+                             emailPackage=emailPackage,
+                             concurrency=concurrency)
+
+    traceEnd(stage, rows_out=len(entirePackage), bytes_in=stageSize(csvfile))
+    stageEnd()  # unmap drive
+    if snapshot != None and results != None:
+        row_snapshot('commit', snapshot, entirePackage,
+                     snapshotKey or primaryID, results, hashes)
+    return results
+
+
+def row_snapshot(mode, snapshot, package, keyField, results=None,
+                 hashes=None):
+    '''
+    Change detection for preupload_prep. The snapshot file holds, for every
+    record uploaded successfully, its key (value of keyField) and a hash of
+    the fields that were sent. Records whose hash is unchanged don't need
+    uploading again.
+
+    Mode: 'filter' - returns the records of package (list of dicts as built
+    by preupload_prep) that are new or changed since the snapshot.
+
+    Mode: 'commit' - saves the hash of each record of package whose matching
+    result (results - from chunk_n_upload) was a success. Records that
+    failed keep their old hash so they are sent again next run.
+
+    Mode: 'load' - returns the snapshot's {key: hash} dictionary. Pass it as
+    hashes to 'filter' and 'commit' so the file is only read once.
+
+    keyField can't be None (insert) - there's nothing to match records on.
+    '''
+    if keyField == None:
+        raise ValueError('row_snapshot needs a keyField - snapshotKey or '
+                         'primaryID')
+    if hashes == None:
         try:
-            with open('Q:' + csvfile) as CSV:
-                for row in CSV:
-                    split = row.split(',')  # make list of CSV param
-                    entirePackage.append(
-                        {'Id': split[14],  # check inFile for index of ID
-                         # check inFile for index
-                         'MailingPostalCode': split[5]
-                         }
-                    )
-        except Exception:
-            if emailPackage:  # not None
-                emailalert.alerter(emailPackage, mode='err', to='prim',
-                                   body='Error @ Point: M')
-            if len(entirePackage) != 0:
-                errrow = entirePackage.pop()
-            else:
-                errrow = entirePackage
-            errorLog(p='Point: M', mode=mode, csvfile=csvfile,
-                     primaryID=primaryID, select=select, debug=debug,
-                     row=row, split=split, last_row=errrow,
-                     error=str(sys.exc_info()))
-        if debug == True:
-            mapSourceDestination('unmap_staging')
-            return entirePackage
-        else:
-            chunk_n_upload('Contact', 500, entirePackage, sfConn, primaryID,
-                           emailPackage=emailPackage)
-    elif mode == 'Opportunity':
+            with open(snapshot, 'rb') as f:
+                hashes = pickle.load(f)
+        except FileNotFoundError:
+            hashes = {}
+
+    if mode == 'load':
+        return hashes
+    elif mode == 'filter':
+        return [record for record in package
+                if hashes.get(str(record.get(keyField))) !=
+                recordHash(record)]
+    elif mode == 'commit':
+        for record, result in zip(package, results):
+            if result['success']:
+                hashes[str(record.get(keyField))] = recordHash(record)
+        with open(snapshot + '.tmp', 'wb') as f:
+            pickle.dump(hashes, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(snapshot + '.tmp', snapshot)
+
+
+def recordHash(record):
+    '''
+    16 byte hash of a record (dict) for row_snapshot - same fields and values
+    in any order give the same hash.
+    '''
+    return hashlib.blake2b(json.dumps(record, sort_keys=True, default=str).
+                           encode('utf-8'), digest_size=16).digest()
+
+
+def bulk2_upload(sObject, sfConn, csvfile, mapping, primaryID=None,
+                 maxBytes=100000000, poll=5, source=None, target=None,
+                 user=None, pw=None, emailPackage=None, header=False,
+                 timeout=3600, deadLetter=None):
+    '''
+    Loads a staged, already transformed CSV file into Salesforce via Bulk API
+    2.0 ingest jobs. Rows are streamed from csvfile into CSV uploads with the
+    Salesforce field names as the header row, instead of building a dict per
+    row and JSON encoding them for the bulk API.
+
+    'sObject' - e.g. 'Contact' or 'Opportunity'.
+
+    'mapping' - field mapping, see fieldMaps e.g.
+    {'columns': carparkColumns, 'fields': {'Email': 'Email',
+     'What_s_On__c': ('Whats On', 'int'), 'StageName': {'value': 'Won'}}}
+    The field names are the header row of the uploads.
+
+    'header' - True if csvfile's first row holds column names, see
+    preupload_prep.
+
+    'primaryID' - external ID field to upsert on e.g. 'Email'. None inserts.
+
+    'maxBytes' - Salesforce takes at most 100MB of CSV per ingest job. Rows
+    are split over as many jobs as needed to keep each upload under this.
+
+    'poll' - seconds between job status checks. All jobs are uploaded first,
+    then polled together until every one of them is finished.
+
+    'timeout' - seconds to wait for the jobs to finish. Jobs still running
+    after it are aborted and logged (Point: Y), their rows go to the dead
+    letter file - as do those of a job that ends Failed or Aborted.
+
+    If a job can't be created or uploaded, the parts not sent yet are not
+    sent - the jobs already sent are still polled to the end - and their
+    rows go to the dead letter file. If polling itself fails, the parts of
+    the jobs not known to have finished are kept in staging and logged.
+
+    Records a job failed on are fetched (failedResults). Those that failed
+    with one of retryableErrors (e.g. row locks) are sent again through
+    chunk_n_upload, with its retries. The rest are written to 'deadLetter'
+    - defaults as chunk_n_upload's.
+
+    Returns a list of the final job info of each job e.g.
+    [{'id': '7505D000', 'state': 'JobComplete', 'numberRecordsProcessed':
+    1200, 'numberRecordsFailed': 3, ...}, ...]
+
+    'source', 'target', 'user', 'pw' - these are to call mapSourceDestination
+    '''
+    fields = list(mapping['fields'])
+    headerRow = ','.join(fields) + '\n'
+    parts = []  # staged upload files, one per ingest job
+    jobs = []  # job info, jobs[n] is the job of parts[n]
+    pending = []  # ids of jobs sent and not finished yet
+    failed = []  # (record, errors) - see bulk2Failed
+    stage = traceStart('bulk2_upload.' + sObject)
+    rowsIn = 0
+
+    stageBegin(target, user, pw)
+    try:
+        with stageOpen(csvfile, newline='') as CSV:
+            schema, rows = readCSV(CSV, header)
+            payload = compileFields(mapping, schema['header'])  # once
+            part = None
+            for row in rows:
+                rowsIn += 1
+                record = payload(row)
+                line = ','.join(['' if record[i] == None else
+                                 quoteField(str(record[i]).strip())
+                                 for i in fields]) + '\n'
+                size = len(line.encode('utf-8'))
+                if part == None or written + size > maxBytes:  # new job
+                    if part != None:
+                        part.close()
+                    parts.append(csvfile[:-4] + '_bulk2_' +
+                                 str(len(parts)) + '.csv')
+                    part = stageOpen(parts[-1], 'w', encoding='utf-8',
+                                     newline='')
+                    part.write(headerRow)
+                    written = len(headerRow)
+                part.write(line)
+                written += size
+            if part != None:
+                part.close()
+
+        for n in range(len(parts)):
+            try:
+                jobs.append(bulk2Job(sfConn, sObject, parts[n], primaryID))
+            except Exception:  # send no more, poll the ones already sent
+                if emailPackage:  # not None
+                    emailalert.alerter(emailPackage, mode='err', to='prim',
+                                       body='Error @ Point: Y')
+                errorLog(p='Point: Y', sObject=sObject, csvfile=csvfile,
+                         part=parts[n], error=str(sys.exc_info()))
+                for name in parts[n:]:
+                    failed.extend(bulk2Rows(name, 'NOT_SENT:' +
+                                            str(sys.exc_info()[1])))
+                break
+            finally:
+                stage['api_calls'] += 3  # create, upload, close
+            stage['bytes_out'] += stageSize(parts[n])
+
+        url = sfConn.base_url + 'jobs/ingest/'
+        ids = [job['id'] for job in jobs]  # ids[n] is the job of parts[n]
+        pending = ids[:]
+        deadline = time.time() + timeout
+        while len(pending) != 0:  # poll all jobs until none are running
+            if time.time() > deadline:  # stuck - abort what's left
+                aborted = pending[:]
+                for jobId in aborted:
+                    stage['api_calls'] += 1
+                    info = sfConn.session.patch(
+                        url + jobId, headers=sfConn.headers,
+                        json={'state': 'Aborted'}).json()
+                    jobs[ids.index(jobId)] = info
+                    failed.extend(bulk2Rows(parts[ids.index(jobId)],
+                                            'ABORTED:still running after ' +
+                                            str(timeout) + 's'))
+                    pending.remove(jobId)
+                raise TimeoutError('bulk2 jobs still running after ' +
+                                   str(timeout) + 's, aborted: ' +
+                                   str(aborted))
+            time.sleep(poll)
+            for jobId in pending[:]:
+                stage['api_calls'] += 1
+                response = sfConn.session.get(url + jobId,
+                                              headers=sfConn.headers)
+                response.raise_for_status()
+                info = response.json()
+                if info['state'] == 'JobComplete':
+                    jobs[ids.index(jobId)] = info
+                    pending.remove(jobId)
+                    if info.get('numberRecordsFailed'):
+                        stage['api_calls'] += 1
+                        failed.extend(bulk2Failed(sfConn, jobId))
+                elif info['state'] in ('Failed', 'Aborted'):  # whole job
+                    jobs[ids.index(jobId)] = info
+                    pending.remove(jobId)
+                    failed.extend(bulk2Rows(
+                        parts[ids.index(jobId)], 'JOB_' +
+                        info['state'].upper() + ':' +
+                        str(info.get('errorMessage'))))
+    except Exception:
+        if emailPackage:  # not None
+            emailalert.alerter(emailPackage, mode='err', to='prim',
+                               body='Error @ Point: Y')
+        errorLog(p='Point: Y', sObject=sObject, csvfile=csvfile,
+                 primaryID=primaryID, parts=parts, jobs=jobs,
+                 error=str(sys.exc_info()))
+    finally:
+        traceEnd(stage, rows_in=rowsIn, bytes_in=stageSize(csvfile),
+                 rows_out=sum([j.get('numberRecordsProcessed', 0) -
+                               j.get('numberRecordsFailed', 0)
+                               for j in jobs]))
+        kept = [parts[n] for n in range(len(jobs))
+                if jobs[n]['id'] in pending]  # outcome unknown
+        if len(kept) != 0:
+            errorLog(p='Point: Y', sObject=sObject, csvfile=csvfile,
+                     kept=kept, error='jobs not finished when polling '
+                     'stopped - parts kept: ' + str(pending))
+        for name in parts:  # rows sent, or dead lettered - no longer needed
+            if name not in kept:
+                try:
+                    stageRemove(name)
+                except Exception:
+                    print('part already removed!', sys.exc_info())
+        stageEnd()
+
+    if deadLetter == None:
+        deadLetter = '.\\error_logs\\' + sObject + '_deadletter_' + \
+            dt.today().strftime('%Y%m%d%H%M%S') + '.csv'
+    retry = [record for record, errors in failed
+             if retryable({'errors': errors}, primaryID != None)]
+    dead = [(record, errors) for record, errors in failed
+            if not retryable({'errors': errors}, primaryID != None)]
+    if len(retry) != 0:  # same retries and dead letters as the bulk API
+        chunk_n_upload(sObject, 500, retry, sfConn, primaryID,
+                       emailPackage=emailPackage,
+                       deadLetter=deadLetter[:-4] + '_retried.csv')
+    if len(dead) != 0:
+        deadLetterCSV(deadLetter, [i[0] for i in dead], [i[1] for i in dead])
+        if emailPackage:  # not None
+            emailalert.alerter(emailPackage, mode='err', to='prim',
+                               body=str(len(dead)) + ' ' + sObject +
+                               ' records failed to upload, see ' + deadLetter)
+    return jobs
+
+
+def bulk2Rows(name, error):
+    '''
+    Every row of a staged bulk2_upload part as (record, [error]) - for the
+    dead letter file, when the part's job was never sent or didn't finish.
+    '''
+    with stageOpen(name, newline='', encoding='utf-8') as f:
+        return [(record, [error]) for record in csv.DictReader(f)]
+
+
+def bulk2Failed(sfConn, jobId):
+    '''
+    Failed records of a finished Bulk API 2.0 ingest job, as a list of
+    (record, errors) - record a dict of the fields sent, errors a list of
+    'STATUS_CODE:message' strings as in the sf__Error column.
+    '''
+    response = sfConn.session.get(
+        sfConn.base_url + 'jobs/ingest/' + jobId + '/failedResults/',
+        headers=sfConn.headers)
+    response.raise_for_status()
+    failed = []
+    for row in csv.DictReader(io.StringIO(response.text)):
+        errors = [row.pop('sf__Error', '')]
+        row.pop('sf__Id', None)
+        failed.append((row, errors))
+    return failed
+
+
+def bulk2Job(sfConn, sObject, name, primaryID=None):
+    '''
+    Creates one Bulk API 2.0 ingest job, streams the staged CSV file into it
+    and marks the upload complete so Salesforce starts processing. Returns
+    the job info Salesforce sends back on creation. Raises if any of the
+    calls fail - a job that was created is aborted first.
+    '''
+    url = sfConn.base_url + 'jobs/ingest/'
+    spec = {'object': sObject, 'contentType': 'CSV', 'lineEnding': 'LF',
+            'operation': 'insert'}
+    if primaryID != None:
+        spec['operation'] = 'upsert'
+        spec['externalIdFieldName'] = primaryID
+    response = sfConn.session.post(url, headers=sfConn.headers, json=spec)
+    response.raise_for_status()  # e.g. session expired, API limit
+    job = response.json()
+    csvHeaders = dict(sfConn.headers)
+    csvHeaders['Content-Type'] = 'text/csv'
+    try:
+        with stageOpen(name, 'rb') as data:  # streamed, not read in memory
+            sfConn.session.put(url + job['id'] + '/batches',
+                               headers=csvHeaders,
+                               data=data).raise_for_status()
+        sfConn.session.patch(url + job['id'], headers=sfConn.headers,
+                             json={'state': 'UploadComplete'}
+                             ).raise_for_status()
+    except Exception:  # don't leave an open job behind
         try:
-            with open('Q:' + csvfile) as CSV:
-                for row in CSV:
-                    split = row.split(',')
-                    if select == 'car_park_tickets':
-                        entirePackage.append(
-                            {'Ticket_Number__c': int(split[8]),  # 'Ticket No'
-                             'Park_Date__c': split[0],  # 'Car Park date'
-                             'Pay_Time__c': int(split[11]),  # 'Pay Time'
-                             'Promo_codes__c': split[13],  # 'Promo Code'
-                             'Amount': split[7],  # 'Pay Amount'
-                             'Pay_Date__c': split[10],  # 'Pay Date'
-                             'Car_Park__c': split[1],  # 'Car Park'
-                             # 'TotalOpportunityQuantity': format(int(split[9]), '.2f'), #'Tickets'
-                             'CloseDate': split[10],  # 'Pay Date'
-                             'StageName': 'Closed Won',
-                             'Contact__c': split[14],  # SFID of asso'd Contact
-                             'Name': split[16],
-                             'RecordTypeId': split[17]  # RecordTypeId on Sf
-                             }
-                        )
-                    elif select == 'health_club':
-                        entirePackage.append(
-                            {'Student_DOB__c': split[14],
-                             'Aquatic_Health_Club__c': 1,
-                             'Opportunity_type__c': 'Health Club',
-                             'Start_Date__c': split[4],
-                             'Status__c': split[16],
-                             'Membership_Type__c': split[3],
-                             'Current_Expiry__c': split[24].strip(),
-                             'Last_Visit__c': split[20][:10],  # date only
-                             # null? use ddDate otherwise use Current_Expiry__c
-                             'CloseDate': split[24].strip(),
-                             'StageName': 'Closed Won',
-                             'Contact__c': split[21],
-                             'Name': split[23],
-                             'RecordTypeId': ''  # insert record type e.g. 0125D0000000
-                             }
-                        )
-                    elif select == 'swim_school':
-                        ...  # to be fleshed out
-                    elif select == 'gymnastics':
-                        ...
+            sfConn.session.patch(url + job['id'], headers=sfConn.headers,
+                                 json={'state': 'Aborted'})
         except Exception:
-            if emailPackage:  # not None
-                emailalert.alerter(emailPackage, mode='err', to='prim',
-                                   body='Error @ Point: N')
-            if len(entirePackage) != 0:
-                errrow = entirePackage.pop()
-            else:
-                errrow = entirePackage
-            errorLog(p='Point: N', mode=mode, csvfile=csvfile,
-                     primaryID=primaryID, select=select, debug=debug,
-                     row=row, split=split, last_row=errrow,
-                     error=str(sys.exc_info()))
-        if debug == True:
-            mapSourceDestination('unmap_staging')
-            return entirePackage
-        else:  # todo 11 feb 2020 - need to add clause for when primaryID is None
-            if primaryID == None:
-                ...
-            else:
-                chunk_n_upload('Opportunity', 500, entirePackage,
-                               sfConn, primaryIDentifier=primaryID,
-                               emailPackage=emailPackage)
-
-    mapSourceDestination('unmap_staging')  # unmap drive
+            print('bulk2 job not aborted!', job['id'], sys.exc_info())
+        raise
+    return job
 
 
 def delete_sf_records(mode, obj, sfConn, records, emailPackage=None):
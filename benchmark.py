@@ -0,0 +1,380 @@
+# Author: HZHtat
+# Date: Oct-2026
+# Version 0.1
+'''
+Offline benchmark for ETLJitterbitClone. Generates synthetic SAP car park
+reports and Links all_members_nightly rows (dirty rows included), then runs
+them through the same functions the nightly jobs use - against stand-in
+SQL Server and Salesforce (sfsimulator) backends, so no production system
+is touched.
+
+python benchmark.py                      # 10k, 100k and 1M rows
+python benchmark.py 10000 50000 -o before.json
+python benchmark.py 100000 --latency 0.2 --batch-time 2 --lock-rate 0.01
+
+By default the simulated Salesforce answers instantly, so the numbers are
+the throughput of this code. Give it latency / processing time / lock
+errors to see how uploads behave against something more like a real org.
+
+Each size runs in its own process so peak RSS of one size doesn't carry
+into the next. Every stage records rows, seconds, rows_per_sec,
+peak_rss_kb (high water mark of the process so far, None if it can't be
+measured) and api_calls (Salesforce calls made by the stage). The
+simulator's summary per size is saved too. Results are printed and saved
+as JSON to compare one run (or commit) with the next.
+'''
+
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import ETLJitterbitClone as etl
+import sfsimulator
+import sqlQueries_v4
+
+try:
+    import resource  # not on Windows
+except ImportError:
+    resource = None
+
+defaultSizes = [10000, 100000, 1000000]
+
+# SAP car park report layout - the columns preupload_prep car_park_tickets
+# expects, before any transforms
+carparkHeader = ['Car Park date', 'Car Park', 'First Name', 'Last Name',
+                 'Mobile', 'Post Code', 'Email', 'Pay Amount', 'Ticket No',
+                 'Tickets', 'Pay Date', 'Pay Time', 'Whats On', 'Promo Code']
+carparks = ['North Car Park', 'South Car Park', 'Stadium, Level 2']
+carparkRecordTypeId = '0127F000001HyMzQAK'
+
+# Links all_members_nightly query (sqlQueries_v4.hc) - 20 columns
+membersColLength = 20
+memberProducts = ['M1050', 'M1076', 'M1093', 'M1209', 'M1224', 'M3034']
+
+
+def carpark_rows(n, dirty=0.05, seed=1):
+    '''
+    Yields n rows of a SAP car park report (no header), as lists of strings.
+    Emails repeat - the same guest parks more than once. 'dirty' is the
+    share of rows given the kinds of mess SAP reports have: upper case and
+    padded emails, a quote and comma in a name or promo code.
+    '''
+    rnd = random.Random(seed)
+    start = date(2020, 1, 1)
+    for i in range(n):
+        day = (start + timedelta(days=rnd.randint(0, 365))).strftime('%Y%m%d')
+        email = 'guest' + str(rnd.randint(0, n // 2)) + '@example.com'
+        row = [day, rnd.choice(carparks), 'First' + str(i % 977),
+               'Last' + str(i % 1319), '04' + str(rnd.randint(10000000,
+                                                              99999999)),
+               str(rnd.randint(2000, 2999)), email,
+               '%.2f' % (rnd.randint(300, 4500) / 100), str(10000000 + i),
+               '1', day, '%02d%02d%02d' % (rnd.randint(6, 23),
+                                           rnd.randint(0, 59),
+                                           rnd.randint(0, 59)),
+               str(rnd.randint(0, 9)), '']
+        if rnd.random() < dirty:
+            pick = rnd.randint(0, 2)
+            if pick == 0:
+                row[6] = '  ' + email.upper() + ' '
+            elif pick == 1:
+                row[2] = 'O"Brien, Jnr'
+            else:
+                row[13] = 'PROMO, 50%'
+        yield row
+
+
+def member_rows(n, dirty=0.05, seed=2):
+    '''
+    Yields n rows shaped like the all_members_nightly query, as tuples the
+    way pyodbc returns them (dates as strings - the query CONVERTs them -
+    timestamps as datetimes, NULLs as None). About 1 in 5 CustomerIds is
+    repeated with a different expiry date. 'dirty' rows have one of: a
+    comma in the address, a blank email, a NULL expiry or an extra column
+    (what 'purge' is for).
+    '''
+    rnd = random.Random(seed)
+    start = date(2015, 1, 1)
+    stamp = datetime(2020, 3, 1, 9, 30)
+    for i in range(n):
+        started = start + timedelta(days=rnd.randint(0, 1800))
+        row = [20000000 + rnd.randint(0, int(n * 0.8)), 'Surname' + str(i),
+               'Given' + str(i % 2011), rnd.choice(memberProducts),
+               started.isoformat(),
+               (started + timedelta(days=rnd.randint(30, 720))).isoformat(),
+               str(rnd.randint(1, 300)) + ' Smith St', 'Homebush', 'NSW',
+               '2140', '02' + str(rnd.randint(10000000, 99999999)), None,
+               '04' + str(rnd.randint(10000000, 99999999)),
+               'member' + str(i) + '@example.com',
+               (date(1960, 1, 1) + timedelta(days=rnd.randint(0, 15000))).
+               isoformat(), rnd.choice('MF'), 'ACTIVE',
+               stamp - timedelta(minutes=rnd.randint(0, 100000)),
+               stamp - timedelta(minutes=rnd.randint(0, 100000)),
+               stamp - timedelta(days=rnd.randint(0, 3000))]
+        if rnd.random() < dirty:
+            pick = rnd.randint(0, 3)
+            if pick == 0:
+                row[6] = 'Unit 4, ' + row[6]
+            elif pick == 1:
+                row[13] = ''
+            elif pick == 2:
+                row[5] = None
+            else:
+                row.append('stray')
+        yield tuple(row)
+
+
+# Stand-in backends
+
+
+class StandInCursor:
+    '''
+    Just enough of a pyodbc cursor for pull_SQL_data - rows are handed out
+    by fetchmany as they are generated.
+    '''
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.arraysize = 1
+
+    def execute(self, sql, *params):
+        return self
+
+    def fetchmany(self, size=None):
+        return list(itertools.islice(self.rows, size or self.arraysize))
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        pass
+
+
+class StandInConnection:
+    '''
+    pyodbc connection stand-in. Each cursor() gets a fresh run of rows.
+    '''
+
+    def __init__(self, rows):
+        self.rows = rows  # function returning an iterable of rows
+
+    def cursor(self):
+        return StandInCursor(self.rows())
+
+    def execute(self, sql, *params):  # sql_connection health check
+        return StandInCursor([(1,)])
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Benchmark
+
+
+def peakRSS():
+    '''
+    Peak resident memory of this process so far in KB. Uses psutil on
+    Windows if it is installed, otherwise None.
+    '''
+    if resource != None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak // 1024 if sys.platform == 'darwin' else peak  # bytes
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset // 1024
+    except Exception:
+        return None
+
+
+def stage(results, n, name, sf, fn):
+    '''
+    Runs fn() as one timed stage of n rows, adding its numbers to results.
+    Returns what fn returns.
+    '''
+    calls = len(sf.calls)
+    start = time.perf_counter()
+    out = fn()
+    secs = time.perf_counter() - start
+    results.append({'rows': n, 'stage': name, 'seconds': round(secs, 4),
+                    'rows_per_sec': int(n / secs) if secs > 0 else None,
+                    'peak_rss_kb': peakRSS(),
+                    'api_calls': len(sf.calls) - calls})
+    return out
+
+
+def run_size(n, dirty=0.05, seed=1, quiet=True, sim=None):
+    '''
+    Runs every stage for n rows of each data set in a scratch folder, with
+    staging_area open on local disk. 'sim' - dict of SalesforceSimulator
+    args e.g. {'latency': 0.2}. Returns [stage results, simulator summary].
+    '''
+    results = []
+    work = tempfile.mkdtemp(prefix='bench_')
+    cwd, stdout = os.getcwd(), sys.stdout
+    os.chdir(work)
+    os.makedirs('error_logs', exist_ok=True)
+    if quiet:  # chunk_n_upload prints every chunk
+        sys.stdout = open(os.devnull, 'w')
+    sf = sfsimulator.SalesforceSimulator(seed=seed, **(sim or {}))
+    etl.staging_area('open', 'local', root=os.path.join(work, 'staging'))
+    try:
+        carpark(results, n, dirty, seed, sf)
+        health_club(results, n, dirty, seed, sf)
+    finally:
+        etl.staging_area('close')
+        etl.sql_connection('close_all', None, None, None)
+        if quiet:
+            sys.stdout.close()
+            sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+    return [results, sf.summary()]
+
+
+def carpark(results, n, dirty, seed, sf):
+    '''
+    Car park job - SAP report to Contacts then Opportunities, one
+    transformCSV call per step as the mainline script does it, then the
+    same steps again fused with transformPipeline.
+    '''
+    def generate():
+        with etl.stageOpen('carpark.csv', 'w', newline='') as f:
+            wr = csv.writer(f)
+            wr.writerow(carparkHeader)
+            wr.writerows(carpark_rows(n, dirty, seed))
+        return 'carpark.csv'
+
+    f = stage(results, n, 'carpark.generate', sf, generate)
+    f = stage(results, n, 'carpark.remove_header', sf,
+              lambda: etl.transformCSV('remove_header', f))
+    stage(results, n, 'carpark.preupload_prep.Contact', sf,
+          lambda: etl.preupload_prep('Contact', sf, f, primaryID='Email',
+                                     select='car_park_tickets',
+                                     concurrency=4))
+    emails = stage(results, n, 'carpark.CSV_query.select_col', sf,
+                   lambda: etl.CSV_query('select_col', f, col=6,
+                                         max_size=500))
+    sfids = stage(results, n, 'carpark.query_salesforce.Contact', sf,
+                  lambda: etl.query_salesforce(sf, 'Contact', 'Email',
+                                               array=emails))
+    steps = [
+        ('yyyymmdd_to_yyyy-mm-dd', {'col': (0, 10)}),
+        ('convert_time', {'col': 11}),
+        ('tack_sfid', {'mapping': sfids, 'match': 6}),
+        ('tack_custom_val', {'mapping': 'Closed Won'}),
+        ('concat_n_tack', {'col': ['PK', 8, 0]}),
+        ('tack_custom_val', {'mapping': carparkRecordTypeId})
+    ]
+    tx = f
+    for mode, args in steps:
+        tx = stage(results, n, 'carpark.transformCSV.' + mode, sf,
+                   lambda: etl.transformCSV(mode, tx, **args))
+    stage(results, n, 'carpark.transformPipeline', sf,
+          lambda: etl.transformPipeline(steps, f))
+    stage(results, n, 'carpark.preupload_prep.Opportunity', sf,
+          lambda: etl.preupload_prep('Opportunity', sf, tx,
+                                     primaryID='Ticket_Number__c',
+                                     select='car_park_tickets',
+                                     concurrency=4))
+
+
+def health_club(results, n, dirty, seed, sf):
+    '''
+    Health club nightly job - Links all_members_nightly to Contacts.
+    '''
+    etl.pyodbc.connect = lambda *args, **kwargs: StandInConnection(
+        lambda: member_rows(n, dirty, seed))
+    f = stage(results, n, 'health_club.pull_SQL_data.query_save', sf,
+              lambda: etl.pull_SQL_data(
+                  'query_save', sqlQueries_v4.hc['all_members_nightly'],
+                  'svr', 'db', 'user', 'pw', 'members.csv', False,
+                  'list')[0])
+    f = stage(results, n, 'health_club.transformCSV.purge', sf,
+              lambda: etl.transformCSV('purge', f, colLength=membersColLength,
+                                       purgeUniqueId=0))
+    f = stage(results, n, 'health_club.transformCSV.remove_row_based_on_val',
+              sf, lambda: etl.transformCSV('remove_row_based_on_val', f,
+                                           col=13, match='', mapping=0))
+    f = stage(results, n, 'health_club.transformCSV.de_dupe_remove_old_dates',
+              sf, lambda: etl.transformCSV('de_dupe_remove_old_dates', f,
+                                           col=0, dateCol=5))
+    stage(results, n, 'health_club.preupload_prep.Contact', sf,
+          lambda: etl.preupload_prep('Contact', sf, f,
+                                     primaryID='LINKS_CUSTID__c',
+                                     select='health_club_nomailing',
+                                     concurrency=4))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Offline ETLJitterbitClone '
+                                 'throughput benchmark.')
+    ap.add_argument('sizes', nargs='*', type=int, default=defaultSizes,
+                    help='row counts to run, default 10000 100000 1000000')
+    ap.add_argument('-o', '--out', help='JSON results file, default '
+                    'benchmark_<yyyymmddhhmmss>.json')
+    ap.add_argument('--dirty', type=float, default=0.05,
+                    help='share of dirty rows, default 0.05')
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--latency', type=float, default=0.0,
+                    help='simulated Salesforce seconds per call')
+    ap.add_argument('--batch-time', type=float, default=0.0,
+                    help='simulated seconds per bulk job')
+    ap.add_argument('--record-time', type=float, default=0.0,
+                    help='simulated seconds per record of a bulk job')
+    ap.add_argument('--lock-rate', type=float, default=0.0,
+                    help='simulated row lock error rate, see sfsimulator')
+    ap.add_argument('--daily-limit', type=int, default=None,
+                    help='simulated daily API call limit')
+    ap.add_argument('--inline', action='store_true',
+                    help='run every size in this process')
+    ap.add_argument('--verbose', action='store_true',
+                    help="don't hide what the stages print")
+    args = ap.parse_args(argv)
+    sim = {'latency': args.latency, 'batchTime': args.batch_time,
+           'recordTime': args.record_time, 'lockRate': args.lock_rate,
+           'dailyLimit': args.daily_limit}
+
+    report = {'started': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'platform': platform.platform(), 'dirty': args.dirty,
+              'seed': args.seed, 'simulator': sim, 'results': [],
+              'salesforce': {}}
+    for n in args.sizes:
+        if args.inline:
+            results, summary = run_size(n, args.dirty, args.seed,
+                                        not args.verbose, sim)
+        else:  # fresh process per size - peak RSS is per size
+            ctx = multiprocessing.get_context('spawn')
+            with ctx.Pool(1) as pool:
+                results, summary = pool.apply(run_size, (
+                    n, args.dirty, args.seed, not args.verbose, sim))
+        for r in results:
+            print('{rows:>9} {stage:<56} {seconds:>9.3f}s {rows_per_sec!s:>9}'
+                  ' rows/s {peak_rss_kb!s:>8} KB {api_calls:>6} calls'.
+                  format(**r))
+        report['results'].extend(results)
+        report['salesforce'][str(n)] = summary
+
+    out = args.out or 'benchmark_' + \
+        datetime.now().strftime('%Y%m%d%H%M%S') + '.json'
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('saved', out)
+    return report
+
+
+if __name__ == '__main__':
+    main()
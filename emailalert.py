@@ -2,9 +2,15 @@
 # Date: Jan-2020
 # Version: 0.8
 
+import atexit
+import queue
 import smtplib
+import threading
+import time
 from email.message import EmailMessage
 
+dispatcher = {}  # state of the background alert worker, see start_dispatcher
+
 
 def alerter(emailpackage, mode, to, body):
     '''
@@ -21,6 +27,23 @@ def alerter(emailpackage, mode, to, body):
     'to',
     'body')
     Arg exception is either True or False
+
+    If start_dispatcher has been called, the alert is only queued and this
+    returns straight away - the background worker sends it as part of a
+    digest. Otherwise it is sent there and then over its own connection.
+    '''
+    if dispatcher.get('thread'):  # running - off the hot path
+        dispatcher['queue'].put((emailpackage, mode, to, body))
+        return
+
+    s = smtplib.SMTP(emailpackage[3])  # mailserver
+    s.send_message(buildMessage(emailpackage, mode, to, body))
+    s.quit()
+
+
+def buildMessage(emailpackage, mode, to, body):
+    '''
+    Builds the EmailMessage for alerter. Args as per alerter.
     '''
     msg = EmailMessage()
     msg['From'] = emailpackage[0]
@@ -42,6 +65,120 @@ def alerter(emailpackage, mode, to, body):
     elif mode == 'info':
         msg['Subject'] = emailpackage[2]['info']
 
-    s = smtplib.SMTP(emailpackage[3])  # mailserver
-    s.send_message(msg)
-    s.quit()
+    return msg
+
+
+def start_dispatcher(interval=60, repeatWindow=3600):
+    '''
+    Starts a background worker that sends the alerts alerter queues. Call
+    once at the start of a mainline script - alerts raised inside transform
+    and upload loops then cost a queue put instead of an SMTP handshake.
+
+    'interval' - seconds the worker collects alerts for before sending.
+    Alerts collected are merged into one digest per recipient and mode
+    (severity), e.g. one 'err' email listing every error of the run so far.
+    Digests are all sent over the one SMTP connection per mail server, kept
+    open between sends.
+
+    'repeatWindow' - an alert with the exact same body as one already sent
+    to the same recipient and mode within this many seconds is not sent
+    again. The next digest just says how many repeats were held back.
+
+    stop_dispatcher sends whatever is still queued and is also called
+    automatically on exit.
+    '''
+    if dispatcher.get('thread'):  # already running
+        return
+    dispatcher['queue'] = queue.Queue()
+    dispatcher['interval'] = interval
+    dispatcher['repeatWindow'] = repeatWindow
+    dispatcher['thread'] = threading.Thread(target=dispatch, daemon=True)
+    dispatcher['thread'].start()
+
+
+def stop_dispatcher():
+    '''
+    Sends everything still queued, closes the SMTP connection(s) and stops
+    the worker. Alerts after this are sent straight away again.
+    '''
+    thread = dispatcher.get('thread')
+    if thread:
+        dispatcher['queue'].put(None)  # tells worker to flush and finish
+        thread.join()
+        dispatcher.clear()
+
+
+atexit.register(stop_dispatcher)  # once - does nothing if not running
+
+
+def dispatch():
+    '''
+    Background worker of start_dispatcher. Collects queued alerts for
+    'interval' seconds, then sends them as digests. Never raises - a mail
+    server being down is printed, not allowed to stop the run.
+    '''
+    q = dispatcher['queue']
+    sent = {}  # (group, body): time last sent - for repeatWindow
+    connections = {}  # mailsvr: open smtplib.SMTP
+    stopping = False
+
+    while not stopping:
+        pending = {}  # group: [emailpackage, mode, to, {body: count}, held]
+        deadline = time.time() + dispatcher['interval']
+        while time.time() < deadline:
+            try:
+                item = q.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if item == None:  # stop_dispatcher
+                stopping = True
+                break
+            emailpackage, mode, to, body = item
+            group = (repr(emailpackage), mode, to)
+            if group not in pending:
+                pending[group] = [emailpackage, mode, to, {}, 0]
+            last = sent.get((group, body))
+            if last != None and time.time() - last < \
+                    dispatcher['repeatWindow']:
+                pending[group][4] += 1  # repeat - held back
+            else:
+                bodies = pending[group][3]
+                bodies[body] = bodies.get(body, 0) + 1
+
+        for group in pending:
+            emailpackage, mode, to, bodies, held = pending[group]
+            if len(bodies) == 0 and held == 0:
+                continue
+            lines = []
+            for body in bodies:
+                if bodies[body] > 1:
+                    lines.append(body + ' (x' + str(bodies[body]) + ')')
+                else:
+                    lines.append(body)
+            if held != 0:
+                lines.append(str(held) + ' repeated alert(s) already sent '
+                             'recently were held back.')
+            try:
+                smtp = connections.get(emailpackage[3])
+                if smtp != None:
+                    try:
+                        smtp.noop()  # still connected?
+                    except Exception:
+                        smtp = None
+                if smtp == None:
+                    smtp = smtplib.SMTP(emailpackage[3])
+                    connections[emailpackage[3]] = smtp
+                smtp.send_message(buildMessage(
+                    emailpackage, mode, to, '\n\n'.join(lines)))
+            except Exception as e:
+                connections.pop(emailpackage[3], None)
+                print('alert digest not sent!', mode, to, e)
+                continue  # not sent - not held back next time either
+            for body in bodies:
+                sent[(group, body)] = time.time()
+
+    for svr in connections:
+        try:
+            connections[svr].quit()
+        except Exception:
+            print('smtp already closed!', svr)
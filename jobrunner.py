@@ -0,0 +1,466 @@
+# Author: HZHtat
+# Date: Oct-2026
+# Version 0.1
+'''
+Runs ETLJitterbitClone jobs described in JSON (or YAML, if PyYAML is
+installed) spec files instead of hand-written mainline scripts. Jobs that
+don't depend on each other run at the same time, with a cap on how many
+jobs use a given resource (Salesforce, a SQL server, the Y: source drive)
+at once.
+
+python jobrunner.py jobs/*.json
+python jobrunner.py jobs/carpark.json jobs/health_club.json --workers 4 \\
+    --limit salesforce=1 --limit sql:links=2
+python jobrunner.py jobs/*.json --plan      # print the order, run nothing
+
+A spec file is one integration - a name and its list of jobs:
+
+{"name": "carpark",
+ "jobs": [
+  {"name": "contacts",
+   "source": {"file": "CARPARKSALES_DEV_*.xls", "extension": "csv",
+              "share": "\\\\\\\\sapsvr\\\\reports"},
+   "transform": [["remove_header", {}]],
+   "target": {"sObject": "Contact", "primaryID": "Email",
+              "select": "car_park_tickets"}},
+  {"name": "opportunities",
+   "source": {"job": "contacts"},
+   "transform": [
+    ["yyyymmdd_to_yyyy-mm-dd", {"col": [0, 10]}],
+    ["tack_sfid", {"match": 6, "mapping": {"lookup": {
+        "sObject": "Contact", "field": "Email", "col": 6}}}]],
+   "target": {"sObject": "Opportunity", "primaryID": "Ticket_Number__c",
+              "select": "car_park_tickets"}}]}
+
+Job names are qualified with the integration's, e.g. 'carpark.contacts'.
+Within a file a job can refer to another by its short name.
+
+'source' - one of:
+    {"file": pattern, "extension": "csv", "share": UNC} - newest report
+    matching pattern on the share, see lastModifiedFile.
+    {"sql": query, "connection": "links", "file": "members.csv"} - query
+    is SQL or the name of one in sqlQueries_v4 e.g.
+    "hc.all_members_nightly". See pull_SQL_data 'query_save'.
+    {"job": name} - the transformed file of another job.
+    {"staged": name} - a file already in staging.
+
+'transform' - list of [mode, args] steps, run in one pass with
+transformPipeline. An arg given as {"lookup": {"sObject": "Contact",
+"field": "Email", "col": 6}} is replaced, when the job runs, by the
+field to Id dictionary query_salesforce returns for the values in column
+col of the job's source file - e.g. the SFIDs tack_sfid needs.
+
+'target' - args for preupload_prep: sObject (its mode, unless "mode" is
+given), primaryID, select, api, concurrency, snapshot, snapshotKey. A
+new venue needs no code - give the field mapping in the spec instead of
+a select, e.g. for a file with a header row:
+    "target": {"sObject": "Contact", "primaryID": "Email", "header": true,
+               "mapping": {"fields": {"Email": "Email",
+                                      "FirstName": "Given",
+                                      "Level__c": ["Level", "int"],
+                                      "Venue__c": {"value": "Gymnastics"}}}}
+See fieldMaps in ETLJitterbitClone.
+
+'needs' - optional list of jobs that have to finish first. Also worked
+out from the spec:
+    - a {"job": name} source needs that job.
+    - a lookup on an sObject needs the jobs in the same integration that
+    upload to it.
+    - a job uploading to an sObject needs the jobs in the same integration
+    that upload to its parents (sObjectParents) - Contacts before
+    Opportunities.
+
+'resources' - optional extra resource names the job holds while it
+runs. Jobs uploading or looking up hold 'salesforce', SQL sources hold
+'sql:<connection>' and file sources hold 'source_drive' (the one Y:
+drive - limit 1). Limits are per resource, see defaultLimits. A resource
+with no limit is only limited by workers.
+
+A job that fails is logged and alerted (Point: AF) and the jobs that
+need it are skipped. A job fails on an exception, a source, transform or
+upload that logged an error (see etl.errorLogged), a lookup that
+query_salesforce couldn't do, or any record or ingest job that failed to
+upload (see uploadFailures). Everything else carries on.
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime as dt
+from graphlib import TopologicalSorter, CycleError
+
+import ETLJitterbitClone as etl
+import emailalert
+import sqlQueries_v4
+
+try:
+    import yaml  # optional - only for .yml/.yaml specs
+except ImportError:
+    yaml = None
+
+# sObject: sObjects its records point to - uploaded first, see job_graph
+sObjectParents = {'Contact': ['Account'],
+                  'Opportunity': ['Account', 'Contact'],
+                  'Case': ['Account', 'Contact']}
+defaultLimits = {'salesforce': 2, 'source_drive': 1}
+jobKeys = ['name', 'source', 'transform', 'target', 'needs', 'resources']
+
+
+def load_jobs(paths):
+    '''
+    Reads spec files (see top of file) and returns a dictionary of
+    qualified job name: job, in the order read. Each job gets 'integration'
+    (the spec's name) and its 'needs' qualified. Raises ValueError for a
+    spec that doesn't make sense e.g. a job without a source, so nothing
+    runs from a bad spec.
+    '''
+    jobs = {}
+    for path in paths:
+        with open(path) as f:
+            if path.endswith(('.yml', '.yaml')):
+                if yaml == None:
+                    raise ValueError(path + ': pip install pyyaml for YAML '
+                                     'specs, or use JSON')
+                spec = yaml.safe_load(f)
+            else:
+                spec = json.load(f)
+        integration = spec.get('name') or \
+            os.path.splitext(os.path.basename(path))[0]
+        for job in spec.get('jobs', []):
+            unknown = [i for i in job if i not in jobKeys]
+            if unknown:
+                raise ValueError(path + ': unknown key(s) ' + str(unknown) +
+                                 ' in job ' + str(job.get('name')))
+            if 'name' not in job or 'source' not in job:
+                raise ValueError(path + ': every job needs a name and a '
+                                 'source - ' + str(job))
+            job = dict(job, integration=integration,
+                       name=qualify(integration, job['name']))
+            if job['name'] in jobs:
+                raise ValueError(path + ': job ' + job['name'] +
+                                 ' defined twice')
+            job['needs'] = [qualify(integration, i)
+                            for i in job.get('needs', [])]
+            if 'job' in job['source']:
+                job['source'] = dict(job['source'], job=qualify(
+                    integration, job['source']['job']))
+            jobs[job['name']] = job
+    job_graph(jobs)  # unknown needs, cycles
+    return jobs
+
+
+def qualify(integration, name):
+    '''
+    'contacts' of integration 'carpark' is 'carpark.contacts'. Names
+    that already have a '.' are left alone - jobs of other integrations.
+    '''
+    return name if '.' in name else integration + '.' + name
+
+
+def job_graph(jobs):
+    '''
+    Returns {job name: set of job names it needs} - explicit needs plus
+    those worked out from the spec (see top of file). Raises ValueError for
+    a need that is not a job, or jobs that need each other.
+    '''
+    uploads = {}  # (integration, sObject): [job names]
+    for name in jobs:
+        job = jobs[name]
+        if 'target' in job:
+            uploads.setdefault((job['integration'], job['target']['sObject']),
+                               []).append(name)
+
+    graph = {}
+    for name in jobs:
+        job = jobs[name]
+        needs = set(job['needs'])
+        if 'job' in job['source']:
+            needs.add(job['source']['job'])
+        sObjects = [i['sObject'] for i in lookups(job)]
+        if 'target' in job:
+            sObjects += sObjectParents.get(job['target']['sObject'], [])
+        for sObject in sObjects:
+            needs.update(uploads.get((job['integration'], sObject), []))
+        needs.discard(name)  # e.g. Contacts job looking up Contacts
+        for i in needs:
+            if i not in jobs:
+                raise ValueError(name + ' needs ' + i + ' - no such job')
+        graph[name] = needs
+    try:
+        TopologicalSorter(graph).prepare()
+    except CycleError as e:
+        raise ValueError('jobs need each other: ' + ' -> '.join(e.args[1]))
+    return graph
+
+
+def lookups(job):
+    '''
+    The {"lookup": {...}} args of a job's transform steps.
+    '''
+    found = []
+    for mode, args in job.get('transform', []):
+        for i in args.values():
+            if isinstance(i, dict) and 'lookup' in i:
+                found.append(i['lookup'])
+    return found
+
+
+def job_resources(job):
+    '''
+    Resources a job holds while it runs - see top of file.
+    '''
+    held = set(job.get('resources', []))
+    if 'target' in job or lookups(job):
+        held.add('salesforce')
+    if 'sql' in job['source']:
+        held.add('sql:' + job['source'].get('connection', 'links'))
+    if 'file' in job['source'] and 'sql' not in job['source']:
+        held.add('source_drive')
+    return held
+
+
+def plan(jobs):
+    '''
+    Returns the jobs in waves - every job of a wave only needs jobs of
+    earlier waves, so a wave can run at the same time (resources allowing).
+    '''
+    ts = TopologicalSorter(job_graph(jobs))
+    ts.prepare()
+    waves = []
+    while ts.is_active():
+        wave = sorted(ts.get_ready())
+        waves.append(wave)
+        ts.done(*wave)
+    return waves
+
+
+def run_jobs(jobs, sfConn=None, connections=None, limits=None, workers=4,
+             staging=None, emailPackage=None):
+    '''
+    Runs jobs (from load_jobs) in dependency order, up to 'workers' at a
+    time and no more than limits[resource] holding a resource at a time.
+    Returns {job name: {'status': 'done' | 'failed' | 'skipped', 'file':
+    transformed file, 'seconds': n, 'error': str or None}}.
+
+    'sfConn' - Salesforce connection. Made from ETLJitterbitClone's
+    sfUname, sfPW and sfToken when not given.
+
+    'connections' - {name: {'server':, 'db':, 'user':, 'pw':}} for SQL
+    sources. 'links' defaults to ETLJitterbitClone's linksDB settings.
+
+    'limits' - {resource: max jobs at once}, on top of defaultLimits.
+
+    'staging' - args for staging_area 'open' e.g. {'backend': 'tmpfs'}.
+    Staging is opened once for the run (jobs running at the same time
+    can't each map and unmap Q:), unless already open. Default 'local'.
+    '''
+    limits = dict(defaultLimits, **(limits or {}))
+    connections = dict({'links': {'server': etl.linksDBsvr,
+                                  'db': etl.linksDB,
+                                  'user': etl.linksDBUName,
+                                  'pw': etl.linksDBUNamePw}},
+                       **(connections or {}))
+    if sfConn == None and any('salesforce' in job_resources(jobs[i])
+                              for i in jobs):
+        sfConn = etl.sf_connection_obj(etl.sfUname, etl.sfPW, etl.sfToken)
+    opened = not etl.staging
+    if opened:
+        etl.staging_area('open', emailPackage=emailPackage,
+                         **(staging or {'backend': 'local'}))
+
+    graph = job_graph(jobs)
+    ts = TopologicalSorter(graph)
+    ts.prepare()
+    results = {}
+    ready = []  # waiting on a worker or a resource
+    running = {}  # future: job name
+    inUse = {}  # resource: jobs holding it
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while ts.is_active():
+                for name in ts.get_ready():
+                    failed = [i for i in sorted(graph[name])
+                              if results[i]['status'] != 'done']
+                    if failed:  # don't run on a failed job's output
+                        results[name] = {'status': 'skipped', 'file': None,
+                                         'seconds': 0, 'error': 'needs ' +
+                                         ', '.join(failed)}
+                        ts.done(name)
+                    else:
+                        ready.append(name)
+                for name in list(ready):
+                    held = job_resources(jobs[name])
+                    if len(running) < workers and all(
+                            inUse.get(i, 0) < max(1, limits.get(i, workers))
+                            for i in held):
+                        for i in held:
+                            inUse[i] = inUse.get(i, 0) + 1
+                        ready.remove(name)
+                        running[pool.submit(run_job, jobs[name], results,
+                                            sfConn, connections,
+                                            emailPackage)] = name
+                if not running:  # only skips this time round
+                    continue
+                finished = wait(running, return_when=FIRST_COMPLETED)[0]
+                for future in finished:
+                    name = running.pop(future)
+                    for i in job_resources(jobs[name]):
+                        inUse[i] -= 1
+                    results[name] = future.result()
+                    ts.done(name)
+    finally:
+        if opened:
+            etl.staging_area('close', emailPackage=emailPackage)
+    return results
+
+
+def run_job(job, results, sfConn, connections, emailPackage=None):
+    '''
+    Runs one job: source, transform, target. Returns its entry of the
+    results of run_jobs. Never raises - a failure is logged, alerted and
+    returned as 'failed'.
+    '''
+    started = time.time()
+    stage = etl.traceStart('job.' + job['name'])
+    f = None
+    try:
+        logged = getattr(etl.errorLogged, 'count', 0)
+        source = job['source']
+        if 'job' in source:
+            f = results[source['job']]['file']
+        elif 'staged' in source:
+            f = source['staged']
+        elif 'sql' in source:
+            query = source['sql']
+            if ' ' not in query:  # name of one in sqlQueries_v4 e.g. hc.x
+                group, key = query.split('.', 1)
+                query = getattr(sqlQueries_v4, group)[key]
+            c = connections[source.get('connection', 'links')]
+            f = etl.pull_SQL_data('query_save', query, c['server'], c['db'],
+                                  c['user'], c['pw'], source['file'], False,
+                                  'list', emailPackage=emailPackage)[0]
+        elif 'file' in source:
+            f = etl.lastModifiedFile(source['file'], source.get('extension'),
+                                     source=source.get('share'),
+                                     user=etl.uName, pw=etl.uPw,
+                                     emailPackage=emailPackage)
+        if not f:
+            raise RuntimeError('no source file for ' + str(source))
+        if getattr(etl.errorLogged, 'count', 0) != logged:
+            raise RuntimeError('error getting source ' + str(source) +
+                               ' - see error log')
+
+        steps = [(mode, resolveArgs(args, f, sfConn, emailPackage))
+                 for mode, args in job.get('transform', [])]
+        if steps:
+            f = etl.transformPipeline(steps, f, emailPackage=emailPackage)
+            if not f or getattr(etl.errorLogged, 'count', 0) != logged:
+                raise RuntimeError('transform failed - see error log')
+
+        if 'target' in job:
+            target = dict(job['target'])
+            mode = target.pop('mode', None) or target['sObject']
+            target.pop('sObject')
+            uploaded = etl.preupload_prep(mode, sfConn, f,
+                                          emailPackage=emailPackage, **target)
+            if getattr(etl.errorLogged, 'count', 0) != logged:
+                raise RuntimeError('upload failed - see error log')
+            failed = uploadFailures(uploaded)
+            if failed:
+                raise RuntimeError(str(failed) + ' record(s) or job(s) '
+                                   'failed to upload - see dead letter file')
+        result = {'status': 'done', 'file': f, 'error': None}
+    except Exception:
+        if emailPackage:  # not None
+            emailalert.alerter(emailPackage, mode='err', to='prim',
+                               body='Error @ Point: AF - job ' + job['name'])
+        etl.errorLog(p='Point: AF', job=job['name'], file=f,
+                     error=str(sys.exc_info()))
+        result = {'status': 'failed', 'file': f,
+                  'error': str(sys.exc_info()[1])}
+    etl.traceEnd(stage)
+    result['seconds'] = round(time.time() - started, 3)
+    return result
+
+
+def uploadFailures(uploaded):
+    '''
+    Number of failures in what preupload_prep returned - per record results
+    with success False (bulk API), or ingest jobs that didn't end
+    JobComplete (api 'bulk2'). None (nothing uploaded) is 0.
+    '''
+    return len([i for i in uploaded or []
+                if i.get('success') == False or
+                i.get('state') not in (None, 'JobComplete')])
+
+
+def resolveArgs(args, f, sfConn, emailPackage=None):
+    '''
+    Copy of a transform step's args with any {"lookup": {...}} replaced by
+    the field to Id dictionary from query_salesforce, for the values in
+    column 'col' of f. Lists become tuples where a mode wants col=(0, 10).
+    '''
+    resolved = {}
+    for key in args:
+        value = args[key]
+        if isinstance(value, dict) and 'lookup' in value:
+            lookup = value['lookup']
+            values = etl.CSV_query('select_col', f, col=lookup['col'],
+                                   max_size=lookup.get('batch', 500))
+            value = etl.query_salesforce(sfConn, lookup['sObject'],
+                                         lookup['field'], array=values,
+                                         emailPackage=emailPackage)
+            if value == None:
+                raise RuntimeError('lookup failed: ' + str(lookup))
+        elif isinstance(value, list) and key == 'col' and \
+                all(isinstance(i, int) for i in value):
+            value = tuple(value)
+        resolved[key] = value
+    return resolved
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Runs ETLJitterbitClone job '
+                                 'spec files.')
+    ap.add_argument('specs', nargs='+', help='JSON or YAML spec files')
+    ap.add_argument('--workers', type=int, default=4,
+                    help='jobs running at once, default 4')
+    ap.add_argument('--limit', action='append', default=[],
+                    metavar='RESOURCE=N', help='e.g. salesforce=1, '
+                    'sql:links=2 - can be given more than once')
+    ap.add_argument('--staging', default='local',
+                    help='staging_area backend, default local')
+    ap.add_argument('--plan', action='store_true',
+                    help='print the order jobs would run in and stop')
+    args = ap.parse_args(argv)
+
+    jobs = load_jobs(args.specs)
+    if args.plan:
+        for i, wave in enumerate(plan(jobs)):
+            print(i + 1, ', '.join(
+                name + ' [' + ', '.join(sorted(job_resources(jobs[name]))) +
+                ']' for name in wave))
+        return
+    limits = {}
+    for i in args.limit:
+        resource, n = i.rsplit('=', 1)
+        limits[resource] = int(n)
+
+    started = dt.today()
+    results = run_jobs(jobs, limits=limits, workers=args.workers,
+                       staging={'backend': args.staging})
+    for name in results:
+        r = results[name]
+        print('{0:<40} {status:<8} {seconds:>9}s {file!s:<30} {error!s}'.
+              format(name, **r))
+    print('ran', len(results), 'jobs in',
+          round((dt.today() - started).total_seconds(), 1), 's')
+    if any(results[i]['status'] != 'done' for i in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,522 @@
+# Author: HZHtat
+# Date: Oct-2026
+# Version 0.1
+'''
+Local stand-in for the parts of Salesforce ETLJitterbitClone talks to, so
+chunk_n_upload, query_salesforce, delete_sf_records and bulk2_upload can be
+run and tuned on a laptop. Pass a SalesforceSimulator wherever a
+simple_salesforce.Salesforce connection goes:
+
+sf = sfsimulator.SalesforceSimulator(latency=0.2, batchTime=2,
+                                     lockRate=0.01, dailyLimit=15000)
+sf.load('Contact', [{'Email': 'a@b.com', 'LastName': 'B'}, ...])
+results = ETLJitterbitClone.chunk_n_upload('Contact', 500, package, sf,
+                                           'Email', concurrency=8)
+print(sf.summary())
+
+What is simulated:
+- REST query / query_more / query_all - SOQL of the shapes the repo sends
+  (SELECT fields FROM sObject [WHERE field IN (...) | LIKE '..' | = '..' |
+  >= > <= < value]), paged pageSize records at a time. Records carry a
+  SystemModstamp, set on every change, so incremental syncs (sfid_index)
+  work too.
+- bulk (sf.bulk.Contact.insert / upsert / update / delete / hard_delete) -
+  each call is one bulk job taking batchTime + recordTime per record.
+- Bulk API 2.0 ingest jobs (session.post / put / patch / get on base_url +
+  'jobs/ingest/') as used by bulk2_upload.
+
+'latency' - seconds added to every call (network round trip).
+
+'lockRate' - chance a record fails with UNABLE_TO_LOCK_ROW for every other
+bulk job running on the same sObject at the same time. One job at a time
+never hits a lock - lock errors come with concurrency, as on a real org.
+
+'dailyLimit' - API calls allowed before every call fails with
+REQUEST_LIMIT_EXCEEDED. None for no limit.
+
+Every call is recorded in calls, see summary.
+'''
+
+import csv
+import io
+import operator
+import random
+import threading
+import time
+
+lockError = {'statusCode': 'UNABLE_TO_LOCK_ROW', 'fields': [],
+             'message': 'unable to obtain exclusive access to this record'}
+idPrefixes = {'Contact': '003', 'Opportunity': '006', 'Account': '001'}
+rangeOps = {'>=': operator.ge, '>': operator.gt, '<=': operator.le,
+            '<': operator.lt}  # WHERE field >= value etc, see select
+
+
+def normKey(value):
+    '''
+    Field value as compared by the simulator - stripped, lower case string.
+    '''
+    return '' if value == None else str(value).strip().lower()
+
+
+def rangeKey(value):
+    '''
+    Field value as compared by >=, >, <= and < - a datetime (SOQL literal
+    2020-03-13T00:00:00Z or stored 2020-03-13T00:00:00.000+0000) to the
+    second as an ISO string, a number as a float, anything else as normKey.
+    '''
+    value = normKey(value).strip("'")
+    if len(value) >= 19 and value[10:11] == 't':
+        return value[:19]
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def modstamp():
+    '''
+    Now as Salesforce formats SystemModstamp, UTC.
+    '''
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000+0000', time.gmtime())
+
+
+class SalesforceSimulatorError(Exception):
+    '''
+    Raised for calls Salesforce would refuse e.g. REQUEST_LIMIT_EXCEEDED,
+    MALFORMED_QUERY.
+    '''
+
+
+class SalesforceSimulator:
+
+    def __init__(self, latency=0.0, batchTime=0.0, recordTime=0.0,
+                 lockRate=0.0, dailyLimit=None, pageSize=2000, seed=None):
+        self.latency = latency
+        self.batchTime = batchTime
+        self.recordTime = recordTime
+        self.lockRate = lockRate
+        self.dailyLimit = dailyLimit
+        self.pageSize = pageSize
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.records = {}  # sObject: {Id: record}
+        self.indexes = {}  # (sObject, field): {normKey(value): [Id, ...]}
+        self.pages = {}  # nextRecordsUrl: records still to be returned
+        self.jobs = {}  # Bulk API 2.0 ingest jobs by id
+        self.inFlight = {}  # sObject: bulk jobs running now
+        self.calls = []  # one dict per call, see summary
+        self.apiUsed = 0
+        self.lastId = 0
+        # as per simple_salesforce.Salesforce, for bulk2_upload
+        self.base_url = 'https://simulated.my.salesforce.com/services/' \
+            'data/v52.0/'
+        self.headers = {'Content-Type': 'application/json',
+                        'Authorization': 'Bearer simulated'}
+        self.bulk = SimulatedBulk(self)
+        self.session = SimulatedSession(self)
+
+    # org data
+
+    def load(self, sObject, records):
+        '''
+        Seeds the org with records (dicts) without counting any API calls.
+        Returns the new Ids.
+        '''
+        with self.lock:
+            return [self.create(sObject, record) for record in records]
+
+    def create(self, sObject, record):
+        '''
+        Adds a new record. Called with self.lock held.
+        '''
+        self.lastId += 1
+        sfid = idPrefixes.get(sObject, 'a00') + str(self.lastId).zfill(12)
+        self.records.setdefault(sObject, {})[sfid] = dict(
+            record, Id=sfid, IsDeleted=False, SystemModstamp=modstamp())
+        self.reindex(sObject, sfid, None, record)
+        return sfid
+
+    def index(self, sObject, field):
+        '''
+        Lookup of field's (normKey'd) values to Ids, built the first time
+        it is needed and kept up to date after. Called with self.lock held.
+        '''
+        idx = self.indexes.get((sObject, field))
+        if idx == None:
+            idx = self.indexes[(sObject, field)] = {}
+            stored = self.records.get(sObject, {})
+            for sfid in stored:
+                idx.setdefault(normKey(stored[sfid].get(field)),
+                               []).append(sfid)
+        return idx
+
+    def reindex(self, sObject, sfid, old, new):
+        '''
+        Moves sfid in every index of sObject from the values in old (a
+        record or None) to those in new (a record or None).
+        '''
+        for (o, field), idx in self.indexes.items():
+            if o != sObject:
+                continue
+            if old != None and (new == None or field in new):
+                ids = idx.get(normKey(old.get(field)), [])
+                if sfid in ids:
+                    ids.remove(sfid)
+            if new != None and (old == None or field in new):
+                idx.setdefault(normKey(new.get(field)), []).append(sfid)
+
+    # call accounting
+
+    def call(self, endpoint, sObject=None, records=0):
+        '''
+        Every simulated call starts here - counts it against dailyLimit,
+        waits latency and records it. Returns the call's record (a dict)
+        for the caller to finish off.
+        '''
+        with self.lock:
+            self.apiUsed += 1
+            over = self.dailyLimit != None and self.apiUsed > self.dailyLimit
+            entry = {'endpoint': endpoint, 'sObject': sObject,
+                     'records': records, 'started': time.time(),
+                     'seconds': None, 'failed': 0, 'error': None}
+            self.calls.append(entry)
+        if self.latency:
+            time.sleep(self.latency)
+        if over:
+            entry['error'] = 'REQUEST_LIMIT_EXCEEDED'
+            entry['seconds'] = time.time() - entry['started']
+            raise SalesforceSimulatorError(
+                'REQUEST_LIMIT_EXCEEDED: TotalRequests Limit exceeded.')
+        return entry
+
+    def summary(self):
+        '''
+        Totals of the calls made so far, per endpoint e.g.
+        {'calls': 42, 'apiUsed': 42, 'records': 20000, 'failed': 31,
+         'endpoints': {'bulk.upsert': {'calls': 40, 'records': 20000,
+                                       'failed': 31, 'seconds': 81.2}, ...}}
+        '''
+        endpoints = {}
+        for entry in list(self.calls):
+            e = endpoints.setdefault(entry['endpoint'], {
+                'calls': 0, 'records': 0, 'failed': 0, 'errors': 0,
+                'seconds': 0.0})
+            e['calls'] += 1
+            e['records'] += entry['records']
+            e['failed'] += entry['failed']
+            e['errors'] += entry['error'] != None
+            e['seconds'] += entry['seconds'] or 0
+        return {'calls': len(self.calls), 'apiUsed': self.apiUsed,
+                'records': sum(e['records'] for e in endpoints.values()),
+                'failed': sum(e['failed'] for e in endpoints.values()),
+                'endpoints': endpoints}
+
+    # REST query
+
+    def query(self, query, include_deleted=False, **kwargs):
+        entry = self.call('query_all' if include_deleted else 'query')
+        found = self.select(query, include_deleted)
+        entry['records'] = min(len(found), self.pageSize)
+        entry['seconds'] = time.time() - entry['started']
+        return self.page(found)
+
+    def query_all(self, query, **kwargs):
+        return self.query(query, include_deleted=True)
+
+    def query_more(self, next_records_identifier, identifier_is_url=False,
+                   **kwargs):
+        entry = self.call('query_more')
+        with self.lock:
+            found = self.pages.pop(next_records_identifier, None)
+        if found == None:
+            entry['error'] = 'INVALID_QUERY_LOCATOR'
+            raise SalesforceSimulatorError('INVALID_QUERY_LOCATOR')
+        entry['records'] = min(len(found), self.pageSize)
+        entry['seconds'] = time.time() - entry['started']
+        return self.page(found)
+
+    def page(self, found):
+        result = {'totalSize': len(found), 'done': True,
+                  'records': found[:self.pageSize]}
+        if len(found) > self.pageSize:
+            with self.lock:
+                url = '/services/data/v52.0/query/01gSIM' + \
+                    str(len(self.pages)) + '-' + str(self.random.randint(
+                        0, 99999))
+                self.pages[url] = found[self.pageSize:]
+            result['done'] = False
+            result['nextRecordsUrl'] = url
+        return result
+
+    def select(self, query, include_deleted=False):
+        '''
+        Runs the SOQL the repo sends: SELECT fields FROM sObject with an
+        optional WHERE field IN (...), LIKE '...', = '...' or a range i.e.
+        >=, >, <= or < a value (datetime, number or string - see rangeKey).
+        Comparisons ignore case, as SOQL does.
+        '''
+        op = None  # no WHERE
+        try:
+            head, rest = query.split(' FROM ', 1)
+            fields = [i.strip() for i in
+                      head.strip()[len('SELECT '):].split(',')]
+            rest = rest.strip().split(None, 1)
+            sObject = rest[0]
+            where = rest[1].strip() if len(rest) > 1 else ''
+            test = lambda value: True
+            if where.upper().startswith('WHERE '):
+                field, op, value = where[6:].strip().split(None, 2)
+                if op.upper() == 'IN':
+                    wanted = set(normKey(i.strip().strip("'")) for i in
+                                 value.strip()[1:-1].split(','))
+                    test = lambda v: normKey(v) in wanted
+                elif op.upper() == 'LIKE':
+                    prefix = value.strip().strip("'").lower()
+                    prefix = prefix[:-1] if prefix.endswith('%') else prefix
+                    test = lambda v: str(v).lower().startswith(prefix)
+                elif op == '=':
+                    wanted = normKey(value.strip().strip("'"))
+                    test = lambda v: normKey(v) == wanted
+                elif op in rangeOps:
+                    bound, compare = rangeKey(value), rangeOps[op]
+                    test = lambda v: v != None and type(rangeKey(v)) == \
+                        type(bound) and compare(rangeKey(v), bound)
+                else:
+                    raise ValueError(op)
+            else:
+                field = 'Id'
+        except Exception:
+            raise SalesforceSimulatorError('MALFORMED_QUERY: ' + query)
+        with self.lock:
+            stored = self.records.get(sObject, {})
+            if op != None and op.upper() in ('IN', '='):  # indexed
+                if op == '=':
+                    wanted = [wanted]
+                idx = self.index(sObject, field)
+                stored = [stored[i] for key in wanted for i in
+                          idx.get(key, [])]
+            else:
+                stored = list(stored.values())
+        return [{f: record.get(f) for f in fields} for record in stored
+                if (include_deleted or not record['IsDeleted']) and
+                test(record.get(field))]
+
+    # bulk
+
+    def bulkJob(self, endpoint, sObject, operation, records, extId=None):
+        '''
+        One bulk API job - sf.bulk.<sObject>.<operation>(records). Takes
+        batchTime + recordTime per record while counting as in flight on
+        sObject, then returns per record results as simple_salesforce does.
+        '''
+        entry = self.call(endpoint, sObject, len(records))
+        with self.lock:
+            self.inFlight[sObject] = self.inFlight.get(sObject, 0) + 1
+        try:
+            time.sleep(self.batchTime + self.recordTime * len(records))
+            with self.lock:
+                others = self.inFlight[sObject] - 1  # contending jobs
+                results = [self.apply(sObject, operation, record, extId,
+                                      others) for record in records]
+        finally:
+            with self.lock:
+                self.inFlight[sObject] -= 1
+        entry['failed'] = len([i for i in results if not i['success']])
+        entry['seconds'] = time.time() - entry['started']
+        return results
+
+    def apply(self, sObject, operation, record, extId=None, others=0):
+        '''
+        Applies one record of a bulk job. Called with self.lock held.
+        '''
+        if others and self.random.random() < self.lockRate * others:
+            return {'success': False, 'created': False, 'id': None,
+                    'errors': [dict(lockError)]}
+        stored = self.records.setdefault(sObject, {})
+        if operation == 'insert':
+            return {'success': True, 'created': True, 'errors': [],
+                    'id': self.create(sObject, record)}
+        if operation == 'upsert':
+            for sfid in self.index(sObject, extId).get(
+                    normKey(record.get(extId)), []):
+                if not stored[sfid]['IsDeleted']:
+                    self.reindex(sObject, sfid, stored[sfid], record)
+                    stored[sfid].update(record, SystemModstamp=modstamp())
+                    return {'success': True, 'created': False, 'id': sfid,
+                            'errors': []}
+            return {'success': True, 'created': True, 'errors': [],
+                    'id': self.create(sObject, record)}
+        sfid = record.get('Id')
+        if sfid not in stored:
+            return {'success': False, 'created': False, 'id': sfid,
+                    'errors': [{'statusCode': 'ENTITY_IS_DELETED',
+                                'message': 'entity is deleted',
+                                'fields': []}]}
+        if operation == 'update':
+            self.reindex(sObject, sfid, stored[sfid], record)
+            stored[sfid].update(record, SystemModstamp=modstamp())
+        elif operation == 'delete':
+            stored[sfid].update(IsDeleted=True, SystemModstamp=modstamp())
+        elif operation == 'hard_delete':
+            self.reindex(sObject, sfid, stored[sfid], None)
+            del stored[sfid]
+        return {'success': True, 'created': False, 'id': sfid, 'errors': []}
+
+
+class SimulatedBulk:
+    '''
+    sf.bulk of SalesforceSimulator - sf.bulk.Contact is a SimulatedBulkType.
+    '''
+
+    def __init__(self, sim):
+        self.sim = sim
+
+    def __getattr__(self, sObject):
+        return SimulatedBulkType(self.sim, sObject)
+
+
+class SimulatedBulkType:
+
+    def __init__(self, sim, sObject):
+        self.sim = sim
+        self.sObject = sObject
+
+    def insert(self, data, **kwargs):
+        return self.sim.bulkJob('bulk.insert', self.sObject, 'insert', data)
+
+    def upsert(self, data, external_id_field, **kwargs):
+        return self.sim.bulkJob('bulk.upsert', self.sObject, 'upsert', data,
+                                external_id_field)
+
+    def update(self, data, **kwargs):
+        return self.sim.bulkJob('bulk.update', self.sObject, 'update', data)
+
+    def delete(self, data, **kwargs):
+        return self.sim.bulkJob('bulk.delete', self.sObject, 'delete', data)
+
+    def hard_delete(self, data, **kwargs):
+        return self.sim.bulkJob('bulk.hard_delete', self.sObject,
+                                'hard_delete', data)
+
+
+class SimulatedResponse:
+    '''
+    What requests would return - json(), text, status_code,
+    raise_for_status().
+    '''
+
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.text = body if type(body) == str else None
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise SalesforceSimulatorError(str(self.status_code) + ' ' +
+                                           str(self.body))
+
+
+class SimulatedSession:
+    '''
+    sf.session of SalesforceSimulator - Bulk API 2.0 ingest endpoints only.
+    A job is processed once marked UploadComplete, taking batchTime +
+    recordTime per row of simulated time, and shows as JobComplete to the
+    first poll after that.
+    '''
+
+    def __init__(self, sim):
+        self.sim = sim
+
+    def path(self, url):
+        return url[len(self.sim.base_url + 'jobs/ingest/'):].strip('/')
+
+    def post(self, url, json=None, **kwargs):  # create job
+        sim = self.sim
+        sim.call('bulk2.create', json['object'])
+        with sim.lock:
+            jobId = '750SIM' + str(len(sim.jobs)).zfill(9)
+            sim.jobs[jobId] = dict(json, id=jobId, state='Open', rows=[],
+                                   numberRecordsProcessed=0,
+                                   numberRecordsFailed=0, ready=None)
+            return SimulatedResponse({i: sim.jobs[jobId][i] for i in
+                                      sim.jobs[jobId] if i not in
+                                      ('rows', 'ready')})
+
+    def put(self, url, data=None, **kwargs):  # upload CSV
+        jobId = self.path(url).split('/')[0]
+        job = self.sim.jobs.get(jobId)
+        if job == None or job['state'] != 'Open':
+            self.sim.call('bulk2.upload')
+            return SimulatedResponse({'errorCode': 'INVALIDJOBSTATE'}, 400)
+        if hasattr(data, 'read'):
+            data = data.read()
+        if type(data) == bytes:
+            data = data.decode('utf-8')
+        rows = list(csv.DictReader(io.StringIO(data)))
+        entry = self.sim.call('bulk2.upload', job['object'], len(rows))
+        job['rows'].extend(rows)
+        entry['seconds'] = time.time() - entry['started']
+        return SimulatedResponse({}, 201)
+
+    def patch(self, url, json=None, **kwargs):  # close / abort job
+        sim = self.sim
+        job = sim.jobs.get(self.path(url))
+        sim.call('bulk2.state', job['object'] if job else None)
+        if job == None:
+            return SimulatedResponse({'errorCode': 'NOT_FOUND'}, 404)
+        job['state'] = json['state']
+        if json['state'] == 'UploadComplete':
+            job['ready'] = time.time() + sim.batchTime + \
+                sim.recordTime * len(job['rows'])
+        return SimulatedResponse(self.info(job))
+
+    def get(self, url, **kwargs):  # poll job, or its failedResults
+        sim = self.sim
+        path = self.path(url).split('/')
+        job = sim.jobs.get(path[0])
+        if path[-1] == 'failedResults':
+            sim.call('bulk2.failedResults', job['object'] if job else None)
+            if job == None:
+                return SimulatedResponse({'errorCode': 'NOT_FOUND'}, 404)
+            return SimulatedResponse(self.failedResults(job))
+        sim.call('bulk2.poll', job['object'] if job else None)
+        if job == None:
+            return SimulatedResponse({'errorCode': 'NOT_FOUND'}, 404)
+        if job['state'] == 'UploadComplete' and time.time() >= job['ready']:
+            with sim.lock:
+                others = len([j for j in sim.jobs.values() if j is not job and
+                              j['object'] == job['object'] and
+                              j['state'] == 'UploadComplete'])
+                results = [sim.apply(job['object'], job['operation'], row,
+                                     job.get('externalIdFieldName'), others)
+                           for row in job['rows']]
+            job['numberRecordsProcessed'] = len(results)
+            job['failed'] = [(row, result) for row, result in
+                             zip(job['rows'], results)
+                             if not result['success']]
+            job['numberRecordsFailed'] = len(job['failed'])
+            job['state'] = 'JobComplete'
+        return SimulatedResponse(self.info(job))
+
+    def failedResults(self, job):
+        '''
+        CSV of the failed rows as Salesforce sends it - sf__Id, sf__Error
+        ('STATUS_CODE:message:fields'), then the fields sent.
+        '''
+        out = io.StringIO()
+        fields = list(job['rows'][0]) if job['rows'] else []
+        wr = csv.writer(out, lineterminator='\n')
+        wr.writerow(['sf__Id', 'sf__Error'] + fields)
+        for row, result in job.get('failed', []):
+            error = result['errors'][0]
+            wr.writerow([result['id'] or '', error['statusCode'] + ':' +
+                         error.get('message', '') + ':--'] +
+                        [row.get(i, '') for i in fields])
+        return out.getvalue()
+
+    def info(self, job):
+        return {i: job[i] for i in job if i not in ('rows', 'ready',
+                                                      'failed')}
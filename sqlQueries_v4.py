@@ -84,6 +84,7 @@ hc = {'birthdays':
         /* Need to churn through with ETLJitterbitClone functions - namely, M to Male, F to Female
         Did I mention the innerjoin function won't work in the SQL query? If it did, it
         would be enough to get the MAX CurrentExpiryDate out of the duplicate CustomerIds
+        transformCSV 'de_dupe_remove_old_dates' (col=0, dateCol=5) now does exactly that
         */
         SELECT
         DISTINCT MCD.CustomerId, 
@@ -186,9 +187,67 @@ hc = {'birthdays':
         /* Above AND and OR clauses filter a la: ContractLastUpdated yesterday | OR | IDLastUpdated yesterday | OR | DateStarted yesterday */
         /* No need for Profile last created yesterday clause as Profile creation date does not necessarily mean Health Club Membership association */
         """,
+        'all_members_incremental': 
+        """
+        SELECT
+        DISTINCT MCD.CustomerId, 
+        MCD.Surname, 
+        MCD.GivenNames, 
+        MCD.Description, 
+        CONVERT(varchar, MCD.DateStarted, 23) AS DateStarted, 
+        CONVERT(varchar, MCD.CurrentExpiryDate, 23) AS CurrentExpiryDate, 
+        MCD.Address, 
+        MCD.Suburb,
+        MCD.State,
+        MCD.PostCode, 
+        MCD.HomePhone, 
+        MCD.WorkPhone, 
+        MCD.MobilePhone, 
+        MCD.Email, 
+        CONVERT(varchar, MCD.DateOfBirth, 23) AS DateOfBirth, 
+        MCD.Gender, 
+        PE.Status, 
+	Profiles.DateLastUpdated AS IDLastUpdated, /* caters for profile changes e.g. address, email, gender lol etc on People table*/
+	MCC.CiD AS ContractLastUpdated, /* caters for contract renewals, cancellations - any changes made to the existing membership contract is timestamped (ideally AQ staff should be updating existing contracts as opposed to creating new ones */
+	MCD.CustomerDateCreated AS CustomerDateCreated /* same timestamp as DateCreated field of People table */
+        FROM MembershipContractsDetails AS MCD /* main table from which other relevant data is attached */
+        LEFT JOIN PeopleEblast AS PE /* required for status filter - needed unfortunately due to dirty Links data */
+        ON MCD.CustomerId=PE.Id 
+        LEFT JOIN (SELECT DISTINCT ContractId, MAX(DateTime) AS CiD FROM MembershipContractChanges GROUP BY ContractId) AS MCC
+        ON MCD.Id=MCC.ContractId /* date when contract details were amended by AQ staff */
+	LEFT JOIN People AS Profiles /* required for date of when customer profile info is changed e.g. address change etc */
+	ON MCD.CustomerId=Profiles.Id
+        WHERE MCD.ProductCode IN ( /* membership types - includes DD and upfront payment */
+        'M1050', 'M1059', 'M1061', 'M1063', 'M1074', 
+        'M1075', 'M1093', 'M1168', 'M1173', 'M1174', 
+        'M1194', 'M1216', 'M1220', 'M1221', 'M1224', 
+        'M1225', 'M1228', 'M1229', 'M1237', 'M1238', 
+        'M1239', 'M3034', 'M1076', 'M1077', 'M1083', 
+        'M1170', 'M1209', 'M1222', 'M1226', 'M1227', 
+        'M1230', 'M1231', 'M1232'
+	)
+	AND
+	PE.Status = 'Active'
+	AND
+	(MCC.CiD >= ? /* watermark - last successful run, see watermark_state in ETLJitterbitClone */
+	OR
+	Profiles.DateLastUpdated >= ? /* watermark */
+	OR
+	MCD.DateStarted >= CAST(? AS date) /* watermark - DateStarted has no time, so the whole day again */
+	)
+	AND
+	(CurrentExpiryDate >= DATEADD(d, datediff(d, 0, getdate()),-1) /* final filter is only generate rows that have an expiry date more than or equal to today! */
+	OR
+	CurrentExpiryDate IS NULL /* direct debit memberships with no expiry */
+	)
+        /* Above AND and OR clauses filter a la: ContractLastUpdated since watermark | OR | IDLastUpdated since watermark | OR | DateStarted since watermark */
+        /* Pass the same watermark for all 3 ? markers. Rows equal to the watermark come back again, upserts don't mind */
+        /* No need for Profile last created yesterday clause as Profile creation date does not necessarily mean Health Club Membership association */
+        """,
         'info': 
         """
         The most often used (the only one used) in health club (hc) dictionary is 'all_members_nightly' query.
+        'all_members_incremental' is the same query but for rows changed since the last successful run (watermark) instead of yesterday only.
         """         
     }
 